@@ -47,7 +47,7 @@ class RagClient:
     async def query(self, q: str):
         # 初始化对话消息
         messages = [
-            {"role": "system", "content": "你是一个专业的医学助手，请根据提供的医学文档回答问题。如果用户的问题需要查询医学知识，请使用列表中的工具来获取相关信息。"},
+            {"role": "system", "content": "你是一个专业的医学助手，请根据提供的医学文档回答问题。如果用户的问题需要查询医学知识，请使用列表中的工具来获取相关信息。需要同时查询多个方面时，用 retrieve_docs_batch 一次检索全部查询，不要多次调用 retrieve_docs。"},
             {"role": "user", "content": q}
         ]
         
@@ -0,0 +1,251 @@
+"""检索基准测试：recall@k、延迟、内存随数据规模与检索参数的变化。
+
+在合成语料（带聚类结构的单位向量，1 万到 1000 万条）和仓库自带的 medical_docs
+（用本地 HashingEmbedder 嵌入，不需要网络）上，依次扫过索引类型、向量编码、top_k、
+每次检索的批大小、线程数以及 nprobe / ef_search，记录：
+    build_s             建索引耗时
+    index_rss_mb        建索引前后常驻内存的增量
+    p50/p95/p99_ms      单次 index.search 调用（一批查询）的延迟
+    qps                 每秒查询数
+    recall              与精确检索 top_k 的重合比例
+结果写成 JSON，便于比较不同机器、不同版本的运行结果。
+
+    uv run bench.py --sizes 10000 100000 --kinds flat hnsw ivf_flat --top-k 1 10 --batch 1 32
+    uv run bench.py --sizes 10000000 --kinds ivf_pq --workdir /data/bench --out 10m.json
+    uv run bench.py --medical --sizes --kinds flat hnsw
+
+--workdir 指定后合成向量写入（并复用）该目录下的 .npy 文件，以内存映射方式读取，
+1000 万 × 1536 维（约 61 GB）这样超过内存的语料也能分段建索引。
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from typing import Dict, Iterator, List, Tuple
+
+import faiss
+import numpy as np
+from faiss.contrib.exhaustive_search import knn_ground_truth
+
+from chunking import chunk_file
+from embedding import HashingEmbedder
+from index_factory import CODECS, INDEX_KINDS, build_index, min_train_size, search_params
+
+# 合成数据每次生成 / 精确检索每次扫描的向量数
+BLOCK = 1 << 16
+
+MEDICAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "..", "05-resource-资源发现", "server", "medical_docs")
+MEDICAL_QUERIES = [
+    "高血压的诊断标准是什么？",
+    "收缩压≥140 需要吃药吗",
+    "糖尿病患者的饮食要注意什么",
+    "心脏病有哪些常见症状",
+    "血糖持续升高是什么病",
+    "冠心病和高血压有什么关系",
+]
+
+
+def rss_mb() -> float:
+    """当前常驻内存（MB）；读不到 /proc 时退化为峰值常驻内存。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KB 为单位
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def synthetic_corpus(n: int, dim: int, n_queries: int, seed: int = 0,
+                     workdir: str = "") -> Tuple[np.ndarray, np.ndarray]:
+    """生成 n 条语料向量与 n_queries 条留出查询（同分布、不在语料中）。
+
+    分块生成，每块的随机数种子只取决于 (seed, 块起点)，结果与块大小以外的参数无关。
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(16, int(np.sqrt(n))), dim)).astype("float32")
+
+    def block(block_seed: int, m: int) -> np.ndarray:
+        r = np.random.default_rng([seed, block_seed])
+        x = centers[r.integers(0, len(centers), m)] + 0.5 * r.standard_normal((m, dim), dtype="float32")
+        return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+    queries = block(n, n_queries)
+    if workdir:
+        path = os.path.join(workdir, f"synthetic_{n}x{dim}_seed{seed}.npy")
+        if os.path.exists(path):
+            return np.load(path, mmap_mode="r"), queries
+        os.makedirs(workdir, exist_ok=True)
+        base = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype="float32", shape=(n, dim))
+    else:
+        base = np.empty((n, dim), dtype="float32")
+    for start in range(0, n, BLOCK):
+        base[start:start + BLOCK] = block(start, min(BLOCK, n - start))
+    if workdir:
+        base.flush()
+        del base
+        os.replace(path + ".tmp", path)
+        return np.load(path, mmap_mode="r"), queries
+    return base, queries
+
+
+def medical_corpus(doc_dir: str = MEDICAL_DIR, dim: int = 1536) -> Tuple[np.ndarray, np.ndarray]:
+    """切块并用 HashingEmbedder 嵌入 doc_dir 下的全部 .txt 文档，查询为 MEDICAL_QUERIES。"""
+    texts = []
+    for name in sorted(os.listdir(doc_dir)):
+        if name.endswith(".txt"):
+            texts.extend(c.text for c in chunk_file(os.path.join(doc_dir, name)))
+    embedder = HashingEmbedder(dim)
+    return embedder.embed(texts), embedder.embed(MEDICAL_QUERIES)
+
+
+def blocks(vectors: np.ndarray) -> Iterator[np.ndarray]:
+    for start in range(0, len(vectors), BLOCK):
+        yield np.ascontiguousarray(vectors[start:start + BLOCK], dtype="float32")
+
+
+def recall(found: np.ndarray, truth: np.ndarray) -> float:
+    """结果与精确 top_k 的重合比例（真值中的空位 -1 不计）。"""
+    hits = total = 0
+    for f, t in zip(found, truth):
+        t = t[t >= 0]
+        hits += len(np.intersect1d(f, t))
+        total += len(t)
+    return hits / total if total else 1.0
+
+
+def search_settings(kind: str, nprobes: List[int], efs: List[int]) -> List[Dict[str, int]]:
+    if kind.startswith("ivf"):
+        return [{"nprobe": p} for p in nprobes]
+    if kind == "hnsw":
+        return [{"ef_search": e} for e in efs]
+    return [{}]
+
+
+def run_search(index: faiss.Index, queries: np.ndarray, top_k: int, batch: int,
+               params) -> Tuple[np.ndarray, List[float], float]:
+    """按 batch 条一批执行全部查询，返回 (结果 ID, 每次调用的延迟, 总耗时)。"""
+    index.search(queries[:batch], top_k, params=params)  # 预热
+    found = np.empty((len(queries), top_k), dtype=np.int64)
+    latencies = []
+    start_all = time.perf_counter()
+    for start in range(0, len(queries), batch):
+        t0 = time.perf_counter()
+        _, I = index.search(queries[start:start + batch], top_k, params=params)
+        latencies.append(time.perf_counter() - t0)
+        found[start:start + batch] = I
+    return found, latencies, time.perf_counter() - start_all
+
+
+def bench_corpus(name: str, base: np.ndarray, queries: np.ndarray,
+                 args: argparse.Namespace) -> List[Dict[str, object]]:
+    n, dim = base.shape
+    max_k = max(args.top_k)
+    t0 = time.perf_counter()
+    _, truth = knn_ground_truth(queries, blocks(base), max_k)
+    print(f"[{name}] n={n} 精确检索真值 {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+
+    rows = []
+    for kind in args.kinds:
+        for codec in args.codecs:
+            if n < max(1, min_train_size(kind, codec)):
+                print(f"[{name}] 跳过 {kind}/{codec}：需要至少 {min_train_size(kind, codec)} 条向量训练",
+                      file=sys.stderr)
+                continue
+            faiss.omp_set_num_threads(max(args.threads))
+            gc.collect()
+            rss0 = rss_mb()
+            t0 = time.perf_counter()
+            index = build_index(kind, base, np.arange(n, dtype=np.int64), codec=codec)
+            build_s = time.perf_counter() - t0
+            index_mb = rss_mb() - rss0
+            print(f"[{name}] {kind}/{codec} 建索引 {build_s:.1f}s，内存 +{index_mb:.0f}MB", file=sys.stderr)
+
+            for threads in args.threads:
+                faiss.omp_set_num_threads(threads)
+                for setting in search_settings(kind, args.nprobe, args.ef_search):
+                    params = search_params(index, setting.get("nprobe", 0), setting.get("ef_search", 0))
+                    for batch in args.batch:
+                        for top_k in args.top_k:
+                            found, lat, total = run_search(index, queries, top_k, batch, params)
+                            lat_ms = np.array(lat) * 1000
+                            rows.append({
+                                "corpus": name, "n": n, "dim": dim, "kind": kind, "codec": codec,
+                                **setting,
+                                "threads": threads, "batch": batch, "top_k": top_k,
+                                "build_s": round(build_s, 3),
+                                "index_rss_mb": round(index_mb, 1),
+                                "p50_ms": round(float(np.percentile(lat_ms, 50)), 4),
+                                "p95_ms": round(float(np.percentile(lat_ms, 95)), 4),
+                                "p99_ms": round(float(np.percentile(lat_ms, 99)), 4),
+                                "qps": round(len(queries) / total, 1),
+                                "recall": round(recall(found, truth[:, :top_k]), 4),
+                            })
+            del index
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="retrieve_docs 检索基准测试")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10000, 100000],
+                        help="合成语料的向量数，可给多个（例如 10000 100000 1000000 10000000）")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--medical", action="store_true", help="同时测试 medical_docs 语料")
+    parser.add_argument("--medical-dir", default=MEDICAL_DIR)
+    parser.add_argument("--queries", type=int, default=1000, help="合成语料的留出查询数")
+    parser.add_argument("--kinds", nargs="+", default=["flat", "hnsw", "ivf_flat"], choices=INDEX_KINDS)
+    parser.add_argument("--codecs", nargs="+", default=["float32"], choices=CODECS)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 32], help="每次 search 调用的查询数")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[16], help="IVF 类索引的 nprobe")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[64], help="HNSW 的 efSearch")
+    parser.add_argument("--workdir", default="", help="合成向量的落盘目录（内存映射），为空则放在内存中")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="结果 JSON 文件，不指定则打印到标准输出")
+    args = parser.parse_args()
+    args.threads = sorted(set(args.threads))
+
+    results = []
+    if args.medical:
+        base, queries = medical_corpus(args.medical_dir, args.dim)
+        results += bench_corpus("medical_docs", base, queries, args)
+    for n in args.sizes:
+        base, queries = synthetic_corpus(n, args.dim, args.queries, args.seed, args.workdir)
+        results += bench_corpus(f"synthetic_{n}", base, queries, args)
+        del base
+        gc.collect()
+
+    report = {
+        "env": {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "faiss": faiss.__version__,
+            "numpy": np.__version__,
+        },
+        "args": vars(args),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
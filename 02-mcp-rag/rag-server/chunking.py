@@ -0,0 +1,131 @@
+"""流式文档切块。
+
+长文档整篇作为一个向量时，命中结果又长又泛，还会撑大 LLM 的提示词。
+这里按句子边界（兼顾中文标点）把文本切成 token 数受限、相邻块有重叠的滑动窗口，
+全部基于生成器实现，多 GB 的语料也只需有界内存；每个块记录它在源文本中的字符偏移，
+命中后可以据此拼接相邻块、还原上下文。
+"""
+import re
+from collections import deque
+from typing import Iterable, Iterator, NamedTuple, Optional, Tuple
+
+# 句末标点（可跟随右引号 / 右括号）、换行，以及后接空白的英文句点
+_SENT_END = re.compile(r"[。！？!?；;…]+[”’\"」』）)]*|\n+|\.(?=\s)")
+
+# 流式读取时，缓冲区中迟迟找不到句子边界也会强制切分，避免单行超大文件撑爆内存
+MAX_CARRY_CHARS = 1 << 16
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 token/字，其余约 4 字符/token。"""
+    cjk = sum(1 for ch in text if ch >= "\u2e80")
+    return cjk + (len(text) - cjk + 3) // 4 + 1
+
+
+class Chunk(NamedTuple):
+    text: str
+    source: str = ""
+    start: int = 0  # 在源文本中的起始字符偏移
+    end: int = 0    # 结束字符偏移（不含）
+    tags: Tuple[str, ...] = ()  # 元数据标签（科室、文档类型等），用于检索过滤
+    timestamp: int = 0          # 文档时间（Unix 秒），0 表示未知
+
+
+def as_chunk(doc) -> Chunk:
+    """把普通字符串视为来源未知的整篇文档。"""
+    return doc if isinstance(doc, Chunk) else Chunk(doc, "", 0, len(doc))
+
+
+def split_sentences(text: str, base: int = 0) -> Iterator[Tuple[int, str]]:
+    """按句子切分，返回 (起始偏移, 句子)；句子首尾相接，拼起来就是原文。"""
+    start = 0
+    for m in _SENT_END.finditer(text):
+        yield base + start, text[start:m.end()]
+        start = m.end()
+    if start < len(text):
+        yield base + start, text[start:]
+
+
+def iter_sentences(blocks: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    """对分块到达的文本流做句子切分，跨块的半句会留到下一块再处理。"""
+    carry, offset = "", 0
+    for block in blocks:
+        buf = carry + block
+        last = None
+        for last in _SENT_END.finditer(buf):
+            pass
+        cut = last.end() if last else 0
+        if cut == 0 and len(buf) > MAX_CARRY_CHARS:
+            cut = len(buf)
+        yield from split_sentences(buf[:cut], offset)
+        carry, offset = buf[cut:], offset + cut
+    if carry:
+        yield from split_sentences(carry, offset)
+
+
+def _hard_split(offset: int, sentence: str, max_tokens: int) -> Iterator[Tuple[int, str]]:
+    n = estimate_tokens(sentence)
+    if n <= max_tokens:
+        yield offset, sentence
+        return
+    step = max(1, len(sentence) * max_tokens // n)
+    for i in range(0, len(sentence), step):
+        yield offset + i, sentence[i:i + step]
+
+
+def chunk_sentences(sentences: Iterable[Tuple[int, str]], source: str = "",
+                    max_tokens: int = 400, overlap_tokens: int = 50) -> Iterator[Chunk]:
+    """把句子流合并成不超过 max_tokens 的块，相邻块保留约 overlap_tokens 的重叠。"""
+    window: deque = deque()  # (偏移, 句子, token 数)
+    tokens = 0
+    fresh = False  # 窗口里是否有尚未输出过的句子
+    for offset, sentence in sentences:
+        for off, piece in _hard_split(offset, sentence, max_tokens):
+            n = estimate_tokens(piece)
+            if fresh and tokens + n > max_tokens:
+                yield _make_chunk(window, source)
+                fresh = False
+                while window and (tokens > overlap_tokens or tokens + n > max_tokens):
+                    tokens -= window.popleft()[2]
+            window.append((off, piece, n))
+            tokens += n
+            fresh = True
+    if fresh:
+        yield _make_chunk(window, source)
+
+
+def _make_chunk(window: deque, source: str) -> Chunk:
+    start = window[0][0]
+    text = "".join(s for _, s, _ in window)
+    return Chunk(text, source, start, start + len(text))
+
+
+def chunk_text(text: str, source: str = "", max_tokens: int = 400,
+               overlap_tokens: int = 50) -> Iterator[Chunk]:
+    """切分一段内存中的文本；max_tokens <= 0 时不切分，整篇作为一个块。"""
+    if max_tokens <= 0:
+        yield Chunk(text, source, 0, len(text))
+        return
+    chunks = chunk_sentences(split_sentences(text), source, max_tokens, overlap_tokens)
+    yield from (c for c in chunks if c.text.strip())
+
+
+def chunk_file(path: str, source: Optional[str] = None, max_tokens: int = 400,
+               overlap_tokens: int = 50, block_chars: int = 1 << 20) -> Iterator[Chunk]:
+    """流式读取并切分文本文件，每次只读入 block_chars 个字符。"""
+    source = path if source is None else source
+
+    def blocks() -> Iterator[str]:
+        with open(path, encoding="utf-8") as f:
+            while True:
+                block = f.read(block_chars)
+                if not block:
+                    return
+                yield block
+
+    if max_tokens <= 0:
+        text = "".join(blocks())
+        yield Chunk(text, source, 0, len(text))
+        return
+    chunks = chunk_sentences(iter_sentences(blocks()), source, max_tokens, overlap_tokens)
+    yield from (c for c in chunks if c.text.strip())
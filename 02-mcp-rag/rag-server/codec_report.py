@@ -0,0 +1,119 @@
+"""向量编码（codec）的内存 / 召回率对照报告。
+
+对同一批向量分别用 float32 / fp16 / sq8 / pq / binary 建索引，用留出的查询向量（不入库）
+测量索引序列化后的字节数、recall@k（以 float32 暴力检索为真值），
+以及用原始向量对 top_k * rescore 个候选精确重排后的 recall@k，结果以 JSON 输出。
+binary 只支持 flat，候选数与 RagStore 一致，至少为 BINARY_CANDIDATES。
+
+    uv run codec_report.py --vectors ./rag_index/vectors.npy --kind flat --top-k 10
+    uv run codec_report.py --n 200000 --dim 1536 --out report.json
+"""
+import argparse
+import json
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from index_factory import (BINARY_CANDIDATES, CODECS, INDEX_KINDS, build_index, index_kind, make_index,
+                           rerank_exact, serialize_index)
+
+
+def synthetic_vectors(n: int, dim: int, n_clusters: int = 100, seed: int = 0) -> np.ndarray:
+    """带聚类结构的单位向量，比纯高斯噪声更接近真实嵌入的分布。"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype("float32")
+    x = centers[rng.integers(0, n_clusters, n)] + 0.5 * rng.standard_normal((n, dim)).astype("float32")
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """每个查询的结果与真值 top_k 的交集比例，再取平均。"""
+    k = truth.shape[1]
+    hits = sum(len(set(f[:k].tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def report(base: np.ndarray, queries: np.ndarray, kind: str, top_k: int,
+           rescore: List[int]) -> List[Dict[str, object]]:
+    ids = np.arange(len(base), dtype=np.int64)
+    exact = make_index("flat", base.shape[1])
+    exact.add_with_ids(base, ids)
+    _, truth = exact.search(queries, top_k)
+
+    rows = []
+    for codec in CODECS:
+        if codec == "binary" and kind != "flat":
+            continue
+        start = time.perf_counter()
+        index = build_index(kind, base, ids, codec=codec)
+        build_s = time.perf_counter() - start
+        start = time.perf_counter()
+        _, found = index.search(queries, top_k)
+        search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        nbytes = int(serialize_index(index).nbytes)
+        row = {
+            "kind": index_kind(index),
+            "codec": codec,
+            "index_bytes": nbytes,
+            "bytes_per_vector": round(nbytes / len(base), 1),
+            "build_s": round(build_s, 3),
+            "search_ms": round(search_ms, 4),
+            f"recall@{top_k}": round(recall_at_k(found, truth), 4),
+        }
+        if codec != "float32":
+            for factor in rescore:
+                start = time.perf_counter()
+                fetch = top_k * factor
+                if codec == "binary":
+                    fetch = max(fetch, BINARY_CANDIDATES)
+                _, cand = index.search(queries, fetch)
+                _, found = rerank_exact(queries, cand, base[np.maximum(cand, 0)], top_k)
+                row[f"rescore_x{factor}"] = {
+                    f"recall@{top_k}": round(recall_at_k(found, truth), 4),
+                    "search_ms": round((time.perf_counter() - start) * 1000 / len(queries), 4),
+                }
+        rows.append(row)
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="比较各向量编码的内存占用与 recall@k")
+    parser.add_argument("--vectors", help=".npy 向量文件（例如向量库目录中的 vectors.npy），不指定则生成合成数据")
+    parser.add_argument("--n", type=int, default=100000, help="合成数据的向量数")
+    parser.add_argument("--dim", type=int, default=1536, help="合成数据的向量维度")
+    parser.add_argument("--queries", type=int, default=1000, help="留出作为查询的向量数")
+    parser.add_argument("--kind", default="flat", choices=INDEX_KINDS, help="索引类型")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--rescore", type=int, nargs="*", default=[2, 4, 8],
+                        help="精确重排的候选倍数，可给多个")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="报告输出文件，不指定则打印到标准输出")
+    args = parser.parse_args()
+
+    if args.vectors:
+        vectors = np.ascontiguousarray(np.load(args.vectors, mmap_mode="r"), dtype="float32")
+    else:
+        vectors = synthetic_vectors(args.n + args.queries, args.dim, seed=args.seed)
+    # 打乱后切出留出查询，查询向量本身不在索引中
+    order = np.random.default_rng(args.seed).permutation(len(vectors))
+    queries = np.ascontiguousarray(vectors[order[:args.queries]])
+    base = np.ascontiguousarray(vectors[order[args.queries:]])
+
+    result = {
+        "n": len(base),
+        "dim": base.shape[1],
+        "queries": len(queries),
+        "top_k": args.top_k,
+        "codecs": report(base, queries, args.kind, args.top_k, args.rescore),
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
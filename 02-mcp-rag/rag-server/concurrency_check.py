@@ -0,0 +1,127 @@
+"""并发检查：嵌入期间事件循环不被阻塞，两个工具调用可以同时执行。
+
+服务端等待嵌入服务时（见 embedding.py），应当照常处理其他请求。本脚本通过 stdio 以 --serve 模式
+启动服务端（默认 server.py，不需要网络与 API Key），把嵌入后端换成 SlowEmbedder：每次调用先等待
+--delay 秒（模拟网络往返），再用 HashingEmbedder 计算向量，并把这次调用的起止时间追加到日志。
+客户端先写入一篇种子文档，再同时发出 index_docs 与 retrieve_docs，检查：
+    overlap   两次嵌入的执行区间有重叠；
+    elapsed   两次调用的总耗时小于两次嵌入耗时之和。
+有人在嵌入期间持锁、在事件循环里做同步网络请求时，两次调用会排队执行，检查失败，退出码为 1。
+
+    uv run concurrency_check.py
+    uv run concurrency_check.py --server server-ali.py --delay 1
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+from mcp import ClientSession
+from mcp.client.stdio import StdioServerParameters, stdio_client
+
+from embedding import HashingEmbedder
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class SlowEmbedder(HashingEmbedder):
+    """每次调用固定耗时 delay 秒的嵌入后端，调用的起止时间按 JSON Lines 追加到 log。"""
+
+    def __init__(self, delay: float, log: str):
+        super().__init__(dim=1536)
+        self.delay = delay
+        self.log = log
+
+    async def __call__(self, texts: List[str]) -> np.ndarray:
+        start = time.time()
+        await asyncio.sleep(self.delay)
+        embeddings = self.embed(texts)
+        with open(self.log, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"start": start, "end": time.time(), "n": len(texts)}) + "\n")
+        return embeddings
+
+
+def serve(args: argparse.Namespace) -> None:
+    """加载服务端脚本，替换嵌入后端后通过 stdio 提供服务。"""
+    spec = importlib.util.spec_from_file_location("rag_server", os.path.join(HERE, args.server))
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    server._embed_remote = SlowEmbedder(args.delay, args.log)
+    server.mcp.run(transport="stdio")
+
+
+async def check(args: argparse.Namespace) -> Dict[str, object]:
+    log = os.path.join(tempfile.mkdtemp(prefix="rag-concurrency-"), "embed.jsonl")
+    env = dict(os.environ)
+    env.setdefault("RAG_EMBED_BACKEND", "hash")
+    env.setdefault("OPENAI_API_KEY", "unused")
+    env.setdefault("DASHSCOPE_API_KEY", "unused")
+    env["RAG_INDEX_PATH"] = ""
+    params = StdioServerParameters(
+        command=sys.executable, env=env, cwd=HERE,
+        args=[os.path.abspath(__file__), "--serve", "--server", args.server,
+              "--delay", str(args.delay), "--log", log])
+    async with stdio_client(params) as (read, write):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+
+            async def call(tool: str, **arguments) -> Dict[str, object]:
+                start = time.time()
+                result = await session.call_tool(tool, arguments)
+                text = result.content[0].text if result.content else ""
+                return {"tool": tool, "start": start, "end": time.time(),
+                        "error": result.isError or text.startswith("参数错误"), "text": text[:200]}
+
+            # 空库上检索不会调用嵌入，先写入一篇种子文档
+            seed = await call("index_docs", docs=["高血压患者应当限制钠盐摄入，每日不超过 5 克。"])
+            os.remove(log)
+            calls = await asyncio.gather(
+                call("index_docs", docs=["糖尿病患者应当定期监测空腹血糖与糖化血红蛋白。"]),
+                call("retrieve_docs", query="高血压每天吃多少盐"))
+    with open(log, encoding="utf-8") as f:
+        windows = [json.loads(line) for line in f]
+
+    failures = [f"{c['tool']}: {c['text']}" for c in [seed, *calls] if c["error"]]
+    if len(windows) != 2:
+        failures.append(f"预期 2 次嵌入调用，实际 {len(windows)} 次")
+    elif max(w["start"] for w in windows) >= min(w["end"] for w in windows):
+        failures.append("overlap: 两次嵌入的执行区间没有重叠")
+    elapsed = max(c["end"] for c in calls) - min(c["start"] for c in calls)
+    if elapsed >= 2 * args.delay:
+        failures.append(f"elapsed: 两次调用共耗时 {elapsed:.2f}s，不小于 {2 * args.delay:.2f}s")
+    return {
+        "server": args.server,
+        "delay": args.delay,
+        "elapsed": round(elapsed, 3),
+        "calls": [{"tool": c["tool"], "seconds": round(c["end"] - c["start"], 3)} for c in calls],
+        "embed_windows": [[round(w["start"] - calls[0]["start"], 3),
+                           round(w["end"] - calls[0]["start"], 3)] for w in windows],
+        "failures": failures,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="检查两个工具调用能否在等待嵌入时同时执行")
+    parser.add_argument("--server", default="server.py", help="服务端脚本（server.py / server-ali.py）")
+    parser.add_argument("--delay", type=float, default=0.5, help="每次嵌入调用的耗时（秒）")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--log", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    report = asyncio.run(check(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if report["failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""基于内容寻址的嵌入缓存（SQLite）。
+
+缓存键 = sha256(模型名, 向量维度, 规范化后的文本)，值为 float32 向量字节。
+按最近使用时间做 LRU 淘汰，条目数超过 max_entries 时删除最久未用的条目，降到 max_entries 的 90%，
+这样不必每次写入都淘汰。条目数在内存中累计，只在超过上限时用 COUNT(*) 核对一次
+（多个进程共用一个缓存文件时，各自的累计值会偏小）。
+SQLite 读写在线程中执行，不阻塞事件循环；同一连接上的操作用锁串行化。
+"""
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def cache_key(model: str, dim: int, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{dim}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """嵌入向量缓存，只把未命中的文本交给嵌入服务。
+
+    Args:
+        path: SQLite 文件路径，":memory:" 表示仅进程内缓存
+        model: 嵌入模型名
+        dim: 向量维度
+        max_entries: 最多缓存的向量条数
+    """
+
+    def __init__(self, path: str, model: str, dim: int, max_entries: int = 50000):
+        self.model = model
+        self.dim = dim
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key BLOB PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        self._db.commit()
+        self._count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        with self._lock:
+            found = self._select(keys)
+            self._db.commit()
+        return found
+
+    def _select(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found: Dict[bytes, np.ndarray] = {}
+        # SQLite 单条语句的参数个数有上限，分批查询
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._db.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk).fetchall()
+            for key, vec in rows:
+                found[key] = np.frombuffer(vec, dtype="float32")
+        if found:
+            now = time.time()
+            self._db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                 [(now, k) for k in found])
+        return found
+
+    def _put_many(self, items: Dict[bytes, np.ndarray]) -> None:
+        now = time.time()
+        with self._lock:
+            # 键由内容决定，已存在（并发的另一次调用刚写入）时向量相同，忽略即可；rowcount 只计新增的行
+            cursor = self._db.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vec, last_used) VALUES (?, ?, ?)",
+                [(k, np.asarray(v, dtype="float32").tobytes(), now) for k, v in items.items()])
+            self._count += max(cursor.rowcount, 0)
+            if self._count > self.max_entries:
+                self._count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                if self._count > self.max_entries:
+                    cursor = self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN ("
+                        " SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                        (self._count - self.max_entries * 9 // 10,))
+                    self._count -= cursor.rowcount
+            self._db.commit()
+
+    async def embed(self, texts: List[str],
+                    embed_fn: Callable[[List[str]], Awaitable[np.ndarray]],
+                    counts: Optional[Dict[str, int]] = None) -> np.ndarray:
+        """返回 texts 的嵌入矩阵；未命中的文本（去重后）交给 embed_fn 计算并写入缓存。
+
+        counts 不为 None 时把本次的命中 / 未命中数累加到 counts["hits"] / counts["misses"]，
+        供调用方统计单次任务（进程累计值见 stats）。
+        """
+        keys = [cache_key(self.model, self.dim, t) for t in texts]
+        found = await asyncio.to_thread(self._get_many, list(dict.fromkeys(keys)))
+
+        missing: Dict[bytes, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        n_hits = sum(1 for k in keys if k in found)
+        self.hits += n_hits
+        self.misses += len(texts) - n_hits
+        if counts is not None:
+            counts["hits"] = counts.get("hits", 0) + n_hits
+            counts["misses"] = counts.get("misses", 0) + len(texts) - n_hits
+
+        if missing:
+            vectors = await embed_fn(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            await asyncio.to_thread(self._put_many, new)
+            found.update(new)
+
+        out = np.empty((len(texts), self.dim), dtype="float32")
+        for i, key in enumerate(keys):
+            out[i] = found[key]
+        return out
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,173 @@
+"""异步嵌入后端。
+
+OpenAI / 百炼的同步客户端会阻塞 FastMCP 的事件循环，这里统一使用 AsyncOpenAI，
+并用信号量限制同时在途的嵌入请求数，让索引与查询请求可以交错执行。
+大批量文档按服务商的单次请求上限（条数 / token 数）切分，并以有界窗口流水线并发嵌入。
+
+所有后端都实现 Embedder 接口；HashingEmbedder 是不依赖网络的本地确定性后端，
+用于压测、基准测试和 CI，嵌入质量远不及真实模型，不要用于生产检索。
+"""
+import asyncio
+import hashlib
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from openai import AsyncOpenAI
+
+from chunking import Chunk, estimate_tokens
+from lexical_index import tokenize
+
+
+class Embedder(ABC):
+    """嵌入后端接口：await embedder(texts) 返回 (len(texts), dim) 的 float32 数组。
+
+    Args:
+        model: 模型名，同时作为嵌入缓存键的一部分
+        dimensions: 输出维度，None 表示使用模型默认维度
+        max_concurrency: 同时在途的嵌入请求上限
+        max_batch_items: 单次请求允许的最大文本条数
+        max_batch_tokens: 单次请求允许的最大 token 数（估算）
+    """
+
+    def __init__(self, model: str, dimensions: Optional[int] = None,
+                 max_concurrency: int = 4, max_batch_items: int = 2048,
+                 max_batch_tokens: int = 300000):
+        self.model = model
+        self.dimensions = dimensions
+        self.max_concurrency = max_concurrency
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
+
+    @abstractmethod
+    async def __call__(self, texts: List[str]) -> np.ndarray:
+        """嵌入一批文本（条数与 token 数不超过 max_batch_items / max_batch_tokens）。"""
+
+
+class OpenAIEmbedder(Embedder):
+    """OpenAI 兼容接口的异步嵌入后端。
+
+    Args:
+        model: 嵌入模型名
+        dimensions: 指定输出维度（仅部分模型支持），None 表示使用模型默认维度
+        max_concurrency: 同时在途的嵌入请求上限
+        max_batch_items: 服务商单次请求允许的最大文本条数
+        max_batch_tokens: 服务商单次请求允许的最大 token 数（估算）
+        **client_kwargs: 透传给 AsyncOpenAI，例如 api_key / base_url
+    """
+
+    def __init__(self, model: str, dimensions: Optional[int] = None,
+                 max_concurrency: int = 4, max_batch_items: int = 2048,
+                 max_batch_tokens: int = 300000, **client_kwargs):
+        super().__init__(model, dimensions, max_concurrency, max_batch_items, max_batch_tokens)
+        self.client = AsyncOpenAI(**client_kwargs)
+        self._sem = asyncio.Semaphore(max_concurrency)
+
+    async def __call__(self, texts: List[str]) -> np.ndarray:
+        kwargs = {"dimensions": self.dimensions} if self.dimensions else {}
+        async with self._sem:
+            resp = await self.client.embeddings.create(
+                model=self.model,
+                input=texts,
+                encoding_format="float",
+                **kwargs,
+            )
+        return np.array([d.embedding for d in resp.data], dtype="float32")
+
+
+@lru_cache(maxsize=1 << 18)
+def _feature_hash(feature: str) -> bytes:
+    return hashlib.blake2b(feature.encode("utf-8"), digest_size=4 * HashingEmbedder.PROBES).digest()
+
+
+class HashingEmbedder(Embedder):
+    """本地确定性嵌入：特征哈希（稀疏随机投影），不需要网络。
+
+    文本按 lexical_index.tokenize 切成特征（中文单字 + 相邻两字、英文单词），每个特征由 blake2b
+    映射到 PROBES 个维度和正负号，按 1 + log(词频) 加权累加后归一化为单位向量。
+    共享特征越多的文本余弦相似度越高；结果只取决于文本本身，跨进程、跨机器完全一致。
+
+    Args:
+        dim: 输出维度，默认与 text-embedding-3-small 相同
+        max_concurrency / max_batch_items / max_batch_tokens: 同 Embedder，用于控制切批与并发
+    """
+
+    PROBES = 4
+
+    def __init__(self, dim: int = 1536, max_concurrency: int = 4,
+                 max_batch_items: int = 2048, max_batch_tokens: int = 300000):
+        super().__init__(f"hashing-{dim}", dim, max_concurrency, max_batch_items, max_batch_tokens)
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """同步嵌入一批文本。"""
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        rows, digests, weights = [], [], []
+        for i, text in enumerate(texts):
+            for feature, tf in Counter(tokenize(text)).items():
+                rows.append(i)
+                digests.append(_feature_hash(feature))
+                weights.append(1.0 + np.log(tf))
+        if not rows:
+            return out
+        codes = np.frombuffer(b"".join(digests), dtype="<u4").reshape(len(rows), self.PROBES)
+        cols = codes % self.dim
+        signs = np.where(codes >> 31, -1.0, 1.0).astype("float32")
+        values = signs * np.asarray(weights, dtype="float32")[:, None]
+        np.add.at(out, (np.repeat(rows, self.PROBES), cols.ravel()), values.ravel())
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.where(norms > 0, norms, 1.0)
+
+    async def __call__(self, texts: List[str]) -> np.ndarray:
+        # 大批量时在线程中计算，不阻塞事件循环
+        if len(texts) < 64:
+            return self.embed(texts)
+        return await asyncio.to_thread(self.embed, texts)
+
+
+def split_batches(chunks: Iterable[Chunk], max_items: int,
+                  max_tokens: int) -> Iterator[List[Chunk]]:
+    """按条数与估算 token 数把块流切成批次。
+
+    单个块超过 max_tokens 时单独成批，由服务商决定是否截断。
+    """
+    batch: List[Chunk] = []
+    tokens = 0
+    for chunk in chunks:
+        n = estimate_tokens(chunk.text)
+        if batch and (len(batch) >= max_items or tokens + n > max_tokens):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(chunk)
+        tokens += n
+    if batch:
+        yield batch
+
+
+async def embed_in_batches(
+    chunks: Iterable[Chunk],
+    embed_fn: Callable[[List[str]], Awaitable[np.ndarray]],
+    max_items: int,
+    max_tokens: int,
+    window: int = 4,
+) -> AsyncIterator[Tuple[List[Chunk], np.ndarray]]:
+    """流水线嵌入：最多 window 个批次同时在途，按输入顺序逐批产出 (块列表, 向量)。
+
+    chunks 可以是生成器，只会被按需消费，内存占用与 window 成正比。
+    """
+    pending: deque = deque()
+    try:
+        for batch in split_batches(chunks, max_items, max_tokens):
+            pending.append((batch, asyncio.ensure_future(embed_fn([c.text for c in batch]))))
+            if len(pending) >= window:
+                batch, task = pending.popleft()
+                yield batch, await task
+        while pending:
+            batch, task = pending.popleft()
+            yield batch, await task
+    finally:
+        # 出错或调用方提前退出时，取消尚未完成的批次
+        for _, task in pending:
+            task.cancel()
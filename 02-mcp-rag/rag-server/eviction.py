@@ -0,0 +1,104 @@
+"""内存预算下的淘汰策略（见 tiered_store.TieredStore）。
+
+策略只负责给热层的在线片段排出淘汰顺序，不关心淘汰后是溢出到磁盘还是丢弃：
+    lru   最久没有被检索命中的先淘汰（从未命中的按加入时间；服务启动前就在库中的最先）
+    fifo  最早加入的先淘汰（外部 ID 严格递增，即按 ID）
+    ttl   时间戳早于 ttl 秒之前的片段无论是否超出预算都淘汰；超出预算时再按时间戳从旧到新淘汰。
+          时间戳默认为入库时间，入库时指定了 timestamps 则按文档时间计；时间戳未知（0）的不过期
+新策略继承 EvictionPolicy 并加入 EVICTION_POLICIES 即可通过 RAG_EVICTION 选用。
+"""
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, Type
+
+import numpy as np
+
+
+class EvictionPolicy(ABC):
+    """淘汰策略的基类。
+
+    Args:
+        ttl: 片段的存活秒数，0 表示不过期（只有 ttl 策略使用）
+    """
+
+    name = ""
+
+    def __init__(self, ttl: float = 0):
+        self.ttl = ttl
+
+    def added(self, doc_ids: np.ndarray, now: float) -> None:
+        """片段加入热层。"""
+
+    def touched(self, doc_ids: Iterable[int], now: float) -> None:
+        """片段被检索命中。"""
+
+    @abstractmethod
+    def order(self, doc_ids: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+        """返回淘汰顺序：doc_ids 的下标排列，先淘汰的在前。"""
+
+    def expired(self, doc_ids: np.ndarray, timestamps: np.ndarray, now: float) -> np.ndarray:
+        """无论是否超出预算都要淘汰的片段（布尔掩码）。"""
+        return np.zeros(len(doc_ids), dtype=bool)
+
+
+class LRUPolicy(EvictionPolicy):
+    name = "lru"
+
+    def __init__(self, ttl: float = 0):
+        super().__init__(ttl)
+        # 按外部 ID 记录最近一次加入或命中的时间，0 表示服务启动后还没有用到过
+        self._last = np.zeros(0, dtype=np.float64)
+
+    def _set(self, doc_ids: np.ndarray, now: float) -> None:
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        doc_ids = doc_ids[doc_ids >= 0]
+        if not len(doc_ids):
+            return
+        if doc_ids.max() >= len(self._last):
+            grown = np.zeros(max(int(doc_ids.max()) + 1, 2 * len(self._last)), dtype=np.float64)
+            grown[:len(self._last)] = self._last
+            self._last = grown
+        self._last[doc_ids] = now
+
+    def added(self, doc_ids: np.ndarray, now: float) -> None:
+        self._set(doc_ids, now)
+
+    def touched(self, doc_ids: Iterable[int], now: float) -> None:
+        self._set(np.fromiter(doc_ids, dtype=np.int64), now)
+
+    def order(self, doc_ids: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+        last = np.zeros(len(doc_ids), dtype=np.float64)
+        known = doc_ids < len(self._last)
+        last[known] = self._last[doc_ids[known]]
+        # 稳定排序：同一时间（例如都未用到过）的按 ID 即加入顺序
+        return np.argsort(last, kind="stable")
+
+
+class FIFOPolicy(EvictionPolicy):
+    name = "fifo"
+
+    def order(self, doc_ids: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+        return np.argsort(doc_ids, kind="stable")
+
+
+class TTLPolicy(EvictionPolicy):
+    name = "ttl"
+
+    def order(self, doc_ids: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+        return np.argsort(timestamps, kind="stable")
+
+    def expired(self, doc_ids: np.ndarray, timestamps: np.ndarray, now: float) -> np.ndarray:
+        if self.ttl <= 0:
+            return super().expired(doc_ids, timestamps, now)
+        # 时间戳为 0（未知，旧版本的向量库）的不算过期
+        return (timestamps > 0) & (timestamps < now - self.ttl)
+
+
+EVICTION_POLICIES: Dict[str, Type[EvictionPolicy]] = {
+    cls.name: cls for cls in (LRUPolicy, FIFOPolicy, TTLPolicy)
+}
+
+
+def make_policy(name: str, ttl: float = 0) -> EvictionPolicy:
+    if name not in EVICTION_POLICIES:
+        raise ValueError(f"未知淘汰策略 {name}，可选：{', '.join(EVICTION_POLICIES)}")
+    return EVICTION_POLICIES[name](ttl)
@@ -0,0 +1,336 @@
+"""FAISS 索引工厂：Flat / IVF-Flat / IVF-PQ / HNSW，以及向量的存储编码（codec）。
+
+IVF 类索引需要先训练聚类中心，文档数不够时先用 Flat 暂存，
+达到训练所需的样本数后再整体迁移（promote）到目标索引。
+所有索引都以稳定的外部 ID 存取向量：IVF 原生支持 add_with_ids，Flat / HNSW 外包一层 IndexIDMap2。
+
+codec 决定索引内每个向量的存储方式（1536 维时每个向量的字节数）：
+    float32  原始向量，6144 字节
+    fp16     半精度，3072 字节，几乎无损
+    sq8      8 位标量量化，1536 字节，需要训练每一维的取值范围
+    pq       乘积量化，64 字节，需要训练码本，召回损失最大
+    binary   符号位（每维 1 位），192 字节，按汉明距离暴力扫描，只用于粗筛（见 SignBitIndex）
+有损编码可配合 rerank_exact 用原始向量对候选重新精确打分；
+mmr_select 按最大边际相关性（MMR）从候选中挑出相关且彼此不重复的结果。
+"""
+import math
+from typing import Optional, Tuple
+
+import faiss
+import numpy as np
+
+INDEX_KINDS = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+CODECS = ("float32", "fp16", "sq8", "pq", "binary")
+
+# 每个聚类中心至少需要的训练样本数（低于它 faiss 会给出警告）
+MIN_POINTS_PER_CENTROID = 39
+# 训练时最多采样的点数 = nlist * MAX_POINTS_PER_CENTROID
+MAX_POINTS_PER_CENTROID = 256
+
+HNSW_M = 32
+PQ_M = 64  # 1536 / 64 = 每个子空间 24 维
+PQ_NBITS = 8
+# 8 位标量量化只需估计每一维的取值范围，少量样本即可
+SQ_TRAIN_SIZE = 1000
+DEFAULT_NPROBE = 16
+# binary 编码粗筛时至少取的候选数（汉明距离很粗，候选太少会漏掉真正的近邻）
+BINARY_CANDIDATES = 256
+# IndexIDMap2 每个向量的外部 ID 表（8 字节）与反查哈希表（每项约 32 字节）
+ID_MAP2_BYTES = 40
+# 建索引时每次 add 的向量数，vectors 可以是大于内存的 np.memmap
+ADD_BATCH = 1 << 16
+
+
+def choose_nlist(n: int) -> int:
+    """按经验值 4 * sqrt(n) 选择聚类中心数。"""
+    return max(1, int(4 * math.sqrt(n)))
+
+
+def normalize_kind(kind: str, codec: str = "float32") -> Tuple[str, str]:
+    """IVF 加 PQ 编码就是 IVF-PQ：统一成 (ivf_pq, pq)，避免同一种索引有两种写法。"""
+    if kind not in INDEX_KINDS:
+        raise ValueError(f"未知索引类型 {kind}，可选：{', '.join(INDEX_KINDS)}")
+    if codec not in CODECS:
+        raise ValueError(f"未知向量编码 {codec}，可选：{', '.join(CODECS)}")
+    if codec == "binary" and kind != "flat":
+        raise ValueError("binary 编码只支持 flat 索引（汉明距离暴力扫描）")
+    if kind == "ivf_pq" or (kind == "ivf_flat" and codec == "pq"):
+        return "ivf_pq", "pq"
+    return kind, codec
+
+
+def min_train_size(kind: str, codec: str = "float32") -> int:
+    """目标索引可以开始训练所需的最少向量数；0 表示无需训练。"""
+    kind, codec = normalize_kind(kind, codec)
+    size = 0
+    if kind.startswith("ivf"):
+        # n >= 39 * 4 * sqrt(n)  =>  n >= (39 * 4)^2
+        size = (MIN_POINTS_PER_CENTROID * 4) ** 2
+    if codec == "pq":
+        # PQ 的每个码本有 2^nbits 个中心，同样需要足够的训练样本
+        size = max(size, MIN_POINTS_PER_CENTROID * (1 << PQ_NBITS))
+    elif codec == "sq8":
+        size = max(size, SQ_TRAIN_SIZE)
+    return size
+
+
+class SignBitIndex:
+    """符号位编码的索引：每维取 x > 0 记 1，压成 d / 8 字节，存入 IndexBinaryIDMap2 按汉明距离检索。
+
+    对外提供与 faiss.Index 相同的 d / ntotal / add_with_ids / search / remove_ids，
+    search 的 params 同样接受按外部 ID 过滤的选择器。返回的距离是汉明距离（不能与 L2 比较），
+    只适合作为第一阶段粗筛，再由 rerank_exact 用原始向量精确打分。
+    """
+
+    is_trained = True
+
+    def __init__(self, index: faiss.IndexBinary):
+        self.index = index
+        self.d = index.d
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @staticmethod
+    def encode(x: np.ndarray) -> np.ndarray:
+        return np.packbits(np.asarray(x) > 0, axis=1, bitorder="little")
+
+    def add_with_ids(self, x: np.ndarray, ids: np.ndarray) -> None:
+        self.index.add_with_ids(self.encode(x), ids)
+
+    def search(self, x: np.ndarray, k: int,
+               params: Optional[faiss.SearchParameters] = None) -> Tuple[np.ndarray, np.ndarray]:
+        D, I = self.index.search(self.encode(x), k, params=params)
+        return D.astype("float32"), I
+
+    def remove_ids(self, sel: faiss.IDSelector) -> int:
+        return self.index.remove_ids(sel)
+
+
+def write_index(index: faiss.Index, path: str) -> None:
+    """faiss.write_index，SignBitIndex 以二进制索引格式写出。"""
+    if isinstance(index, SignBitIndex):
+        faiss.write_index_binary(index.index, path)
+    else:
+        faiss.write_index(index, path)
+
+
+def read_index(path: str, flags: int = 0) -> faiss.Index:
+    """faiss.read_index，按文件头识别二进制索引（"IB" 开头）并包装成 SignBitIndex。"""
+    with open(path, "rb") as f:
+        binary = f.read(2) == b"IB"
+    if binary:
+        return SignBitIndex(faiss.read_index_binary(path, flags))
+    return faiss.read_index(path, flags)
+
+
+def serialize_index(index: faiss.Index) -> np.ndarray:
+    if isinstance(index, SignBitIndex):
+        return faiss.serialize_index_binary(index.index)
+    return faiss.serialize_index(index)
+
+
+def clone_index(index: faiss.Index) -> faiss.Index:
+    """faiss.clone_index；IndexBinaryIDMap2 不支持 clone，经序列化复制。"""
+    if isinstance(index, SignBitIndex):
+        return SignBitIndex(faiss.deserialize_index_binary(serialize_index(index)))
+    return faiss.clone_index(index)
+
+
+def make_index(kind: str, dim: int, nlist: int = 1, codec: str = "float32") -> faiss.Index:
+    """创建一个空索引（IVF 类与 sq8 / pq 编码尚未训练）。"""
+    kind, codec = normalize_kind(kind, codec)
+    if codec == "binary":
+        if dim % 8:
+            raise ValueError(f"binary 编码要求向量维度是 8 的倍数，当前 {dim}")
+        return SignBitIndex(faiss.IndexBinaryIDMap2(faiss.IndexBinaryFlat(dim)))
+    # PQ 子空间数必须整除向量维度
+    pq_m = math.gcd(dim, PQ_M)
+    qtype = {"fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}.get(codec)
+    if kind == "flat":
+        if codec == "pq":
+            # IndexPQ 不支持 IDSelector（删除过滤），用单聚类的 IVF-PQ 代替，效果等同于暴力扫描 PQ 码
+            return faiss.index_factory(dim, f"IVF1,PQ{pq_m}x{PQ_NBITS}")
+        if qtype is not None:
+            return faiss.IndexIDMap2(faiss.IndexScalarQuantizer(dim, qtype))
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+    if kind == "hnsw":
+        if codec == "pq":
+            return faiss.IndexIDMap2(faiss.IndexHNSWPQ(dim, pq_m, HNSW_M, PQ_NBITS))
+        if qtype is not None:
+            return faiss.IndexIDMap2(faiss.IndexHNSWSQ(dim, qtype, HNSW_M))
+        return faiss.IndexIDMap2(faiss.IndexHNSWFlat(dim, HNSW_M))
+    if kind == "ivf_pq":
+        return faiss.index_factory(dim, f"IVF{nlist},PQ{pq_m}x{PQ_NBITS}")
+    storage = {"float32": "Flat", "fp16": "SQfp16", "sq8": "SQ8"}[codec]
+    return faiss.index_factory(dim, f"IVF{nlist},{storage}")
+
+
+def build_index(kind: str, vectors: np.ndarray, ids: np.ndarray,
+                codec: str = "float32", seed: int = 1234) -> faiss.Index:
+    """用 vectors 训练（采样）并以 ids 为外部 ID 填充一个 kind 类型、codec 编码的新索引。
+
+    vectors 按 ADD_BATCH 分段读取与加入，可以是内存映射的大文件。
+    """
+    n, dim = vectors.shape
+    nlist = choose_nlist(n)
+    index = make_index(kind, dim, nlist, codec)
+    if not index.is_trained:
+        # 非 IVF 索引只有码本需要训练，采样数按 PQ 码本中心数计
+        max_sample = max(nlist if kind.startswith("ivf") else 1, 1 << PQ_NBITS) * MAX_POINTS_PER_CENTROID
+        sample = vectors
+        if n > max_sample:
+            rng = np.random.default_rng(seed)
+            sample = vectors[np.sort(rng.choice(n, max_sample, replace=False))]
+        index.train(np.ascontiguousarray(sample, dtype="float32"))
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = min(DEFAULT_NPROBE, index.nlist)
+    for start in range(0, n, ADD_BATCH):
+        index.add_with_ids(np.ascontiguousarray(vectors[start:start + ADD_BATCH], dtype="float32"),
+                           np.ascontiguousarray(ids[start:start + ADD_BATCH], dtype=np.int64))
+    return index
+
+
+def unwrap(index: faiss.Index) -> faiss.Index:
+    """去掉 IndexIDMap 外壳，返回实际执行检索的索引。"""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def export_vectors(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """导出 IndexIDMap 中的全部 (外部 ID, 原始向量)，用于迁移或重建索引。"""
+    ids = faiss.vector_to_array(index.id_map)
+    return ids, unwrap(index).reconstruct_n(0, index.ntotal)
+
+
+def index_kind(index: faiss.Index) -> str:
+    index = unwrap(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF) and index.nlist > 1:
+        return "ivf_pq" if isinstance(index, faiss.IndexIVFPQ) else "ivf_flat"
+    return "flat"
+
+
+def index_codec(index: faiss.Index) -> str:
+    """索引内向量的存储编码，见 CODECS。"""
+    index = unwrap(index)
+    if isinstance(index, SignBitIndex):
+        return "binary"
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "float32"
+
+
+def index_bytes(index: faiss.Index) -> int:
+    """索引在内存中的大致字节数：向量编码、外部 ID 表与 HNSW 的邻接表（不含码本、聚类中心等固定开销）。"""
+    n = index.ntotal
+    if isinstance(index, SignBitIndex):
+        return n * (index.d // 8 + ID_MAP2_BYTES)
+    size = n * (ID_MAP2_BYTES if isinstance(index, faiss.IndexIDMap2) else 8) \
+        if isinstance(index, faiss.IndexIDMap) else 0
+    inner = unwrap(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        hnsw = inner.hnsw
+        size += hnsw.neighbors.size() * 4 + hnsw.levels.size() * 4 + hnsw.offsets.size() * 8
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, faiss.IndexIVF):
+        # 倒排表中每个向量另存一个 8 字节的 ID
+        return size + n * (inner.code_size + 8)
+    return size + n * inner.code_size
+
+
+def rerank_exact(queries: np.ndarray, cand_ids: np.ndarray, cand_vectors: np.ndarray,
+                 top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """用原始向量对候选重新计算精确 L2 距离并取前 top_k。
+
+    Args:
+        queries: (nq, d) 查询向量
+        cand_ids: (nq, c) 候选外部 ID，-1 表示空位
+        cand_vectors: (nq, c, d) 候选的原始 float32 向量（空位内容任意）
+        top_k: 每个查询保留的结果数
+    """
+    diff = cand_vectors - queries[:, None, :]
+    D = np.einsum("qcd,qcd->qc", diff, diff)
+    D[cand_ids < 0] = np.inf
+    order = np.argsort(D, axis=1, kind="stable")[:, :top_k]
+    D = np.take_along_axis(D, order, axis=1)
+    I = np.take_along_axis(cand_ids, order, axis=1)
+    I[np.isinf(D)] = -1
+    # 与 FAISS 保持一致：空位的距离为最大浮点数
+    D[np.isinf(D)] = np.finfo("float32").max
+    return D.astype("float32"), I
+
+
+def reconstruct(index: faiss.Index, ids: np.ndarray) -> np.ndarray:
+    """按外部 ID 从索引中还原向量（有损编码时为解码后的近似值）。
+
+    IndexIDMap2 自带反查表；IVF 类索引第一次调用时建立哈希形式的 direct map，之后随增删自动维护。
+    """
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    if not isinstance(index, faiss.IndexIDMap2):
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index.reconstruct_batch(ids)
+
+
+_EXCLUDED = np.float32(1e30)
+
+
+def mmr_select(relevance: np.ndarray, cand_ids: np.ndarray, cand_vectors: np.ndarray,
+               top_k: int, lam: float) -> np.ndarray:
+    """最大边际相关性（MMR）重排，所有查询一起做矩阵运算，只在 top_k 上循环。
+
+    每一步选出 lam * 相关性 - (1 - lam) * 与已选结果的最大余弦相似度 最大的候选。
+
+    Args:
+        relevance: (nq, c) 候选与查询的相关性，越大越相关
+        cand_ids: (nq, c) 候选外部 ID，-1 表示空位
+        cand_vectors: (nq, c, d) 候选向量
+        top_k: 每个查询保留的结果数
+        lam: 相关性的权重，1 表示不考虑多样性，0 表示只考虑多样性
+    Returns:
+        (nq, top_k) 被选中候选在 c 维上的下标，按选中顺序排列，不足时为 -1
+    """
+    nq, c = cand_ids.shape
+    # 先算内积矩阵，再用对角线（各向量的模长平方）归一化成余弦相似度，省去归一化整批向量
+    sims = np.matmul(cand_vectors, cand_vectors.transpose(0, 2, 1))
+    norms = np.sqrt(np.maximum(np.einsum("qcc->qc", sims), 1e-24))
+    sims /= norms[:, :, None] * norms[:, None, :]
+    # 已选中或无效的候选用一个很大的有限值排除（用 inf 在 lam = 0 / 1 时会得到 nan）
+    rel = np.where(cand_ids >= 0, relevance * lam, -_EXCLUDED).astype(np.float32)
+    penalty = np.zeros((nq, c), dtype=np.float32)
+    order = np.full((nq, top_k), -1, dtype=np.int64)
+    rows = np.arange(nq)
+    for t in range(min(top_k, c)):
+        score = rel - penalty
+        best = score.argmax(axis=1)
+        order[:, t] = np.where(score[rows, best] > -_EXCLUDED / 4, best, -1)
+        np.maximum(penalty, (1 - lam) * sims[rows, best], out=penalty)
+        rel[rows, best] = -_EXCLUDED
+    return order
+
+
+def search_params(index: faiss.Index, nprobe: int = 0, ef_search: int = 0,
+                  sel: Optional[faiss.IDSelector] = None) -> Optional[faiss.SearchParameters]:
+    """为单次查询构造搜索参数。
+
+    nprobe / ef_search 为 0 或与索引类型不符时使用索引默认值；sel 为按外部 ID 过滤的选择器。
+    没有任何需要覆盖的参数时返回 None。
+    """
+    inner = unwrap(index)
+    if isinstance(inner, faiss.IndexIVF) and (nprobe > 0 or sel is not None):
+        # IVF 只接受 SearchParametersIVF，未指定 nprobe 时沿用索引自身的设置
+        return faiss.SearchParametersIVF(nprobe=nprobe or inner.nprobe, sel=sel)
+    if ef_search > 0 and isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search, sel=sel)
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
@@ -0,0 +1,180 @@
+"""后台入库队列。
+
+大批量 index_docs 要等全部片段嵌入完才返回，客户端既看不到进度，也容易因请求超时而断开。
+IngestQueue 把每次入库变成一个任务：
+    - submit 立即返回任务，任务进入有界队列，队列满时直接拒绝，不让请求挂起；
+      put 则等到队列有空位（同步入库用）；
+    - 一个后台协程按提交顺序逐个执行任务，入库函数每处理完一批就调用 job.advance 更新进度；
+    - watch 在任务有进展时回调（用于发送 MCP 进度通知），直到任务结束或超时；
+    - 最近结束的 keep 个任务保留状态，供 job_status 查询。
+任务只保存在内存中，服务重启后丢失（已经入库并保存的片段不受影响）。
+"""
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+
+class QueueFull(Exception):
+    """入库队列已满。"""
+
+
+class Job:
+    """一次入库任务。done / total 为已处理 / 全部片段数，total 在切块去重之后才确定。"""
+
+    def __init__(self, fn: Callable[["Job"], Awaitable[str]], description: str = ""):
+        self.id = uuid.uuid4().hex[:12]
+        self.description = description
+        self.status = "queued"
+        self.done = 0
+        self.total: Optional[int] = None
+        self.result: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._fn: Optional[Callable[["Job"], Awaitable[str]]] = fn
+        self._changed = asyncio.Event()
+        self._ended = asyncio.Event()
+
+    @property
+    def ended(self) -> bool:
+        return self._ended.is_set()
+
+    def advance(self, done: int, total: Optional[int] = None) -> None:
+        """入库函数报告进度：已处理 done 个片段（total 为全部片段数，可选）。"""
+        self.done = done
+        if total is not None:
+            self.total = total
+        self._touch()
+
+    def _touch(self) -> None:
+        # 唤醒当前的等待者，后来的等待者等下一次变化
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def changed(self, timeout: Optional[float]) -> bool:
+        """等到任务有新进展（或结束），超时返回 False。"""
+        if self.ended:
+            return True
+        event = self._changed
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def join(self) -> None:
+        await self._ended.wait()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "description": self.description,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "result": self.result,
+            "error": f"{type(self.error).__name__}: {self.error}" if self.error else None,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class IngestQueue:
+    """按提交顺序逐个执行入库任务的有界队列。
+
+    Args:
+        max_pending: 最多排队（尚未开始）的任务数
+        keep: 最多保留多少个已结束任务的状态
+    """
+
+    def __init__(self, max_pending: int = 16, keep: int = 100):
+        self.max_pending = max(1, max_pending)
+        self.keep = keep
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # 事件循环启动后才创建，见 _ensure_worker
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def _ensure_worker(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_pending)
+            self._worker = asyncio.ensure_future(self._run())
+        return self._queue
+
+    def submit(self, fn: Callable[[Job], Awaitable[str]], description: str = "") -> Job:
+        """提交任务并立即返回；队列已满时抛出 QueueFull。"""
+        job = Job(fn, description)
+        try:
+            self._ensure_worker().put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFull(f"入库队列已满（{self.max_pending} 个任务等待中），请稍后重试") from None
+        self._register(job)
+        return job
+
+    async def put(self, fn: Callable[[Job], Awaitable[str]], description: str = "") -> Job:
+        """提交任务，队列已满时等待空位。"""
+        job = Job(fn, description)
+        self._register(job)
+        await self._ensure_worker().put(job)
+        return job
+
+    def _register(self, job: Job) -> None:
+        self._jobs[job.id] = job
+        ended = [job_id for job_id, j in self._jobs.items() if j.ended]
+        for job_id in ended[:max(0, len(ended) - self.keep)]:
+            del self._jobs[job_id]
+
+    async def _run(self) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status, job.started = "running", time.time()
+            job._touch()
+            try:
+                job.result = await job._fn(job)
+                job.status = "done"
+            except Exception as e:
+                job.status, job.error = "failed", e
+            job.finished = time.time()
+            job._fn = None
+            job._ended.set()
+            job._touch()
+            self._queue.task_done()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> List[Job]:
+        return list(self._jobs.values())
+
+    def ahead_of(self, job: Job) -> int:
+        """排在 job 前面、尚未结束的任务数（含正在执行的）。"""
+        n = 0
+        for other in self._jobs.values():
+            if other is job:
+                return n
+            n += not other.ended
+        return n
+
+    async def watch(self, job: Job, on_progress: Callable[[Job], Awaitable[None]],
+                    timeout: Optional[float] = None) -> None:
+        """任务每有进展就调用 on_progress，直到任务结束或超过 timeout 秒（None 表示一直等）。"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not job.ended:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return
+            if await job.changed(remaining):
+                await on_progress(job)
+
+    def stats(self) -> Dict[str, int]:
+        counts = {state: 0 for state in JOB_STATES}
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return counts
@@ -0,0 +1,307 @@
+"""BM25 词法倒排索引与混合检索的结果融合。
+
+医学问答常常取决于精确的词：药名、"收缩压≥140" 这样的阈值，纯向量检索容易漏掉。
+这里维护一个与 FAISS 索引逐行对应的倒排索引：
+    - 中文按字切分，同时生成相邻两字的 bigram，不依赖分词器；
+    - 英文 / 数字按词切分，"≥140" 这类比较符加数字整体作为一个词，同时保留数字本身；
+    - 倒排表以 CSR 形式存放在紧凑的 numpy 数组中（int32 行号、uint16 词频），可内存映射加载；
+      新增文档先进入内存中的尾部倒排表，超过阈值后再合并进数组；
+    - 保存时只把新增文档的词频逐行追加到 lex_log.jsonl，打开时重放进尾部倒排表，
+      数组只在合并之后才整体重写。
+分词（analyze）与合并（merged）都不修改索引本身，可以在检索进行时完成，
+RagStore 只在追加词频（add_counts）与换上合并结果时独占索引。
+检索时只访问查询词的倒排表，用 numpy 批量计算 BM25 分数。
+"""
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+TERMS_FILE = "lex_terms.json"
+OFFSETS_FILE = "lex_offsets.npy"
+ROWS_FILE = "lex_rows.npy"
+TF_FILE = "lex_tf.npy"
+LENGTHS_FILE = "lex_lengths.npy"
+LOG_FILE = "lex_log.jsonl"
+FILES = (TERMS_FILE, OFFSETS_FILE, ROWS_FILE, TF_FILE, LENGTHS_FILE, LOG_FILE)
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 倒数排名融合（RRF）的平滑常数
+RRF_K = 60
+# 尾部倒排表累计的词条数超过该值后合并进数组
+MERGE_AT = 1 << 20
+
+FUSIONS = ("rrf", "weighted")
+
+_CJK = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN = re.compile(rf"[<>≤≥=]+ ?\d+(?:\.\d+)?|[a-z0-9]+(?:\.\d+)*|[{_CJK}]+")
+_COMPARATORS = "<>≤≥= "
+
+
+def tokenize(text: str) -> Iterator[str]:
+    """切出检索词：中文单字 + 相邻两字，英文 / 数字按词，比较符与数字组合成一个词。"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    for m in _TOKEN.finditer(text):
+        tok = m.group()
+        if tok[0] in _COMPARATORS:
+            yield tok.replace(" ", "")
+            yield tok.lstrip(_COMPARATORS)
+        elif "a" <= tok[0] <= "z" or "0" <= tok[0] <= "9":
+            yield tok
+        else:
+            yield from tok
+            yield from (tok[i:i + 2] for i in range(len(tok) - 1))
+
+
+class LexicalIndex:
+    """按行号组织的 BM25 倒排索引，行号与 RagStore 的文档行一一对应。"""
+
+    def __init__(self, terms: Optional[List[str]] = None, offsets: Optional[np.ndarray] = None,
+                 rows: Optional[np.ndarray] = None, tfs: Optional[np.ndarray] = None,
+                 lengths: Optional[np.ndarray] = None, path: Optional[str] = None):
+        self._terms: List[str] = terms or []
+        self._vocab: Dict[str, int] = {t: i for i, t in enumerate(self._terms)}
+        self._offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self._rows = rows if rows is not None else np.zeros(0, dtype=np.int32)
+        self._tfs = tfs if tfs is not None else np.zeros(0, dtype=np.uint16)
+        # 每行文档的词数，用于 BM25 的长度归一化
+        self._lengths = np.array(lengths if lengths is not None else [], dtype=np.int32)
+        self._total_len = int(self._lengths.sum())
+        # 尾部倒排表：词 -> ([行号], [词频])
+        self._tail: Dict[str, Tuple[List[int], List[int]]] = {}
+        self._tail_size = 0
+        # 数组映射自的目录，与其中 lex_log.jsonl 已提交的字节数；之后新增文档的词频行暂存在 _unsaved
+        self._path = path
+        self.log_size = 0
+        self._unsaved = bytearray()
+
+    @classmethod
+    def load(cls, path: str, log_size: Optional[int] = None) -> "LexicalIndex":
+        """打开 path 目录下的索引并重放日志；log_size 为已提交的日志字节数，之后的内容被忽略。"""
+        with open(os.path.join(path, TERMS_FILE), encoding="utf-8") as f:
+            terms = json.load(f)
+
+        def arr(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        index = cls(terms, arr(OFFSETS_FILE), arr(ROWS_FILE), arr(TF_FILE), arr(LENGTHS_FILE), path)
+        log = os.path.join(path, LOG_FILE)
+        if os.path.exists(log):
+            with open(log, "rb") as f:
+                data = f.read() if log_size is None else f.read(log_size)
+            index._append_rows(Counter(json.loads(line)) for line in data.splitlines())
+            index.log_size = len(data)
+        return index
+
+    @classmethod
+    def build(cls, texts: Iterable[str]) -> "LexicalIndex":
+        index = cls()
+        index.add(texts)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    @staticmethod
+    def analyze(texts: Iterable[str]) -> List[Counter]:
+        """每篇文档的词频，供 add_counts 使用。"""
+        return [Counter(tokenize(text)) for text in texts]
+
+    def add(self, texts: Iterable[str]) -> None:
+        """按顺序追加文档，行号紧接在已有文档之后；尾部倒排表过大时合并进数组。"""
+        self.add_counts(self.analyze(texts))
+        if self.needs_merge():
+            self._merge()
+
+    def needs_merge(self) -> bool:
+        return self._tail_size > MERGE_AT
+
+    def nbytes(self) -> int:
+        """常驻内存的大致字节数：未映射的数组与尾部倒排表（每项按行号、词频两个列表槽位计）。"""
+        arrays = (self._offsets, self._rows, self._tfs, self._lengths)
+        return (sum(a.nbytes for a in arrays if not isinstance(a, np.memmap)) + 16 * self._tail_size
+                + len(self._unsaved))
+
+    def add_counts(self, doc_counts: Iterable[Counter]) -> None:
+        """按顺序追加已分词文档（analyze 的结果），只写入尾部倒排表与待保存的日志行。"""
+        doc_counts = list(doc_counts)
+        for counts in doc_counts:
+            self._unsaved += json.dumps(counts, ensure_ascii=False).encode("utf-8") + b"\n"
+        self._append_rows(doc_counts)
+
+    def _append_rows(self, doc_counts: Iterable[Counter]) -> None:
+        row = len(self._lengths)
+        lengths = []
+        for counts in doc_counts:
+            for term, tf in counts.items():
+                rows, tfs = self._tail.setdefault(term, ([], []))
+                rows.append(row)
+                tfs.append(min(tf, 0xFFFF))
+            self._tail_size += len(counts)
+            lengths.append(sum(counts.values()))
+            row += 1
+        self._lengths = np.concatenate([self._lengths, np.asarray(lengths, dtype=np.int32)])
+        self._total_len += sum(lengths)
+
+    def _merge(self) -> None:
+        merged = self.merged()
+        self._terms, self._vocab = merged._terms, merged._vocab
+        self._offsets, self._rows, self._tfs = merged._offsets, merged._rows, merged._tfs
+        self._tail, self._tail_size = {}, 0
+
+    def merged(self) -> "LexicalIndex":
+        """尾部倒排表合并进 CSR 数组后的新索引（不修改自身）。
+
+        每个词的新行号都大于已有行号，直接追加在该词末尾。
+        """
+        if not self._tail:
+            return self
+        terms = list(self._terms)
+        vocab = dict(self._vocab)
+        for term in self._tail:
+            if term not in vocab:
+                vocab[term] = len(terms)
+                terms.append(term)
+        n_terms = len(terms)
+        base_counts = np.zeros(n_terms, dtype=np.int64)
+        base_counts[:len(self._offsets) - 1] = np.diff(self._offsets)
+        tail_counts = np.zeros(n_terms, dtype=np.int64)
+        for term, (rows, _) in self._tail.items():
+            tail_counts[vocab[term]] = len(rows)
+        offsets = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(base_counts + tail_counts, out=offsets[1:])
+
+        new_rows = np.empty(offsets[-1], dtype=np.int32)
+        new_tfs = np.empty(offsets[-1], dtype=np.uint16)
+        # 已有词条整体平移到新位置
+        tid = np.repeat(np.arange(len(self._offsets) - 1), np.diff(self._offsets))
+        pos = offsets[tid] + np.arange(len(tid)) - self._offsets[tid]
+        new_rows[pos] = self._rows
+        new_tfs[pos] = self._tfs
+        for term, (rows, tfs) in self._tail.items():
+            t = vocab[term]
+            start = offsets[t] + base_counts[t]
+            new_rows[start:start + len(rows)] = rows
+            new_tfs[start:start + len(rows)] = tfs
+        return LexicalIndex(terms, offsets, new_rows, new_tfs, self._lengths)
+
+    def _postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        rows, tfs = [], []
+        t = self._vocab.get(term)
+        if t is not None:
+            start, end = self._offsets[t], self._offsets[t + 1]
+            rows.append(self._rows[start:end])
+            tfs.append(self._tfs[start:end])
+        if term in self._tail:
+            tail_rows, tail_tfs = self._tail[term]
+            rows.append(np.asarray(tail_rows, dtype=np.int32))
+            tfs.append(np.asarray(tail_tfs, dtype=np.uint16))
+        if not rows:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16)
+        return np.concatenate(rows), np.concatenate(tfs)
+
+    def search(self, query: str, top_k: int,
+               mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 检索，返回按分数降序的 (分数, 行号)，最多 top_k 个；mask 为按行的布尔掩码，只返回为 True 的行。"""
+        n = len(self._lengths)
+        empty = np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        if n == 0 or top_k <= 0:
+            return empty
+        avgdl = self._total_len / n or 1.0
+        all_rows, all_scores = [], []
+        for term in set(tokenize(query)):
+            rows, tfs = self._postings(term)
+            if not len(rows):
+                continue
+            df = len(rows)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            tf = tfs.astype(np.float32)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[rows] / avgdl)
+            all_rows.append(rows)
+            all_scores.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        if not all_rows:
+            return empty
+        rows, inverse = np.unique(np.concatenate(all_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores)).astype(np.float32)
+        if mask is not None:
+            keep = mask[rows]
+            rows, scores = rows[keep], scores[keep]
+        if len(rows) > top_k:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return scores[order], rows[order].astype(np.int64)
+
+    def take(self, keep: np.ndarray) -> "LexicalIndex":
+        """只保留 keep 为 True 的行（压缩用），行号重新连续编号，不再出现的词被移除。"""
+        src = self.merged()
+        remap = np.cumsum(keep) - 1
+        tid = np.repeat(np.arange(len(src._terms)), np.diff(src._offsets))
+        mask = keep[src._rows]
+        tid, rows, tfs = tid[mask], remap[src._rows[mask]].astype(np.int32), src._tfs[mask]
+        counts = np.bincount(tid, minlength=len(src._terms))
+        used = np.flatnonzero(counts)
+        offsets = np.zeros(len(used) + 1, dtype=np.int64)
+        np.cumsum(counts[used], out=offsets[1:])
+        terms = [src._terms[t] for t in used.tolist()]
+        return LexicalIndex(terms, offsets, rows, tfs, np.asarray(src._lengths)[keep])
+
+    def write(self, path: str) -> List[str]:
+        """保存到 path 目录，返回以临时文件写出、需要由调用方替换的文件名。
+
+        数组就映射自 path 时只把新增文档的词频行追加到 lex_log.jsonl（先截掉上次保存失败时留下的未提交字节，
+        调用方在版本头中记下 log_size 才算提交）；否则把合并尾部后的数组整体写到临时文件，日志清空。
+        """
+        log = os.path.join(path, LOG_FILE)
+        if self._path == path and os.path.exists(log):
+            with open(log, "r+b") as f:
+                f.truncate(self.log_size)
+                f.seek(self.log_size)
+                f.write(self._unsaved)
+            self.log_size += len(self._unsaved)
+            self._unsaved = bytearray()
+            return []
+        src = self.merged()
+        with open(os.path.join(path, TERMS_FILE + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump(src._terms, f, ensure_ascii=False)
+        for name, arr in ((OFFSETS_FILE, src._offsets), (ROWS_FILE, src._rows),
+                          (TF_FILE, src._tfs), (LENGTHS_FILE, src._lengths)):
+            with open(os.path.join(path, name + ".tmp"), "wb") as f:
+                np.save(f, arr)
+        open(log + ".tmp", "wb").close()
+        return list(FILES)
+
+
+def fuse(vec_ids: np.ndarray, vec_dist: np.ndarray, lex_ids: np.ndarray, lex_scores: np.ndarray,
+         top_k: int, method: str = "rrf", alpha: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
+    """融合一条查询的向量结果（L2 距离升序）与 BM25 结果（分数降序），返回 (融合分数, ID)。
+
+    Args:
+        method: "rrf" 按倒数排名融合，与分数尺度无关；"weighted" 把两路分数各自归一化到 [0, 1] 后加权
+        alpha: weighted 模式下向量分数的权重，BM25 的权重为 1 - alpha
+    """
+    if method not in FUSIONS:
+        raise ValueError(f"未知融合方式 {method}，可选：{', '.join(FUSIONS)}")
+    valid = vec_ids >= 0
+    vec_ids, vec_dist = vec_ids[valid], vec_dist[valid]
+    if method == "rrf":
+        vec_part = 1.0 / (RRF_K + 1 + np.arange(len(vec_ids)))
+        lex_part = 1.0 / (RRF_K + 1 + np.arange(len(lex_ids)))
+    else:
+        def minmax(x: np.ndarray) -> np.ndarray:
+            span = x.max() - x.min() if len(x) else 0.0
+            return (x - x.min()) / span if span > 0 else np.ones_like(x)
+
+        vec_part = alpha * minmax(-vec_dist.astype(np.float64))
+        lex_part = (1 - alpha) * minmax(lex_scores.astype(np.float64))
+    ids, inverse = np.unique(np.concatenate([vec_ids, lex_ids]), return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate([vec_part, lex_part]))
+    order = np.lexsort((ids, -scores))[:top_k]
+    return scores[order].astype(np.float32), ids[order]
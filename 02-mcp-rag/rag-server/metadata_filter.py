@@ -0,0 +1,100 @@
+"""检索过滤表达式：把 JSON 形式的元数据条件编译为按行的布尔掩码。
+
+表达式是一个 JSON 对象，各个键之间是"且"的关系：
+    {"source": "糖尿病.txt"}                     来源等于其中之一（字符串或列表）
+    {"source_prefix": "guidelines/"}             来源以其中之一开头
+    {"tags": ["心内科", "指南"]}                  含任一标签
+    {"tags_all": ["心内科", "指南"]}              含全部标签
+    {"after": "2024-01-01", "before": 1735689600} 时间范围 [after, before)，ISO 日期或 Unix 秒
+    {"or": [{...}, {...}]} / {"not": {...}}       组合
+掩码按列向量化计算，RagStore 再把它转换成 FAISS 的 IDSelectorBitmap，
+在索引内部过滤，过滤查询与普通查询的开销基本相同。
+"""
+import datetime
+import re
+from typing import Any, Dict, List, Sequence, Union
+
+import numpy as np
+
+FILTER_KEYS = ("source", "source_prefix", "tags", "tags_all", "after", "before", "or", "not")
+# ISO 基本格式的日期，例如 "20240101"（Python 3.11 之前的 fromisoformat 不接受）
+_BASIC_DATE = re.compile(r"^\d{8}$")
+# 字符串形式的 Unix 秒，例如 "1700000000"
+_UNIX_SECONDS = re.compile(r"^\s*-?\d+(\.\d*)?\s*$")
+
+
+class FilterError(ValueError):
+    """过滤表达式不合法。"""
+
+
+def parse_time(value: Union[str, int, float]) -> int:
+    """ISO 8601 日期 / 时间（无时区时按本地时间）或 Unix 秒（数字或数字字符串）-> Unix 秒。
+
+    8 位数字总是按 ISO 基本格式的日期解析（"20240101" 是 2024-01-01，不同 Python 版本结果一致），
+    其余数字字符串按 Unix 秒解析。
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str):
+        text = value.strip()
+        try:
+            if _BASIC_DATE.match(text):
+                return int(datetime.datetime.strptime(text, "%Y%m%d").timestamp())
+            return int(datetime.datetime.fromisoformat(text).timestamp())
+        except ValueError:
+            if _UNIX_SECONDS.match(text) and not _BASIC_DATE.match(text):
+                return int(float(text))
+    raise FilterError(f"无法解析的时间：{value!r}，请使用 ISO 日期（如 2024-01-01）或 Unix 秒")
+
+
+def _as_list(value: Any) -> List[str]:
+    values = value if isinstance(value, list) else [value]
+    if not all(isinstance(v, str) for v in values):
+        raise FilterError(f"期望字符串或字符串列表：{value!r}")
+    return values
+
+
+def compile_filter(spec: Dict[str, Any], sources: Sequence[str], source_col: np.ndarray,
+                   tags, timestamps: np.ndarray) -> np.ndarray:
+    """计算满足 spec 的行。
+
+    Args:
+        spec: 过滤表达式
+        sources: 来源名称列表，source_col 中的来源编号即其下标
+        source_col: 每行的来源编号（-1 表示未知）
+        tags: 提供 rows_with(names, require_all) 的标签表（rag_store.TagTable）
+        timestamps: 每行的时间戳（Unix 秒，0 表示未知）
+    """
+    if not isinstance(spec, dict):
+        raise FilterError(f"过滤表达式必须是 JSON 对象：{spec!r}")
+    unknown = set(spec) - set(FILTER_KEYS)
+    if unknown:
+        raise FilterError(f"未知的过滤条件 {', '.join(sorted(unknown))}，可选：{', '.join(FILTER_KEYS)}")
+
+    mask = np.ones(len(source_col), dtype=bool)
+    if "source" in spec:
+        wanted = set(_as_list(spec["source"]))
+        ids = [i for i, name in enumerate(sources) if name in wanted]
+        mask &= np.isin(source_col, ids)
+    if "source_prefix" in spec:
+        prefixes = tuple(_as_list(spec["source_prefix"]))
+        ids = [i for i, name in enumerate(sources) if name.startswith(prefixes)]
+        mask &= np.isin(source_col, ids)
+    if "tags" in spec:
+        mask &= tags.rows_with(_as_list(spec["tags"]), require_all=False)
+    if "tags_all" in spec:
+        mask &= tags.rows_with(_as_list(spec["tags_all"]), require_all=True)
+    if "after" in spec:
+        mask &= timestamps >= parse_time(spec["after"])
+    if "before" in spec:
+        mask &= timestamps < parse_time(spec["before"])
+    if "or" in spec:
+        if not isinstance(spec["or"], list) or not spec["or"]:
+            raise FilterError("or 的值必须是非空的表达式列表")
+        any_mask = np.zeros(len(source_col), dtype=bool)
+        for sub in spec["or"]:
+            any_mask |= compile_filter(sub, sources, source_col, tags, timestamps)
+        mask &= any_mask
+    if "not" in spec:
+        mask &= ~compile_filter(spec["not"], sources, source_col, tags, timestamps)
+    return mask
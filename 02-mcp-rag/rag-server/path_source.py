@@ -0,0 +1,109 @@
+"""由服务端直接从磁盘读取待入库的文件（index_path 工具）。
+
+index_docs 要求客户端把全文放进一次 JSON-RPC 请求：客户端先读出资源，再把同样的字节发回同一个服务端，
+stdio 上每个字节走两遍，两端还要各拼出一条巨大的 JSON 消息。index_path 只传路径：
+    - resolve_paths 把 file:// URI、文件、目录（递归收录文本文件）与 glob 模式（支持 **）展开为文件列表，
+      去重后按路径排序；只接受 roots 之下的路径，避免借工具读取服务端机器上的任意文件；
+    - read_file_chunks 用 chunking.chunk_file 流式读取并切块，片段的来源为文件的绝对路径、时间为修改时间；
+    - map_ordered 在线程中并行处理多个文件，最多 workers 个同时在途，按列表顺序逐个产出，
+      内存占用与 workers 成正比，与文件总量无关。
+"""
+import asyncio
+import fnmatch
+import glob
+import os
+from collections import deque
+from typing import AsyncIterator, Callable, Iterable, List, Optional, Sequence, Tuple, TypeVar
+from urllib.parse import unquote, urlparse
+
+from chunking import Chunk, chunk_file
+
+# 展开目录时收录的文件（显式给出的文件与 glob 匹配到的文件不受限制）
+TEXT_PATTERNS = ("*.txt", "*.md", "*.markdown", "*.rst", "*.csv", "*.json", "*.jsonl",
+                 "*.html", "*.htm", "*.xml", "*.log")
+# 一次最多展开的文件数，防止误传根目录之类的模式
+MAX_FILES = 100000
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def uri_to_path(uri: str) -> str:
+    """file:// URI 转为本地路径，普通路径原样返回；其他协议抛出 ValueError。"""
+    parsed = urlparse(uri)
+    if parsed.scheme == "file":
+        return unquote(parsed.path)
+    if parsed.scheme and len(parsed.scheme) > 1:  # 单个字母是 Windows 盘符
+        raise ValueError(f"只支持本地文件（file://）：{uri}")
+    return uri
+
+
+def _within(path: str, roots: Sequence[str]) -> bool:
+    return any(os.path.commonpath([path, root]) == root for root in roots)
+
+
+def _walk(directory: str) -> Iterable[str]:
+    for parent, dirs, names in os.walk(directory):
+        # 跳过 .git 之类的隐藏目录与隐藏文件
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in names:
+            if not name.startswith(".") and any(fnmatch.fnmatch(name, p) for p in TEXT_PATTERNS):
+                yield os.path.join(parent, name)
+
+
+def resolve_paths(patterns: Sequence[str], roots: Sequence[str]) -> List[str]:
+    """展开路径、目录、file:// URI 与 glob 模式，返回去重排序后的文件绝对路径（已解析符号链接）。
+
+    Args:
+        patterns: 待展开的路径列表，相对路径相对于 roots[0]
+        roots: 允许读取的目录，展开结果不在其中任何一个之下时抛出 ValueError
+    """
+    roots = [os.path.realpath(root) for root in roots]
+    if not roots:
+        raise ValueError("服务端没有配置允许读取的目录")
+    found = set()
+    for pattern in patterns:
+        path = os.path.join(roots[0], os.path.expanduser(uri_to_path(pattern)))
+        matches = glob.glob(path, recursive=True) if glob.has_magic(path) else [path]
+        for match in matches:
+            for file in (_walk(match) if os.path.isdir(match) else [match]):
+                real = os.path.realpath(file)
+                if not _within(real, roots):
+                    raise ValueError(f"{pattern} 不在允许读取的目录（{os.pathsep.join(roots)}）之下")
+                if os.path.isfile(real):
+                    found.add(real)
+            if len(found) > MAX_FILES:
+                raise ValueError(f"匹配到的文件超过 {MAX_FILES} 个，请缩小范围")
+    return sorted(found)
+
+
+def read_file_chunks(path: str, max_tokens: int = 400, overlap_tokens: int = 50,
+                     max_bytes: int = 0) -> Optional[List[Chunk]]:
+    """读取并切分一个文件（来源为 path，时间为修改时间）；超过 max_bytes、不是 UTF-8 文本或读取失败时返回 None。"""
+    try:
+        stat = os.stat(path)
+        if max_bytes and stat.st_size > max_bytes:
+            return None
+        return [c._replace(timestamp=int(stat.st_mtime))
+                for c in chunk_file(path, path, max_tokens, overlap_tokens)]
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+async def map_ordered(fn: Callable[[T], R], items: Iterable[T],
+                      workers: int = 8) -> AsyncIterator[Tuple[T, R]]:
+    """在线程中并行执行 fn(item)，最多 workers 个同时在途，按输入顺序逐个产出 (item, 结果)。"""
+    pending: deque = deque()
+    try:
+        for item in items:
+            pending.append((item, asyncio.ensure_future(asyncio.to_thread(fn, item))))
+            if len(pending) >= max(1, workers):
+                item, task = pending.popleft()
+                yield item, await task
+        while pending:
+            item, task = pending.popleft()
+            yield item, await task
+    finally:
+        # 出错或调用方提前退出时，取消尚未开始的读取
+        for _, task in pending:
+            task.cancel()
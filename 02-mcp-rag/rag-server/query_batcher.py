@@ -0,0 +1,240 @@
+"""retrieve_docs 查询合并（micro-batching）。
+
+并发查询各自发起一次单条嵌入请求、一次 1×d 的 FAISS 检索，开销主要花在往返上。
+QueryBatcher 把 window_ms 时间窗口内到达的查询（最多 max_batch 条）合并为
+一次嵌入请求 + 一次批量检索，再把结果分发回各个调用方。
+纯词法（lexical）查询不需要嵌入，只走 BM25 倒排索引。
+检索模式、搜索参数与元数据过滤条件都相同的查询共用一次检索。
+mmr_lambda < 1 时先多取 mmr_fetch 倍候选，再用 MMR 去掉内容相近的重复片段后截断到 top_k。
+调用方一次给出多条查询时（search_many）不等合并窗口，直接作为一批执行。
+检索放在线程中执行，不阻塞事件循环，也就不会被同时进行的入库拖住（并发安全由向量库的读写锁保证）。
+"""
+import asyncio
+import json
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from index_factory import mmr_select
+from lexical_index import FUSIONS
+from rag_store import check_top_k
+
+import numpy as np
+
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+
+
+def select_hits(D: np.ndarray, I: np.ndarray, mode: str, min_score: float = 0.0,
+                relative_score: float = 0.0) -> List[Tuple[int, float]]:
+    """把一条查询的检索结果转换为 [(外部 ID, 分数)]（分数越大越相关），并按阈值截断。
+
+    分数：vector 模式为余弦相似度（嵌入为单位向量时 = 1 - L2² / 2），lexical 为 BM25 分数，
+    hybrid 为融合分数。
+
+    Args:
+        min_score: 分数低于该值的结果被丢弃
+        relative_score: 0~1，分数低于最高分的该比例的结果被丢弃（自适应 top_k：强相关的结果少时只返回少数几个）
+    """
+    valid = I >= 0
+    scores = 1 - D[valid] / 2 if mode == "vector" else D[valid]
+    ids = I[valid]
+    if not len(ids):
+        return []
+    keep = scores >= min_score
+    if relative_score > 0:
+        best = scores.max()
+        # 最高分为负（例如余弦相似度）时按与最高分的差距比较
+        keep &= scores >= best - (1 - relative_score) * abs(best)
+    return [(int(i), float(s)) for i, s in zip(ids[keep], scores[keep])]
+
+
+class _Pending(NamedTuple):
+    query: str
+    top_k: int
+    nprobe: int
+    ef_search: int
+    mode: str
+    filters: Optional[Dict[str, Any]]
+    mmr_lambda: float
+    fut: asyncio.Future
+
+
+class QueryBatcher:
+    """合并并发查询的检索器。
+
+    Args:
+        store: 提供 search / search_lexical / search_hybrid 的向量库（RagStore）
+        embed_fn: 异步嵌入函数
+        window_ms: 合并窗口（毫秒），第一条查询到达后最多等待这么久
+        max_batch: 单批最多合并的查询数，达到后立即执行
+        fusion: 混合检索的融合方式，"rrf" 或 "weighted"
+        alpha: weighted 融合时向量分数的权重
+        mmr_lambda: MMR 重排中相关性的默认权重，1 表示不重排
+        mmr_fetch: MMR 重排时候选数为 top_k 的多少倍
+    """
+
+    def __init__(self, store, embed_fn: Callable[[List[str]], Awaitable[np.ndarray]],
+                 window_ms: float = 2.0, max_batch: int = 32,
+                 fusion: str = "rrf", alpha: float = 0.5,
+                 mmr_lambda: float = 1.0, mmr_fetch: int = 4):
+        if fusion not in FUSIONS:
+            raise ValueError(f"未知融合方式 {fusion}，可选：{', '.join(FUSIONS)}")
+        self.store = store
+        self.embed_fn = embed_fn
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.fusion = fusion
+        self.alpha = alpha
+        self.mmr_lambda = mmr_lambda
+        self.mmr_fetch = max(1, mmr_fetch)
+        self._pending: List[_Pending] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._batch_sizes: Counter = Counter()
+        # 持有运行中批次任务的引用，避免被垃圾回收
+        self._tasks: set = set()
+
+    async def search(self, query: str, top_k: int, nprobe: int = 0, ef_search: int = 0,
+                     mode: str = "vector",
+                     filters: Optional[Dict[str, Any]] = None,
+                     mmr_lambda: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """提交一条查询，返回该查询的 (距离或分数, 外部 ID) 两个一维数组。
+
+        mode 为 "vector" 时返回 L2 距离（越小越相关），"lexical" / "hybrid" 时返回分数（越大越相关）。
+        filters 为元数据过滤表达式（见 metadata_filter），为空表示不过滤。
+        mmr_lambda 为 None 时使用构造时的默认值；MMR 重排后结果按选中顺序排列。
+        """
+        mmr_lambda = self._check(mode, mmr_lambda, top_k)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append(_Pending(query, top_k, nprobe, ef_search, mode, filters or None,
+                                      mmr_lambda, fut))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    async def search_many(self, queries: List[str], top_k: int, nprobe: int = 0, ef_search: int = 0,
+                          mode: str = "vector",
+                          filters: Optional[Dict[str, Any]] = None,
+                          mmr_lambda: Optional[float] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """一次提交多条查询（例如智能体同一轮拆出的几个子问题），返回每条查询的 (距离或分数, 外部 ID)。
+
+        调用方已经把查询攒好，不再等待合并窗口：直接作为一批执行，即一次嵌入请求 + 一次矩阵检索。
+        参数含义同 search，对全部查询生效；查询数不能超过 max_batch。
+        """
+        mmr_lambda = self._check(mode, mmr_lambda, top_k)
+        if not queries or len(queries) > self.max_batch:
+            raise ValueError(f"查询数须在 1 到 {self.max_batch} 之间：{len(queries)}")
+        loop = asyncio.get_running_loop()
+        batch = [_Pending(query, top_k, nprobe, ef_search, mode, filters or None, mmr_lambda,
+                          loop.create_future()) for query in queries]
+        self._batch_sizes[len(batch)] += 1
+        await self._run(batch)
+        return [entry.fut.result() for entry in batch]
+
+    def _check(self, mode: str, mmr_lambda: Optional[float], top_k: int) -> float:
+        """校验检索模式、mmr_lambda 与 top_k，返回实际使用的 mmr_lambda。
+
+        在查询入队之前校验：非法参数只让本次调用失败，不会进入合并批次连累其他调用方。
+        """
+        check_top_k(top_k)
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"未知检索模式 {mode}，可选：{', '.join(SEARCH_MODES)}")
+        mmr_lambda = self.mmr_lambda if mmr_lambda is None else mmr_lambda
+        if not 0 <= mmr_lambda <= 1:
+            raise ValueError(f"mmr_lambda 必须在 [0, 1] 之间：{mmr_lambda}")
+        return mmr_lambda
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._batch_sizes[len(batch)] += 1
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[_Pending]) -> None:
+        try:
+            # 只有需要向量的查询才嵌入
+            need = [i for i, entry in enumerate(batch) if entry.mode != "lexical"]
+            q_emb = np.zeros((len(batch), 0), dtype="float32")
+            if need:
+                emb = await self.embed_fn([batch[i].query for i in need])
+                q_emb = np.zeros((len(batch), emb.shape[1]), dtype="float32")
+                q_emb[need] = emb
+            # 模式、搜索参数与过滤条件相同的查询共用一次检索，取组内最大的 top_k 再各自截断
+            groups: Dict[Tuple[int, int, str, str, float], List[int]] = {}
+            for i, entry in enumerate(batch):
+                key = json.dumps(entry.filters, sort_keys=True, ensure_ascii=False)
+                groups.setdefault((entry.nprobe, entry.ef_search, entry.mode, key, entry.mmr_lambda),
+                                  []).append(i)
+            for (nprobe, ef_search, mode, _, lam), rows in groups.items():
+                top = max(batch[i].top_k for i in rows)
+                k = top * self.mmr_fetch if lam < 1 else top
+                texts = [batch[i].query for i in rows]
+                try:
+                    D, I = await asyncio.to_thread(self._search_group, mode, texts, q_emb[rows], k,
+                                                   nprobe, ef_search, batch[rows[0]].filters, top, lam)
+                except Exception as e:
+                    # 过滤表达式等参数错误（以及检索中的其他异常）只影响本组查询
+                    for i in rows:
+                        if not batch[i].fut.done():
+                            batch[i].fut.set_exception(e)
+                    continue
+                for j, i in enumerate(rows):
+                    top_k, fut = batch[i].top_k, batch[i].fut
+                    if not fut.done():
+                        fut.set_result((D[j, :top_k], I[j, :top_k]))
+        except Exception as e:
+            for entry in batch:
+                if not entry.fut.done():
+                    entry.fut.set_exception(e)
+
+    def _search_group(self, mode: str, texts: List[str], q_emb: np.ndarray, k: int, nprobe: int,
+                      ef_search: int, filters: Optional[Dict[str, Any]], top_k: int,
+                      lam: float) -> Tuple[np.ndarray, np.ndarray]:
+        """一组查询的检索（取 k 个候选）与可选的 MMR 重排（保留 top_k 个），在工作线程中执行。"""
+        if mode == "lexical":
+            D, I = self.store.search_lexical(texts, k, filters=filters)
+        elif mode == "hybrid":
+            D, I = self.store.search_hybrid(q_emb, texts, k, fusion=self.fusion, alpha=self.alpha,
+                                            nprobe=nprobe, ef_search=ef_search, filters=filters)
+        else:
+            D, I = self.store.search(q_emb, k, nprobe=nprobe, ef_search=ef_search, filters=filters)
+        if lam < 1:
+            D, I = self._diversify(D, I, mode, top_k, lam)
+        return D, I
+
+    def _diversify(self, D: np.ndarray, I: np.ndarray, mode: str, top_k: int,
+                   lam: float) -> Tuple[np.ndarray, np.ndarray]:
+        """对一组查询的候选做 MMR 重排，保留 top_k 个。"""
+        if mode == "vector":
+            # 嵌入为单位向量时，余弦相似度 = 1 - L2² / 2
+            relevance = 1 - D / 2
+        else:
+            # 分数的尺度不固定，按查询归一化到 [0, 1]，与余弦相似度可比
+            valid = I >= 0
+            lo = np.where(valid, D, np.inf).min(axis=1, keepdims=True)
+            hi = np.where(valid, D, -np.inf).max(axis=1, keepdims=True)
+            span = np.where(hi > lo, hi - lo, 1)
+            relevance = np.where(valid, (D - lo) / span, 0)
+        order = mmr_select(relevance, I, self.store.vectors_of(I), top_k, lam)
+        picked = np.maximum(order, 0)
+        empty = np.finfo("float32").max if mode == "vector" else 0
+        D = np.where(order >= 0, np.take_along_axis(D, picked, axis=1), empty).astype("float32")
+        I = np.where(order >= 0, np.take_along_axis(I, picked, axis=1), -1)
+        return D, I
+
+    def stats(self) -> Dict[str, object]:
+        batches = sum(self._batch_sizes.values())
+        queries = sum(size * n for size, n in self._batch_sizes.items())
+        return {
+            "batches": batches,
+            "queries": queries,
+            "mean_batch_size": queries / batches if batches else 0.0,
+            "max_batch_size": max(self._batch_sizes, default=0),
+            "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+        }
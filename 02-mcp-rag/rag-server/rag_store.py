@@ -0,0 +1,1568 @@
+"""RAG 向量库的磁盘格式与加载逻辑。
+
+目录结构（RAG_INDEX_PATH 指向的目录）：
+    meta.json   版本头：格式版本、向量维度、文档数、下一个可用 ID、快照代数（每次保存加一）、
+                index.faiss 覆盖的行数，以及各数据文件已提交的区域 [数据起始偏移, 字节数, CRC32]
+    snapshot.lock 快照锁：保存时替换文件与写版本头持排他锁，打开时持共享锁（见 _snapshot_lock）
+    index.faiss FAISS 索引（faiss.write_index 格式，binary 编码时为 write_index_binary 格式），向量以外部 ID 存取
+    index_log.npy 上次整体写出索引之后新增的原始向量（float32，只追加），打开时重放进索引
+    docs.bin    所有文档的 UTF-8 字节顺序拼接（只追加）；启用文档压缩时为逐块压缩后的数据
+    docs.off    文档偏移数组（int64，长度 = 文档数 + 1，.npy 格式），偏移针对未压缩的字节
+    docs.blk    仅压缩时存在：每块的 (未压缩起始偏移, docs.bin 中的起始偏移)，末行为结尾
+    ids.npy     每行文档的外部 ID（int64，严格递增）
+    chunks.npy  每个文档块的来源编号与在来源文本中的起止字符偏移（结构化 .npy）
+    sources.jsonl 来源名称（文件路径 / URI），每行一个 JSON 字符串（只追加），chunks.npy 中的来源编号即行号
+    hashes.npy  每个文档规范化文本的 64 位内容哈希，用于入库去重
+    deleted.npy 已删除（墓碑）但尚未压缩掉的外部 ID
+    vectors.npy 每行文档的原始 float32 向量，仅在索引使用有损编码（codec）时保存，
+                用于精确重排与重建索引；只按需读取，不计入常驻内存
+    lex_*       BM25 倒排索引（见 lexical_index.py），行号与文档行一一对应
+    timestamps.npy 每行文档的时间戳（Unix 秒，0 表示未知）
+    tag_names.json / tag_offsets.npy / tag_ids.npy  每行文档的标签（CSR 形式）
+
+启动时索引与文档均以内存映射方式打开，只有真正被访问的页才会进入内存，
+因此百万级向量的服务也能在几秒内就绪。
+
+保存的开销与新增的文档数成正比：按行的 .npy 列、docs.bin、sources.jsonl 与 lex_log.jsonl 都原地追加，
+.npy 只改写文件头中的行数；校验和在上次的值上续算追加的字节。版本头记录的长度之外的内容打开时被忽略，
+所以版本头替换成功才算提交。index.faiss 与倒排数组只在压缩、升级或追加部分超过阈值时整体重写。
+
+删除只记墓碑，检索时用 IDSelector 在 FAISS 内部过滤；墓碑比例超过阈值后由
+prepare_compaction / finish_compaction 两步重建，前一步可放在后台线程执行。
+按来源 / 标签 / 时间的元数据过滤同样编译为 IDSelector（位图），在 FAISS 内部生效。
+
+并发：写操作（add / delete / save / 压缩）由调用方串行执行，检索可以在其他线程中同时进行。
+各列只追加，写入时分词、哈希、读入索引、写文件等准备工作都不持锁，只有把一批新行
+提交到索引与各列（或换上压缩 / 重新映射后的对象）的一步持有写锁；检索持有读锁，
+因此看到的总是某次提交之后的完整状态，不会出现索引里有向量而文档还没写入的中间态。
+
+多个进程可以共享同一个目录：一个进程写入并保存，其余进程以内存映射只读打开，
+发现版本头中的快照代数变化后用 refresh 整体切换到新快照（进程间的写入角色见 shared_index.py）。
+"""
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows 没有 flock，多进程共享目录时不加锁
+    fcntl = None
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set,
+                    Tuple)
+
+import faiss
+import numpy as np
+
+from chunking import Chunk, as_chunk
+from embed_cache import normalize_text
+from index_factory import (BINARY_CANDIDATES, build_index, clone_index, export_vectors, index_bytes,
+                           index_codec, index_kind, make_index, min_train_size, normalize_kind,
+                           read_index, reconstruct, rerank_exact, search_params, write_index)
+from lexical_index import FILES as LEXICAL_FILES, LOG_FILE as LEXICAL_LOG_FILE, LexicalIndex, fuse
+from metadata_filter import compile_filter
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 3
+MAGIC = "rag-store"
+
+META_FILE = "meta.json"
+INDEX_FILE = "index.faiss"
+INDEX_LOG_FILE = "index_log.npy"
+DOCS_FILE = "docs.bin"
+OFFSETS_FILE = "docs.off"
+DOC_BLOCKS_FILE = "docs.blk"
+IDS_FILE = "ids.npy"
+CHUNKS_FILE = "chunks.npy"
+SOURCES_FILE = "sources.jsonl"
+HASHES_FILE = "hashes.npy"
+DELETED_FILE = "deleted.npy"
+VECTORS_FILE = "vectors.npy"
+TIMESTAMPS_FILE = "timestamps.npy"
+TAG_NAMES_FILE = "tag_names.json"
+TAG_OFFSETS_FILE = "tag_offsets.npy"
+TAG_IDS_FILE = "tag_ids.npy"
+SNAPSHOT_LOCK_FILE = "snapshot.lock"
+
+CHUNK_DTYPE = np.dtype([("source", "<i4"), ("start", "<i8"), ("end", "<i8")])
+
+# 文档区的压缩方式：none 不压缩；zlib / zstd 按块压缩（zstd 需要安装 zstandard）
+DOC_COMPRESSIONS = ("none", "zlib", "zstd")
+# 压缩块的目标大小（未压缩字节数）
+DOC_BLOCK_BYTES = 64 << 10
+# 最多缓存多少个解压后的块
+DOC_CACHE_BLOCKS = 64
+
+# 最多缓存多少个编译好的过滤表达式（任何写入都会清空缓存）
+FILTER_CACHE_SIZE = 32
+# 过滤后剩余的行数不超过该值时直接精确计算距离：HNSW 在高选择性过滤下容易走不到匹配的节点
+FILTER_EXACT_AT = 4096
+# 追加日志中的向量超过 index.faiss 向量数的该比例，或超过 INDEX_LOG_MAX_BYTES 时，保存时整体重写索引
+# （内存映射只读打开的进程要把日志另建成一个精确的小索引，日志不宜太大）
+INDEX_LOG_RATIO = 0.125
+INDEX_LOG_MAX_BYTES = 64 << 20
+
+
+def _heap_bytes(*arrays: Optional[np.ndarray]) -> int:
+    """数组占用的匿名内存字节数，内存映射（np.memmap）的不计。"""
+    return sum(a.nbytes for a in arrays if a is not None and not isinstance(a, np.memmap))
+
+
+class StoreFormatError(Exception):
+    """磁盘上的索引文件损坏、版本不兼容或与文档不一致。"""
+
+
+def _crc32(path: str, offset: int = 0, size: Optional[int] = None, crc: int = 0,
+           chunk_size: int = 1 << 20) -> int:
+    """文件中从 offset 开始的 size 个字节（默认到文件末尾）的 CRC32，crc 为之前字节的校验和（续算）。"""
+    remaining = os.path.getsize(path) - offset if size is None else size
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+    return crc
+
+
+@contextmanager
+def _snapshot_lock(path: str, exclusive: bool = False) -> Iterator[None]:
+    """跨进程的快照锁（flock）：保存时排他，打开时共享，读进程不会打开到替换了一半的文件。"""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(path, SNAPSHOT_LOCK_FILE), "a+b") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _npy_offset(path: str) -> int:
+    """.npy 文件中数据的起始偏移（文件头的长度）。"""
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+        return f.tell()
+
+
+def _load_npy(path: str, name: str, rows: Optional[int] = None) -> np.ndarray:
+    """内存映射打开 path 目录下的 .npy，只取前 rows 行（版本头记录的行数，之后是尚未提交的追加）。"""
+    arr = np.load(os.path.join(path, name), mmap_mode="r")
+    if rows is None:
+        return arr
+    if len(arr) < rows:
+        raise StoreFormatError(f"{name} 只有 {len(arr)} 行，版本头记录 {rows} 行")
+    return arr[:rows]
+
+
+def _append_npy(path: str, name: str, base: np.ndarray, tail: np.ndarray) -> bool:
+    """把 tail 追加到 path 目录下的 .npy 文件末尾，base 为从该文件映射的已提交部分；成功时返回 True。
+
+    先截掉上次保存失败时留下的未提交字节，再追加并改写文件头中的行数（持快照锁，打开的进程读到的文件头总是完整的）。
+    新文件头与原来长度不同（例如旧版本 numpy 写出的文件没有为行数预留位置）时不追加，返回 False，由调用方整体重写。
+    """
+    file = os.path.join(path, name)
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        "descr": np.lib.format.dtype_to_descr(base.dtype), "fortran_order": False,
+        "shape": (len(base) + len(tail),) + base.shape[1:]})
+    offset = _npy_offset(file)
+    if offset != len(header.getvalue()):
+        return False
+    if not len(tail):
+        return True
+    with open(file, "r+b") as f:
+        f.truncate(offset + base.nbytes)
+        f.seek(offset + base.nbytes)
+        f.write(np.ascontiguousarray(tail, dtype=base.dtype).reshape(-1).view(np.uint8).data)
+        f.flush()
+        with _snapshot_lock(path, exclusive=True):
+            f.seek(0)
+            f.write(header.getvalue())
+    return True
+
+
+def read_generation(path: str) -> int:
+    """path 目录中最新快照的代数；目录还没有保存过时为 -1。"""
+    try:
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            return json.load(f).get("generation", 0)
+    except FileNotFoundError:
+        return -1
+
+
+class _RWLock:
+    """读写锁：读者之间并发，写者独占。
+
+    有写者在等待时新来的读者排队，持续的检索不会把写入饿死；写者提交的临界区很短，读者最多等一次提交。
+    同一线程可以重入读锁，持有写锁的线程也可以直接读。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer: Optional[int] = None
+        self._waiting = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = threading.get_ident()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+
+def _reader(method):
+    """在读锁内执行的 RagStore 方法。"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._rw.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def check_top_k(top_k: int) -> None:
+    """top_k 必须是正整数（FAISS 对 k <= 0 只会断言失败，负数切片还会静默取错结果）。"""
+    if isinstance(top_k, bool) or not isinstance(top_k, (int, np.integer)) or top_k < 1:
+        raise ValueError(f"top_k 必须是正整数：{top_k!r}")
+
+
+def content_hash(text: str) -> int:
+    """规范化文本的 64 位内容哈希（有符号，便于存入 int64 数组）。"""
+    digest = hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class Column:
+    """定长列：已持久化的部分内存映射，新增的部分暂存在内存列表中。
+
+    width > 0 时每行是长度为 width 的向量（二维数组）。
+    """
+
+    def __init__(self, dtype, base: Optional[np.ndarray] = None, width: int = 0,
+                 file: Optional[str] = None):
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        shape = (0, width) if width else (0,)
+        self._base = base if base is not None else np.zeros(shape, dtype=self.dtype)
+        self._tail: list = []
+        # 已持久化部分映射自的文件，保存到同一个文件时原地追加
+        self._file = file
+
+    @classmethod
+    def load(cls, path: str, name: str, dtype, width: int = 0, rows: Optional[int] = None) -> "Column":
+        """rows 为版本头记录的行数，文件中之后的内容被忽略。"""
+        base = _load_npy(path, name, rows)
+        if base.dtype != np.dtype(dtype):
+            raise StoreFormatError(f"{name} 的数据类型为 {base.dtype}，期望 {np.dtype(dtype)}")
+        if base.shape[1:] != ((width,) if width else ()):
+            raise StoreFormatError(f"{name} 的形状为 {base.shape}，每行期望 {width} 维")
+        return cls(dtype, base, width, os.path.join(path, name))
+
+    def __len__(self) -> int:
+        return len(self._base) + len(self._tail)
+
+    def __getitem__(self, i: int):
+        i = int(i)
+        if i < len(self._base):
+            return self._base[i]
+        return self._tail[i - len(self._base)]
+
+    def extend(self, values: Iterable) -> None:
+        self._tail.extend(values)
+
+    def nbytes(self) -> int:
+        """常驻内存的字节数：未映射的部分与新增部分。"""
+        return _heap_bytes(self._base) + len(self._tail) * self.dtype.itemsize * max(self.width, 1)
+
+    def array(self) -> np.ndarray:
+        if not self._tail:
+            return self._base
+        tail = np.array(self._tail, dtype=self.dtype).reshape((-1,) + self._base.shape[1:])
+        return np.concatenate([self._base, tail])
+
+    def gather(self, rows: np.ndarray) -> np.ndarray:
+        """按行号批量取值（不拼接整列，只读取被选中的行）。"""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty(rows.shape + self._base.shape[1:], dtype=self.dtype)
+        mapped = rows < len(self._base)
+        out[mapped] = self._base[rows[mapped]]
+        for pos in zip(*np.nonzero(~mapped)):
+            out[pos] = self._tail[rows[pos] - len(self._base)]
+        return out
+
+    def take(self, mask: np.ndarray) -> "Column":
+        return Column(self.dtype, np.ascontiguousarray(self.array()[mask]), self.width)
+
+    def write(self, path: str, name: str) -> List[str]:
+        """保存到 path 目录下的 name，返回以临时文件写出、需要由调用方替换的文件名。
+
+        已持久化的部分就映射自该文件时只把新增部分追加到末尾（见 _append_npy）；
+        否则流式整体写出：已映射部分与新增部分依次写入临时文件，不在内存中拼接整列。
+        """
+        tail = np.array(self._tail, dtype=self.dtype).reshape((-1,) + self._base.shape[1:])
+        if self._file == os.path.join(path, name) and _append_npy(path, name, self._base, tail):
+            return []
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False,
+                  "shape": (len(self),) + self._base.shape[1:]}
+        with open(os.path.join(path, name + ".tmp"), "wb") as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for part in (self._base, tail):
+                f.write(np.ascontiguousarray(part).reshape(-1).view(np.uint8).data)
+        return [name]
+
+
+def _codec(compression: str) -> Optional[Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]]:
+    """块压缩方式 -> (压缩函数, 解压函数)，none 返回 None；zstd 需要安装可选依赖 zstandard。"""
+    if compression == "none":
+        return None
+    if compression == "zlib":
+        return zlib.compress, zlib.decompress
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise StoreFormatError("文档压缩方式 zstd 需要先安装 zstandard（uv pip install zstandard）") from None
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    raise ValueError(f"未知文档压缩方式 {compression}，可选：{', '.join(DOC_COMPRESSIONS)}")
+
+
+class DocStore:
+    """文档区：所有文档的 UTF-8 字节顺序拼接，配合偏移数组按需解码。
+
+    已持久化的部分内存映射；新增的部分追加在内存中的字节缓冲区里（不为每篇文档建 Python 对象），
+    保存时只把新增部分追加到 docs.bin 与偏移表（块表）末尾。compression 不为 none 时按块压缩：
+    每次保存把新增文档打包成若干个约 DOC_BLOCK_BYTES 的块，块边界总在文档之间，
+    读取一篇文档只需解压它所在的一个块（最近用过的块有缓存）。
+    """
+
+    def __init__(self, blob: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None,
+                 blocks: Optional[np.ndarray] = None, stored: str = "none",
+                 file: Optional[str] = None, compression: Optional[str] = None):
+        self._blob = blob if blob is not None else np.zeros(0, dtype=np.uint8)
+        self._offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        # 压缩块表：每行是块的 (文档区起始偏移, docs.bin 中的起始偏移)，末行为结尾；未压缩时为 None
+        self._blocks = blocks if stored != "none" else None
+        self._stored = stored
+        # 之后保存使用的压缩方式，与磁盘上的不同时下次保存整体转换
+        self.compression = compression or stored
+        _codec(self.compression)
+        # 内存映射的 docs.bin 路径，压缩方式不变时保存可以原地追加
+        self._file = file
+        self._tail = bytearray()
+        self._tail_ends = array("q")
+        self._cache: "OrderedDict[int, bytes]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, stored: str = "none", compression: Optional[str] = None,
+             n: Optional[int] = None) -> "DocStore":
+        """stored 为磁盘上的压缩方式，compression 为之后写入使用的压缩方式（不同时下次保存整体转换）；
+        n 为版本头记录的文档数。
+        """
+        offsets = _load_npy(path, OFFSETS_FILE, None if n is None else n + 1)
+        blocks = None
+        end = int(offsets[-1])
+        if stored != "none":
+            blocks = np.load(os.path.join(path, DOC_BLOCKS_FILE), mmap_mode="r")
+            # 未提交的块都在已提交文档的结尾之后
+            blocks = blocks[:int(np.searchsorted(blocks[:, 0], end, side="right"))]
+            end = int(blocks[-1, 1])
+        blob_path = os.path.join(path, DOCS_FILE)
+        # 上次保存中途失败时各文件末尾可能多出未提交的内容，以版本头与偏移表为准
+        if os.path.getsize(blob_path) < end:
+            raise StoreFormatError(f"{DOCS_FILE} 长度与偏移表不一致")
+        # 空文件不能被 mmap
+        blob = np.memmap(blob_path, dtype=np.uint8, mode="r", shape=(end,)) if end else None
+        return cls(blob, offsets, blocks, stored, blob_path, compression)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1 + len(self._tail_ends)
+
+    def _block(self, b: int) -> bytes:
+        with self._cache_lock:
+            data = self._cache.get(b)
+            if data is not None:
+                self._cache.move_to_end(b)
+                return data
+        start, end = self._blocks[b, 1], self._blocks[b + 1, 1]
+        data = _codec(self._stored)[1](bytes(self._blob[start:end]))
+        with self._cache_lock:
+            self._cache[b] = data
+            if len(self._cache) > DOC_CACHE_BLOCKS:
+                self._cache.popitem(last=False)
+        return data
+
+    def _bytes(self, i: int) -> bytes:
+        n_mapped = len(self._offsets) - 1
+        if i >= n_mapped:
+            j = i - n_mapped
+            return bytes(self._tail[self._tail_ends[j - 1] if j else 0:self._tail_ends[j]])
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        if self._blocks is None:
+            return bytes(self._blob[start:end])
+        b = int(np.searchsorted(self._blocks[:, 0], start, side="right")) - 1
+        base = int(self._blocks[b, 0])
+        return self._block(b)[start - base:end - base]
+
+    def __getitem__(self, i: int) -> str:
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        return self._bytes(i).decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def extend(self, docs: Iterable[str]) -> None:
+        for doc in docs:
+            self._tail += doc.encode("utf-8")
+            self._tail_ends.append(len(self._tail))
+
+    def nbytes(self) -> int:
+        """常驻内存的字节数：新增部分与解压块缓存（内存映射的部分不计）。"""
+        with self._cache_lock:
+            cached = sum(len(b) for b in self._cache.values())
+        return (_heap_bytes(self._blob, self._offsets, self._blocks) + len(self._tail)
+                + self._tail_ends.itemsize * len(self._tail_ends) + cached)
+
+    def take(self, mask: np.ndarray) -> "DocStore":
+        kept = DocStore(stored=self.compression)
+        for i in np.flatnonzero(mask).tolist():
+            kept._tail += self._bytes(i)
+            kept._tail_ends.append(len(kept._tail))
+        return kept
+
+    def _pack(self, raw: Iterable[bytes], raw_start: int, comp_start: int, f) -> List[Tuple[int, int]]:
+        """把文档字节流按约 DOC_BLOCK_BYTES 切块压缩写入 f，返回新块的起点与结尾 (文档区偏移, 文件偏移)。"""
+        compress = _codec(self.compression)[0]
+        rows, buf = [], bytearray()
+
+        def flush() -> None:
+            nonlocal raw_start, comp_start
+            rows.append((raw_start, comp_start))
+            data = compress(bytes(buf))
+            f.write(data)
+            raw_start += len(buf)
+            comp_start += len(data)
+            buf.clear()
+
+        for doc in raw:
+            buf += doc
+            if len(buf) >= DOC_BLOCK_BYTES:
+                flush()
+        if buf:
+            flush()
+        rows.append((raw_start, comp_start))
+        return rows
+
+    def write(self, path: str) -> List[str]:
+        """保存到 path 目录，返回以临时文件写出、需要由调用方替换的文件名。
+
+        docs.bin 已由本对象内存映射且压缩方式不变时原地追加新增部分，偏移表与块表也只追加新增的行
+        （版本头替换成功才算提交），否则整体重写到临时文件。
+        """
+        blob_path = os.path.join(path, DOCS_FILE)
+        n_mapped = len(self._offsets) - 1
+        base_end = int(self._offsets[-1])
+        tail_ends = np.frombuffer(self._tail_ends, dtype=np.int64) if self._tail_ends else np.zeros(0, np.int64)
+        names = []
+        if self._file == blob_path and self.compression == self._stored and os.path.exists(blob_path):
+            committed = len(self._blob)
+            with open(blob_path, "r+b") as f:
+                # 截掉上次保存失败时留下的未提交字节
+                f.truncate(committed)
+                f.seek(committed)
+                if self.compression == "none":
+                    f.write(self._tail)
+                    blocks = None
+                else:
+                    # 新块表的第一行就是原来的结尾行
+                    new = np.asarray(self._pack(self._tail_docs(), base_end, committed, f), dtype=np.int64)
+                    if _append_npy(path, DOC_BLOCKS_FILE, self._blocks, new[1:]):
+                        blocks = None
+                    else:
+                        blocks = np.concatenate([np.asarray(self._blocks[:-1]), new])
+            if _append_npy(path, OFFSETS_FILE, self._offsets, base_end + tail_ends):
+                offsets = None
+            else:
+                offsets = np.concatenate([self._offsets, base_end + tail_ends])
+        else:
+            names.append(DOCS_FILE)
+            offsets = np.concatenate([self._offsets, base_end + tail_ends])
+            with open(blob_path + ".tmp", "wb") as f:
+                if self.compression == "none":
+                    if self._blocks is None:
+                        f.write(memoryview(self._blob))
+                    else:
+                        for i in range(n_mapped):
+                            f.write(self._bytes(i))
+                    f.write(self._tail)
+                    blocks = None
+                else:
+                    raw = (self._bytes(i) for i in range(len(self)))
+                    blocks = np.asarray(self._pack(raw, 0, 0, f), dtype=np.int64)
+        if blocks is not None:
+            with open(os.path.join(path, DOC_BLOCKS_FILE + ".tmp"), "wb") as f:
+                np.save(f, blocks.reshape(-1, 2))
+            names.append(DOC_BLOCKS_FILE)
+        if offsets is not None:
+            with open(os.path.join(path, OFFSETS_FILE + ".tmp"), "wb") as f:
+                np.save(f, offsets)
+            names.append(OFFSETS_FILE)
+        return names
+
+    def _tail_docs(self) -> Iterator[bytes]:
+        start = 0
+        for end in self._tail_ends:
+            yield bytes(self._tail[start:end])
+            start = end
+
+
+class ChunkTable:
+    """列式的块来源表，与文档一一对应：来源编号（-1 表示未知）与起止偏移。"""
+
+    def __init__(self, rows: Optional[Column] = None, sources: Optional[List[str]] = None,
+                 file: Optional[str] = None, size: int = 0):
+        self.rows = rows if rows is not None else Column(CHUNK_DTYPE)
+        self.sources: List[str] = sources or []
+        self._source_ids = {name: i for i, name in enumerate(self.sources)}
+        # 来源已写入的文件（sources.jsonl）与其中的来源数、字节数，保存时只追加之后新增的来源
+        self._file = file
+        self._saved = len(self.sources) if file else 0
+        self.size = size
+
+    @classmethod
+    def load(cls, path: str, n: Optional[int] = None, size: Optional[int] = None) -> "ChunkTable":
+        """n 为版本头记录的行数，size 为 sources.jsonl 已提交的字节数。"""
+        file = os.path.join(path, SOURCES_FILE)
+        with open(file, "rb") as f:
+            data = f.read() if size is None else f.read(size)
+        sources = [json.loads(line) for line in data.splitlines()]
+        return cls(Column.load(path, CHUNKS_FILE, CHUNK_DTYPE, rows=n), sources, file, len(data))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> Tuple[str, int, int]:
+        """返回第 i 个块的 (来源名, 起始偏移, 结束偏移)。"""
+        src, start, end = self.rows[i]
+        return (self.sources[src] if src >= 0 else ""), int(start), int(end)
+
+    def source_id(self, source: str) -> int:
+        return self._source_ids.get(source, -1)
+
+    def extend(self, chunks: Iterable[Chunk]) -> None:
+        rows = []
+        for c in chunks:
+            src = -1
+            if c.source:
+                src = self._source_ids.setdefault(c.source, len(self.sources))
+                if src == len(self.sources):
+                    self.sources.append(c.source)
+            rows.append((src, c.start, c.end))
+        self.rows.extend(rows)
+
+    def take(self, mask: np.ndarray) -> "ChunkTable":
+        return ChunkTable(self.rows.take(mask), list(self.sources))
+
+    def write(self, path: str) -> List[str]:
+        """保存到 path 目录，返回以临时文件写出、需要由调用方替换的文件名；新增的来源追加到 sources.jsonl 末尾。"""
+        names = self.rows.write(path, CHUNKS_FILE)
+        file = os.path.join(path, SOURCES_FILE)
+        if self._file == file and os.path.exists(file):
+            target, mode = file, "r+b"
+        else:
+            target, mode = file + ".tmp", "wb"
+            self._saved, self.size = 0, 0
+            names.append(SOURCES_FILE)
+        lines = b"".join(json.dumps(name, ensure_ascii=False).encode("utf-8") + b"\n"
+                         for name in self.sources[self._saved:])
+        with open(target, mode) as f:
+            # 截掉上次保存失败时留下的未提交字节
+            f.truncate(self.size)
+            f.seek(self.size)
+            f.write(lines)
+        self._file, self._saved, self.size = file, len(self.sources), self.size + len(lines)
+        return names
+
+
+class TagTable:
+    """每行文档的标签表，CSR 形式：offsets（长度 = 行数 + 1）与标签编号，标签名单独存放。"""
+
+    def __init__(self, names: Optional[List[str]] = None, offsets: Optional[np.ndarray] = None,
+                 tag_ids: Optional[np.ndarray] = None, path: Optional[str] = None):
+        self.names: List[str] = names or []
+        self._name_ids = {name: i for i, name in enumerate(self.names)}
+        self._offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self._ids = tag_ids if tag_ids is not None else np.zeros(0, dtype=np.int32)
+        self._tail: List[Tuple[int, ...]] = []
+        # offsets / tag_ids 映射自的目录与当时的标签名数，保存到同一目录时只追加新增的行
+        self._path = path
+        self._saved_names = len(self.names)
+
+    @classmethod
+    def load(cls, path: str, n: int) -> "TagTable":
+        if not os.path.exists(os.path.join(path, TAG_NAMES_FILE)):
+            # 旧版本的向量库没有标签
+            return cls(offsets=np.zeros(n + 1, dtype=np.int64))
+        with open(os.path.join(path, TAG_NAMES_FILE), encoding="utf-8") as f:
+            names = json.load(f)
+        offsets = _load_npy(path, TAG_OFFSETS_FILE, n + 1)
+        return cls(names, offsets, _load_npy(path, TAG_IDS_FILE, int(offsets[-1])), path)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1 + len(self._tail)
+
+    def __getitem__(self, i: int) -> List[str]:
+        i = int(i)
+        n_base = len(self._offsets) - 1
+        ids = self._ids[self._offsets[i]:self._offsets[i + 1]] if i < n_base else self._tail[i - n_base]
+        return [self.names[t] for t in ids]
+
+    def nbytes(self) -> int:
+        return _heap_bytes(self._offsets, self._ids) + sum(8 + 4 * len(t) for t in self._tail)
+
+    def extend(self, tag_lists: Iterable[Sequence[str]]) -> None:
+        for tags in tag_lists:
+            row = []
+            for name in dict.fromkeys(tags):  # 去重并保持顺序
+                tid = self._name_ids.setdefault(name, len(self.names))
+                if tid == len(self.names):
+                    self.names.append(name)
+                row.append(tid)
+            self._tail.append(tuple(row))
+
+    def _tail_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """新增行接在已有部分之后的 offsets（不含开头的 0）与标签编号。"""
+        counts = np.fromiter((len(t) for t in self._tail), dtype=np.int64, count=len(self._tail))
+        ids = np.fromiter((t for row in self._tail for t in row), dtype=np.int32, count=int(counts.sum()))
+        return self._offsets[-1] + np.cumsum(counts), ids
+
+    def _merged(self) -> Tuple[np.ndarray, np.ndarray]:
+        if not self._tail:
+            return self._offsets, self._ids
+        offsets, ids = self._tail_arrays()
+        return np.concatenate([self._offsets, offsets]), np.concatenate([self._ids, ids])
+
+    def rows_with(self, names: List[str], require_all: bool = False) -> np.ndarray:
+        """含 names 中任一（require_all 时为全部）标签的行掩码。"""
+        wanted = {self._name_ids[name] for name in names if name in self._name_ids}
+        mask = np.zeros(len(self), dtype=bool)
+        if not wanted or (require_all and len(wanted) < len(set(names))):
+            return mask
+        offsets, ids = self._merged()
+        rows = np.repeat(np.arange(len(self)), np.diff(offsets))[np.isin(ids, list(wanted))]
+        if require_all:
+            return np.bincount(rows, minlength=len(self)) >= len(wanted)
+        mask[rows] = True
+        return mask
+
+    def take(self, mask: np.ndarray) -> "TagTable":
+        offsets, ids = self._merged()
+        counts = np.diff(offsets)[mask]
+        entry_rows = np.repeat(np.arange(len(self)), np.diff(offsets))
+        kept = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=kept[1:])
+        return TagTable(list(self.names), kept, np.ascontiguousarray(ids[mask[entry_rows]]))
+
+    def write(self, path: str) -> List[str]:
+        """保存到 path 目录，返回以临时文件写出、需要由调用方替换的文件名。
+
+        标签名（通常很少）有变化时才重写；offsets 与 tag_ids 映射自该目录时只追加新增的行。
+        """
+        names = []
+        if self._path != path or len(self.names) != self._saved_names:
+            with open(os.path.join(path, TAG_NAMES_FILE + ".tmp"), "w", encoding="utf-8") as f:
+                json.dump(self.names, f, ensure_ascii=False)
+            names.append(TAG_NAMES_FILE)
+        if self._path == path:
+            offsets, ids = self._tail_arrays()
+            if (_append_npy(path, TAG_OFFSETS_FILE, self._offsets, offsets)
+                    and _append_npy(path, TAG_IDS_FILE, self._ids, ids)):
+                return names
+        offsets, ids = self._merged()
+        for name, arr in ((TAG_OFFSETS_FILE, offsets), (TAG_IDS_FILE, ids)):
+            with open(os.path.join(path, name + ".tmp"), "wb") as f:
+                np.save(f, arr)
+        return names + [TAG_OFFSETS_FILE, TAG_IDS_FILE]
+
+
+class _Compacted(NamedTuple):
+    index: faiss.Index
+    docs: DocStore
+    ids: Column
+    chunks: ChunkTable
+    hashes: Column
+    tags: TagTable
+    timestamps: Column
+    vectors: Optional[Column]
+    lexical: Optional[LexicalIndex]
+    removed: Set[int]
+
+
+class RagStore:
+    """FAISS 索引与文档列表的组合，可选持久化到 path 目录。
+
+    每个文档块在加入时分配一个稳定的外部 ID（严格递增），检索结果与删除都使用该 ID；
+    压缩只会移除行，不会改变其余文档的 ID。
+
+    kind 为目标索引类型，codec 为向量存储编码；需要训练的组合（IVF 类、sq8 / pq 编码）
+    在向量数达到 promote_at（且不少于训练所需样本数）之前以 float32 的 Flat 暂存。
+    kind="flat" 且 promote_at > 0 时，达到阈值后自动升级为 IVF-Flat。
+
+    使用有损编码时另存一份原始向量（vectors.npy，内存映射）；rescore > 1 时检索先取
+    top_k * rescore 个候选，再用原始向量精确重排，以少量随机读换回编码损失的召回率。
+    binary 编码（符号位）的汉明距离只用于粗筛，总是取至少 BINARY_CANDIDATES 个候选精确重排。
+
+    lexical=True 时同步维护 BM25 倒排索引，支持 search_lexical 与混合检索 search_hybrid。
+
+    上次整体写出索引之后新增的向量另存在追加日志（index_log.npy）中，_log 对应 _index_rows 之后的行。
+    内存映射只读打开的索引不能 add，日志中的向量另建一个精确的小索引（_delta），检索时合并两边的结果。
+    """
+
+    def __init__(self, index: faiss.Index, path: Optional[str] = None,
+                 mapped: bool = False, kind: str = "flat", promote_at: int = 0,
+                 codec: str = "float32", rescore: int = 0, lexical: bool = True,
+                 doc_compression: str = "none"):
+        self.index = index
+        self.docs = DocStore(stored=doc_compression)
+        self.ids = Column(np.int64)
+        self.chunks = ChunkTable()
+        self.hashes = Column(np.int64)
+        self.tags = TagTable()
+        self.timestamps = Column(np.int64)
+        kind, self.codec = normalize_kind(kind, codec)
+        # 原始向量只在有损编码下需要保存
+        self.vectors = Column(np.float32, width=index.d) if self.codec != "float32" else None
+        self.rescore = rescore
+        self.lexical = LexicalIndex() if lexical else None
+        self.deleted: Set[int] = set()
+        self.next_id = 0
+        # 快照代数：与磁盘上 meta.json 的 generation 相同时说明已是最新快照
+        self.generation = -1
+        self.path = path
+        self.kind = "ivf_flat" if kind == "flat" and promote_at > 0 and self.codec != "binary" else kind
+        # 需要训练的索引至少要攒够训练样本数才能迁移（IVF 为 156² = 24336 个），更小的 promote_at 被抬高到该值
+        min_size = min_train_size(self.kind, self.codec)
+        if 0 < promote_at < min_size:
+            logger.warning("promote_at=%d 小于 %s/%s 索引的训练样本数，按 %d 处理",
+                           promote_at, self.kind, self.codec, min_size)
+        self.promote_at = max(promote_at, min_size)
+        # 以 mmap 只读方式加载的索引不能 add，第一次写入前要先读入内存
+        self._mapped = mapped
+        # 索引有追加以外的变化（压缩、升级），下次保存要整体重写
+        self._index_dirty = False
+        self._index_rows = 0
+        self._log = Column(np.float32, width=index.d)
+        self._delta: Optional[faiss.Index] = None
+        self._deleted_dirty = False
+        # 上次保存时各数据文件的 [数据起始偏移, 字节数, CRC32]，保存时在此基础上续算
+        self._files: Dict[str, List[int]] = {}
+        # 在线文档的内容哈希集合，第一次去重时才构建
+        self._hash_set: Optional[Set[int]] = None
+        self._selector: Optional[faiss.IDSelector] = None
+        # 在线行掩码与编译好的过滤表达式，写入后失效
+        self._live: Optional[np.ndarray] = None
+        self._filters: Dict[str, Tuple[np.ndarray, np.ndarray, faiss.IDSelector]] = {}
+        self._filters_lock = threading.Lock()
+        self._rw = _RWLock()
+
+    @classmethod
+    def open(cls, path: Optional[str], dim: int = 1536,
+             mmap: bool = True, verify: bool = False,
+             kind: str = "flat", promote_at: int = 0,
+             codec: str = "float32", rescore: int = 0, lexical: bool = True,
+             doc_compression: str = "none") -> "RagStore":
+        """打开 path 目录下的向量库；path 为空或目录不存在时返回空库。
+
+        Args:
+            path: 向量库目录，None 表示只在内存中使用
+            dim: 新建索引时的向量维度
+            mmap: 是否以内存映射方式加载索引与文档
+            verify: 是否校验所有数据文件的 CRC32（大索引会拖慢启动）
+            kind: 目标索引类型，见 index_factory.INDEX_KINDS
+            promote_at: 文档数超过该值后从 Flat 迁移到 IVF
+            codec: 向量存储编码，见 index_factory.CODECS
+            rescore: 有损编码下精确重排的候选倍数，0 或 1 表示不重排
+            lexical: 是否维护 BM25 倒排索引（混合检索需要）
+            doc_compression: 文档区的压缩方式，见 DOC_COMPRESSIONS；与磁盘上的不同时下次保存整体转换
+        """
+        if not path or not os.path.exists(os.path.join(path, META_FILE)):
+            if min_train_size(kind, codec) == 0:
+                index = make_index(kind, dim, codec=codec)
+            else:
+                index = make_index("flat", dim)
+            return cls(index, path, kind=kind, promote_at=promote_at, codec=codec, rescore=rescore,
+                       lexical=lexical, doc_compression=doc_compression)
+        with _snapshot_lock(path):
+            return cls._load(path, dim, mmap, verify, kind, promote_at, codec, rescore, lexical,
+                             doc_compression)
+
+    @classmethod
+    def _load(cls, path: str, dim: int, mmap: bool, verify: bool, kind: str, promote_at: int,
+              codec: str, rescore: int, lexical: bool, doc_compression: str) -> "RagStore":
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("magic") != MAGIC:
+            raise StoreFormatError(f"{path} 不是 RAG 向量库目录")
+        if meta.get("version") != FORMAT_VERSION:
+            raise StoreFormatError(
+                f"不支持的向量库版本 {meta.get('version')}（当前版本 {FORMAT_VERSION}），请重新索引")
+        if meta["dim"] != dim:
+            raise StoreFormatError(f"向量维度不一致：磁盘 {meta['dim']}，期望 {dim}")
+        files = meta["files"]
+        if verify:
+            # 只追加的文件末尾可能有上次保存失败留下的内容，只校验已提交的区域
+            for name, (offset, size, crc) in files.items():
+                if _crc32(os.path.join(path, name), offset, size) != crc:
+                    raise StoreFormatError(f"{name} 校验和不匹配，文件可能已损坏")
+
+        n = meta["ndocs"]
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        store = cls(read_index(os.path.join(path, INDEX_FILE), flags), path,
+                    mapped=mmap, kind=kind, promote_at=promote_at, codec=codec, rescore=rescore,
+                    lexical=lexical)
+        store.docs = DocStore.load(path, meta.get("doc_compression", "none"), doc_compression, n)
+        store.ids = Column.load(path, IDS_FILE, np.int64, rows=n)
+        store.chunks = ChunkTable.load(path, n, files[SOURCES_FILE][1])
+        store.hashes = Column.load(path, HASHES_FILE, np.int64, rows=n)
+        store.deleted = set(np.load(os.path.join(path, DELETED_FILE)).tolist())
+        store.tags = TagTable.load(path, n)
+        store.timestamps = Column.load(path, TIMESTAMPS_FILE, np.int64, rows=n)
+        store.next_id = meta["next_id"]
+        store.generation = meta.get("generation", 0)
+        store._files = files
+        store._index_rows = meta["index_rows"]
+        store._log = Column.load(path, INDEX_LOG_FILE, np.float32, dim, rows=n - store._index_rows)
+        if len(store._log):
+            log_ids = store.ids.array()[store._index_rows:]
+            if mmap:
+                store._delta = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+                store._delta.add_with_ids(np.ascontiguousarray(store._log.array()), log_ids)
+            else:
+                store.index.add_with_ids(np.ascontiguousarray(store._log.array()), log_ids)
+        if (store._ntotal() != meta["ntotal"] or len(store.docs) != n
+                or not len(store.ids) == len(store.chunks) == len(store.hashes) == n
+                or not len(store.tags) == len(store.timestamps) == n):
+            raise StoreFormatError("索引向量数或文档数与版本头记录不一致")
+        if store.vectors is not None:
+            if os.path.exists(os.path.join(path, VECTORS_FILE)):
+                store.vectors = Column.load(path, VECTORS_FILE, np.float32, dim, rows=n)
+            elif isinstance(store.index, faiss.IndexIDMap) and index_codec(store.index) == "float32":
+                # 尚未保存过原始向量（例如换了 codec），从无损索引中导出并按 ID（即行序）排列
+                ids, vectors = export_vectors(store.index)
+                store.vectors = Column(np.float32, vectors[np.argsort(ids)], dim)
+            else:
+                # 索引已是有损编码且没有原始向量，无法重排
+                store.vectors = None
+            if store.vectors is not None and len(store.vectors) != n:
+                raise StoreFormatError(f"{VECTORS_FILE} 行数与文档数不一致")
+        if store.lexical is not None:
+            if all(os.path.exists(os.path.join(path, name)) for name in LEXICAL_FILES):
+                store.lexical = LexicalIndex.load(path, files[LEXICAL_LOG_FILE][1])
+            else:
+                # 旧版本的向量库没有倒排索引，由文档重建，下次保存时写入
+                store.lexical = LexicalIndex.build(store.docs)
+            if len(store.lexical) != n:
+                raise StoreFormatError("倒排索引行数与文档数不一致")
+        return store
+
+    def __len__(self) -> int:
+        """在线（未删除）文档数。"""
+        return len(self.docs) - len(self.deleted)
+
+    def _ntotal(self) -> int:
+        return self.index.ntotal + (self._delta.ntotal if self._delta is not None else 0)
+
+    def _read_index(self) -> faiss.Index:
+        """把磁盘上的索引完整读入内存，并重放追加日志中的向量。"""
+        index = read_index(os.path.join(self.path, INDEX_FILE))
+        if len(self._log):
+            index.add_with_ids(np.ascontiguousarray(self._log.array()), self.ids.array()[self._index_rows:])
+        return index
+
+    def _writable(self) -> None:
+        if self._mapped:
+            index = self._read_index()
+            with self._rw.write():
+                self.index, self._delta, self._mapped = index, None, False
+
+    @_reader
+    def rows_of(self, doc_ids: np.ndarray) -> np.ndarray:
+        """row_of 的向量化版本（不检查墓碑）；不存在的 ID 为 -1。"""
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        base, tail = self.ids._base, self.ids._tail
+        rows = np.full(doc_ids.shape, -1, dtype=np.int64)
+        if len(base):
+            pos = np.minimum(np.searchsorted(base, doc_ids), len(base) - 1)
+            found = base[pos] == doc_ids
+            rows[found] = pos[found]
+        if tail:
+            in_tail = (doc_ids >= tail[0]) & (doc_ids <= tail[-1])
+            rows[in_tail] = len(base) + doc_ids[in_tail] - tail[0]
+        return rows
+
+    @_reader
+    def row_of(self, doc_id: int) -> int:
+        """外部 ID -> 行号；ID 不存在或已删除时返回 -1。"""
+        doc_id = int(doc_id)
+        if doc_id in self.deleted:
+            return -1
+        base, tail = self.ids._base, self.ids._tail
+        # 新增部分的 ID 是连续分配的
+        if tail and tail[0] <= doc_id <= tail[-1]:
+            return len(base) + doc_id - tail[0]
+        pos = int(np.searchsorted(base, doc_id))
+        return pos if pos < len(base) and base[pos] == doc_id else -1
+
+    def _row(self, doc_id: int) -> int:
+        """同 row_of，ID 不存在或已删除时抛出 KeyError（而不是返回 -1 让调用方取到最后一行）。"""
+        row = self.row_of(doc_id)
+        if row < 0:
+            raise KeyError(doc_id)
+        return row
+
+    @_reader
+    def doc(self, doc_id: int) -> str:
+        """文档块的文本；ID 不存在或已删除时抛出 KeyError。"""
+        return self.docs[self._row(doc_id)]
+
+    @_reader
+    def source_of(self, doc_id: int) -> str:
+        """文档块的来源；ID 不存在或已删除时抛出 KeyError。"""
+        return self.chunks[self._row(doc_id)][0]
+
+    @_reader
+    def fetch(self, doc_ids: Sequence[int], window: int = 0) -> List[Optional[Tuple[str, str]]]:
+        """按外部 ID 批量取出命中片段的 (来源, 文本)，window > 0 时文本拼接同源相邻片段（见 context）。
+
+        已删除或不存在的 ID 为 None。全部在一次读锁内完成，不会与并发的删除、压缩交错。
+        """
+        out: List[Optional[Tuple[str, str]]] = []
+        for doc_id in doc_ids:
+            row = self.row_of(doc_id)
+            out.append((self.chunks[row][0], self.context(doc_id, window)) if row >= 0 else None)
+        return out
+
+    @_reader
+    def vectors_of(self, doc_ids: np.ndarray) -> np.ndarray:
+        """按外部 ID 取向量，形状为 doc_ids.shape + (d,)，ID 为 -1 的位置为零向量。
+
+        有原始向量时直接读取，否则从索引中还原。
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        flat = doc_ids.ravel()
+        valid = flat >= 0
+        out = np.zeros((len(flat), self.index.d), dtype="float32")
+        if valid.any():
+            if self.vectors is not None:
+                out[valid] = self.vectors.gather(self.rows_of(flat[valid]))
+            else:
+                out[valid] = self._reconstruct(flat[valid])
+        return out.reshape(doc_ids.shape + (self.index.d,))
+
+    def _reconstruct(self, ids: np.ndarray) -> np.ndarray:
+        """从索引中按外部 ID 还原向量；另建了日志小索引时，日志中的向量直接从日志读取。"""
+        if self._delta is None:
+            return reconstruct(self.index, ids)
+        rows = self.rows_of(ids) - self._index_rows
+        in_log = rows >= 0
+        out = np.empty((len(ids), self.index.d), dtype="float32")
+        out[in_log] = self._log.gather(rows[in_log])
+        if not in_log.all():
+            out[~in_log] = reconstruct(self.index, ids[~in_log])
+        return out
+
+    def add(self, embeddings: np.ndarray, docs: List) -> np.ndarray:
+        """加入一批向量；docs 为对应的文本或 Chunk（带来源与偏移）。返回分配的外部 ID。
+
+        分词与哈希在写锁外完成，写锁内只把这一批追加到索引与各列。
+        """
+        chunks = [as_chunk(d) for d in docs]
+        embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+        hashes = [content_hash(c.text) for c in chunks]
+        counts = LexicalIndex.analyze(c.text for c in chunks) if self.lexical is not None else None
+        self._writable()
+        with self._rw.write():
+            ids = np.arange(self.next_id, self.next_id + len(chunks), dtype=np.int64)
+            self.index.add_with_ids(embeddings, ids)
+            self._log.extend(embeddings)
+            if self.vectors is not None:
+                self.vectors.extend(embeddings)
+            self.next_id += len(chunks)
+            self.docs.extend(c.text for c in chunks)
+            if self.lexical is not None:
+                self.lexical.add_counts(counts)
+            self.ids.extend(ids.tolist())
+            self.chunks.extend(chunks)
+            self.tags.extend(c.tags for c in chunks)
+            self.timestamps.extend(c.timestamp for c in chunks)
+            self.hashes.extend(hashes)
+            if self._hash_set is not None:
+                self._hash_set.update(hashes)
+            self._invalidate()
+        if self.lexical is not None and self.lexical.needs_merge():
+            lexical = self.lexical.merged()
+            with self._rw.write():
+                self.lexical = lexical
+        self._maybe_promote()
+        return ids
+
+    def _invalidate(self) -> None:
+        """写入后丢弃按当前状态缓存的在线掩码、墓碑选择器与编译好的过滤条件（须持有写锁）。"""
+        self._selector = None
+        self._live = None
+        with self._filters_lock:
+            self._filters.clear()
+
+    def delete(self, doc_ids: Iterable[int]) -> int:
+        """删除（记墓碑），返回实际删除的文档数；向量在压缩时才真正移除。"""
+        removed = 0
+        with self._rw.write():
+            for doc_id in doc_ids:
+                row = self.row_of(doc_id)
+                if row < 0:
+                    continue
+                self.deleted.add(int(doc_id))
+                if self._hash_set is not None:
+                    self._hash_set.discard(int(self.hashes[row]))
+                removed += 1
+            if removed:
+                self._deleted_dirty = True
+                self._invalidate()
+        return removed
+
+    @_reader
+    def ids_of_source(self, source: str) -> np.ndarray:
+        """某个来源当前在线的全部文档 ID。"""
+        src = self.chunks.source_id(source)
+        if src < 0:
+            return np.zeros(0, dtype=np.int64)
+        ids = self.ids.array()[self.chunks.rows.array()["source"] == src]
+        return np.array([i for i in ids.tolist() if i not in self.deleted], dtype=np.int64)
+
+    def dead_ratio(self) -> float:
+        return len(self.deleted) / len(self.docs) if len(self.docs) else 0.0
+
+    @_reader
+    def memory_usage(self) -> Dict[str, int]:
+        """各部分常驻内存的大致字节数，total 为合计。
+
+        索引总是全部计入：检索要扫描全部编码，内存映射的页面同样常驻；
+        文档、各列与原始向量只计未映射的部分（映射的部分只在命中时读取，可被系统回收）。
+        """
+        usage = {
+            "index": index_bytes(self.index) + self._log.nbytes()
+                     + (index_bytes(self._delta) if self._delta is not None else 0),
+            "docs": self.docs.nbytes(),
+            "columns": sum(col.nbytes() for col in (self.ids, self.hashes, self.timestamps,
+                                                     self.chunks.rows)) + self.tags.nbytes(),
+            "vectors": self.vectors.nbytes() if self.vectors is not None else 0,
+            "lexical": self.lexical.nbytes() if self.lexical is not None else 0,
+        }
+        usage["total"] = sum(usage.values())
+        return usage
+
+    @_reader
+    def live_ids(self) -> Tuple[np.ndarray, np.ndarray]:
+        """在线文档的 (外部 ID, 时间戳)，按行序（即加入顺序）排列。"""
+        live = self._live_mask()
+        return self.ids.array()[live], self.timestamps.array()[live]
+
+    @_reader
+    def export(self, doc_ids: Sequence[int]) -> Tuple[np.ndarray, List[Chunk]]:
+        """按外部 ID 取出在线片段的向量与完整的 Chunk（文本、来源、偏移、标签、时间），用于迁移到另一个向量库。
+
+        不存在或已删除的 ID 被跳过。
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        rows = self.rows_of(doc_ids)
+        keep = (rows >= 0) & ~np.isin(doc_ids, list(self.deleted))
+        chunks = [Chunk(self.docs[r], *self.chunks[r], tuple(self.tags[r]), int(self.timestamps[r]))
+                  for r in rows[keep].tolist()]
+        return self.vectors_of(doc_ids[keep]), chunks
+
+    def prepare_compaction(self) -> _Compacted:
+        """构建去掉全部墓碑后的新索引与各列（不修改当前状态，可在后台线程执行，期间检索照常进行）。"""
+        removed = set(self.deleted)
+        dead = np.fromiter(removed, dtype=np.int64, count=len(removed))
+        if index_kind(self.index) == "hnsw":
+            # HNSW 不支持删除，取出在线向量重建（有原始向量时用原始向量，避免编码误差累积）
+            ids, vectors = self._all_vectors()
+            keep = ~np.isin(ids, dead)
+            index = build_index("hnsw", vectors[keep], ids[keep], codec=index_codec(self.index))
+        else:
+            # mmap 只读加载的索引不能原地修改，从磁盘读一份内存副本
+            if self._mapped:
+                index = self._read_index()
+            else:
+                index = clone_index(self.index)
+            ivf = faiss.try_extract_index_ivf(index) if isinstance(index, faiss.Index) else None
+            if ivf is not None:
+                # 哈希 direct map（见 index_factory.reconstruct）只支持按数组删除，先去掉，需要时再建
+                ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+            index.remove_ids(faiss.IDSelectorBatch(dead))
+        keep = ~np.isin(self.ids.array(), dead)
+        vectors = self.vectors.take(keep) if self.vectors is not None else None
+        lexical = self.lexical.take(keep) if self.lexical is not None else None
+        return _Compacted(index, self.docs.take(keep), self.ids.take(keep),
+                          self.chunks.take(keep), self.hashes.take(keep), self.tags.take(keep),
+                          self.timestamps.take(keep), vectors, lexical, removed)
+
+    def finish_compaction(self, compacted: _Compacted) -> None:
+        """切换到 prepare_compaction 的结果；期间新增的墓碑会保留下来。"""
+        with self._rw.write():
+            self.index = compacted.index
+            self.docs = compacted.docs
+            self.ids = compacted.ids
+            self.chunks = compacted.chunks
+            self.hashes = compacted.hashes
+            self.tags = compacted.tags
+            self.timestamps = compacted.timestamps
+            self.vectors = compacted.vectors
+            self.lexical = compacted.lexical
+            self.deleted -= compacted.removed
+            self._invalidate()
+            self._mapped = False
+            self._delta = None
+            self._index_dirty = True
+            self._deleted_dirty = True
+            self._index_rows = len(self.docs)
+            self._log = Column(np.float32, width=self.index.d)
+
+    def unique_chunks(self, chunks: Iterable[Chunk], counts: Dict[str, int]) -> Iterator[Chunk]:
+        """过滤掉与库中（或本批前面）内容完全相同的块，在嵌入之前就省掉重复的请求。
+
+        counts["skipped"] 累计被跳过的块数。
+        """
+        live = self._live_hashes()
+        seen: Set[int] = set()
+        for c in chunks:
+            h = content_hash(c.text)
+            if h in live or h in seen:
+                counts["skipped"] = counts.get("skipped", 0) + 1
+                continue
+            seen.add(h)
+            yield c
+
+    @_reader
+    def _live_hashes(self) -> Set[int]:
+        if self._hash_set is None:
+            live = ~np.isin(self.ids.array(), list(self.deleted))
+            self._hash_set = set(self.hashes.array()[live].tolist())
+        return self._hash_set
+
+    @_reader
+    def known_hashes(self, hashes: Sequence[int]) -> np.ndarray:
+        """哪些内容哈希已在库中（在线文档），供分片模式跨分片去重。"""
+        live = self._live_hashes()
+        return np.fromiter((h in live for h in hashes), dtype=bool, count=len(hashes))
+
+    @_reader
+    def novel_mask(self, embeddings: np.ndarray, threshold: float) -> np.ndarray:
+        """近重复抑制：与库中或本批前面向量的余弦相似度 >= threshold 的位置为 False。
+
+        假定嵌入已归一化（OpenAI / 百炼的嵌入均为单位向量），此时余弦 = 1 - L2² / 2。
+        """
+        emb = np.ascontiguousarray(embeddings, dtype="float32")
+        keep = np.ones(len(emb), dtype=bool)
+        if threshold <= 0 or len(emb) == 0:
+            return keep
+        if len(self):
+            D, _ = self.search(emb, 1)
+            keep &= 1 - D[:, 0] / 2 < threshold
+        # 批内两两比较，只与排在前面且被保留的向量比
+        sims = emb @ emb.T
+        for i in range(1, len(emb)):
+            if keep[i] and np.any(sims[i, :i][keep[:i]] >= threshold):
+                keep[i] = False
+        return keep
+
+    def _all_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """索引中全部向量（含墓碑）的 (外部 ID, 向量)，优先使用原始向量。"""
+        if self.vectors is not None:
+            return self.ids.array(), np.asarray(self.vectors.array())
+        ids, vectors = export_vectors(self.index)
+        if self._delta is not None:
+            ids = np.concatenate([ids, self.ids.array()[self._index_rows:]])
+            vectors = np.concatenate([vectors, self._log.array()])
+        return ids, vectors
+
+    def _maybe_promote(self) -> None:
+        if index_kind(self.index) == self.kind and index_codec(self.index) == self.codec:
+            return
+        if self.vectors is None and not isinstance(self.index, faiss.IndexIDMap):
+            # 已训练的 IVF 索引无法导出全部向量，也没有原始向量可用，保持现状
+            return
+        if self.index.ntotal >= self.promote_at:
+            # 在写锁外训练、构建新索引（写操作串行，期间不会有新的行），再原子地换上
+            ids, vectors = self._all_vectors()
+            index = build_index(self.kind, vectors, ids, codec=self.codec)
+            with self._rw.write():
+                self.index = index
+                self._index_dirty = True
+                self._invalidate()
+
+    @_reader
+    def context(self, doc_id: int, window: int = 1) -> str:
+        """把文档块与同一来源中前后各 window 个相邻在线块拼接（按偏移去掉重叠部分）；ID 不存在或已删除时抛出 KeyError。"""
+        i = self._row(doc_id)
+        source, _, _ = self.chunks[i]
+        if not source or window <= 0:
+            return self.docs[i]
+
+        def neighbours(step: int) -> List[int]:
+            rows, j = [], i + step
+            while 0 <= j < len(self.docs) and len(rows) < window and self.chunks[j][0] == source:
+                if int(self.ids[j]) not in self.deleted:
+                    rows.append(j)
+                j += step
+            return rows
+
+        text, end = "", None
+        for j in neighbours(-1)[::-1] + [i] + neighbours(1):
+            _, start, stop = self.chunks[j]
+            doc = self.docs[j]
+            if end is None or start >= end:
+                text += doc if end is None or start == end else "……" + doc
+            elif stop > end:
+                text += doc[end - start:]
+            end = stop if end is None else max(end, stop)
+        return text
+
+    def _live_mask(self) -> np.ndarray:
+        """按行的在线（未删除）掩码。"""
+        if self._live is None:
+            dead = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+            self._live = ~np.isin(self.ids.array(), dead)
+        return self._live
+
+    def _compile(self, filters: Dict[str, Any]) -> Tuple[np.ndarray, faiss.IDSelector]:
+        """过滤表达式 -> (在线且满足条件的行掩码, 按外部 ID 的位图选择器)，结果缓存到下一次写入。"""
+        key = json.dumps(filters, sort_keys=True, ensure_ascii=False)
+        with self._filters_lock:
+            hit = self._filters.get(key)
+        if hit is None:
+            mask = compile_filter(filters, self.chunks.sources, self.chunks.rows.array()["source"],
+                                  self.tags, self.timestamps.array())
+            mask &= self._live_mask()
+            bits = np.zeros(max(self.next_id, 1), dtype=bool)
+            bits[self.ids.array()[mask]] = True
+            bitmap = np.packbits(bits, bitorder="little")
+            # 选择器只保存指针，bitmap 必须与它一起缓存
+            hit = (mask, bitmap, faiss.IDSelectorBitmap(len(bits), faiss.swig_ptr(bitmap)))
+            with self._filters_lock:
+                if len(self._filters) >= FILTER_CACHE_SIZE:
+                    self._filters.pop(next(iter(self._filters)))
+                self._filters[key] = hit
+        return hit[0], hit[2]
+
+    @_reader
+    def search(self, query: np.ndarray, top_k: int, nprobe: int = 0, ef_search: int = 0,
+               filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """检索，返回 (距离, 外部 ID)，已删除的文档在 FAISS 内部被过滤；不足 top_k 时 ID 为 -1。
+
+        nprobe / ef_search 为 0 时使用索引默认值；filters 为元数据过滤表达式（见 metadata_filter）。
+        """
+        check_top_k(top_k)
+        query = np.ascontiguousarray(query, dtype="float32")
+        if filters:
+            mask, sel = self._compile(filters)
+            rows = np.flatnonzero(mask)
+            if len(rows) <= FILTER_EXACT_AT and (
+                    self.vectors is not None or isinstance(self.index, faiss.IndexIDMap2)):
+                return self._search_rows(query, rows, top_k)
+        else:
+            if self.deleted and self._selector is None:
+                dead = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+                self._selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(dead))
+            sel = self._selector if self.deleted else None
+        params = search_params(self.index, nprobe, ef_search, sel)
+        codec = index_codec(self.index)
+        if codec == "binary" and self.vectors is not None:
+            # 汉明距离不能直接作为结果：先粗筛出足够多的候选，再读原始向量精确重排
+            fetch = max(top_k * self.rescore, BINARY_CANDIDATES)
+        elif self.rescore > 1 and self.vectors is not None and codec != "float32":
+            fetch = top_k * self.rescore
+        else:
+            return self._search_index(query, top_k, params, sel)
+        _, cand = self._search_index(query, fetch, params, sel, merge=False)
+        rows = self.rows_of(cand)
+        rows[cand < 0] = 0
+        return rerank_exact(query, cand, self.vectors.gather(rows), top_k)
+
+    def _search_index(self, query: np.ndarray, k: int, params: Optional[faiss.SearchParameters],
+                      sel: Optional[faiss.IDSelector], merge: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """在索引中检索 k 个结果；另建了日志小索引时同时检索它，merge 为 True 时按距离合并取前 k 个，
+        否则把两边的结果拼在一起（候选由调用方精确重排）。
+        """
+        D, I = self.index.search(query, k, params=params)
+        if self._delta is None:
+            return D, I
+        log_D, log_I = self._delta.search(query, k, params=search_params(self._delta, sel=sel))
+        D = np.hstack([D.astype("float32"), log_D])
+        I = np.hstack([I, log_I])
+        if not merge:
+            return D, I
+        order = np.argsort(D, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+    def _search_rows(self, query: np.ndarray, rows: np.ndarray,
+                     top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """只在 rows 这些行中精确检索（原始向量优先，否则从 IDMap2 索引中按 ID 还原）。"""
+        D = np.full((len(query), top_k), np.finfo("float32").max, dtype="float32")
+        I = np.full((len(query), top_k), -1, dtype=np.int64)
+        if not len(rows):
+            return D, I
+        ids = self.ids.gather(rows)
+        if self.vectors is not None:
+            vectors = self.vectors.gather(rows)
+        else:
+            vectors = self._reconstruct(ids)
+        k = min(top_k, len(rows))
+        D[:, :k], pos = faiss.knn(query, np.ascontiguousarray(vectors, dtype="float32"), k)
+        I[:, :k] = ids[pos]
+        return D, I
+
+    @_reader
+    def search_lexical(self, queries: List[str], top_k: int,
+                       filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 检索，返回 (分数, 外部 ID) 两个 (查询数, top_k) 数组，分数越大越相关；不足时 ID 为 -1。"""
+        check_top_k(top_k)
+        if self.lexical is None:
+            raise ValueError("未启用词法索引（lexical=False），不能使用词法 / 混合检索")
+        if filters:
+            mask = self._compile(filters)[0]
+        else:
+            mask = self._live_mask() if self.deleted else None
+        D = np.zeros((len(queries), top_k), dtype=np.float32)
+        I = np.full((len(queries), top_k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            scores, rows = self.lexical.search(query, top_k, mask)
+            D[i, :len(rows)] = scores
+            I[i, :len(rows)] = self.ids.gather(rows)
+        return D, I
+
+    @_reader
+    def search_hybrid(self, query: np.ndarray, texts: List[str], top_k: int,
+                      fusion: str = "rrf", alpha: float = 0.5, fetch_factor: int = 4,
+                      nprobe: int = 0, ef_search: int = 0,
+                      filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """向量 + BM25 混合检索：两路各取 top_k * fetch_factor 个候选再融合。
+
+        返回 (融合分数, 外部 ID)，分数越大越相关；fusion / alpha 见 lexical_index.fuse。
+        """
+        check_top_k(top_k)
+        fetch = top_k * max(1, fetch_factor)
+        vec_D, vec_I = self.search(query, fetch, nprobe=nprobe, ef_search=ef_search, filters=filters)
+        lex_D, lex_I = self.search_lexical(texts, fetch, filters=filters)
+        D = np.zeros((len(texts), top_k), dtype=np.float32)
+        I = np.full((len(texts), top_k), -1, dtype=np.int64)
+        for i in range(len(texts)):
+            found = lex_I[i] >= 0
+            scores, ids = fuse(vec_I[i], vec_D[i], lex_I[i][found], lex_D[i][found],
+                               top_k, fusion, alpha)
+            D[i, :len(ids)] = scores
+            I[i, :len(ids)] = ids
+        return D, I
+
+    def save(self) -> None:
+        """保存到 self.path：只追加的文件原地追加新增部分，需要整体重写的先写临时文件，
+        在快照锁内逐个替换，最后写版本头（记录各文件已提交的区域，替换成功才算提交）。
+
+        开销与上次保存以来新增的文档数成正比：索引只在 _fold_index 时整体重写，否则新增向量追加到日志；
+        校验和在上次的值上续算追加的字节。保存后改为内存映射刚写出的文件，新增的数据不再常驻内存。
+        """
+        if not self.path:
+            return
+        path = self.path
+        os.makedirs(path, exist_ok=True)
+        names = self.docs.write(path)
+        names += self.ids.write(path, IDS_FILE)
+        names += self.chunks.write(path)
+        names += self.hashes.write(path, HASHES_FILE)
+        names += self.timestamps.write(path, TIMESTAMPS_FILE)
+        names += self.tags.write(path)
+        if self.vectors is not None:
+            names += self.vectors.write(path, VECTORS_FILE)
+        lexical_names = self.lexical.write(path) if self.lexical is not None else []
+        names += lexical_names
+        if self._deleted_dirty or not os.path.exists(os.path.join(path, DELETED_FILE)):
+            with open(os.path.join(path, DELETED_FILE + ".tmp"), "wb") as f:
+                np.save(f, np.array(sorted(self.deleted), dtype=np.int64))
+            names.append(DELETED_FILE)
+        if self._fold_index():
+            self._writable()
+            write_index(self.index, os.path.join(path, INDEX_FILE + ".tmp"))
+            names.append(INDEX_FILE)
+            names += Column(np.float32, width=self.index.d).write(path, INDEX_LOG_FILE)
+            index_rows = len(self.docs)
+        else:
+            names += self._log.write(path, INDEX_LOG_FILE)
+            index_rows = self._index_rows
+        # 替换文件到写完版本头之间持排他锁，其他进程不会打开到新旧混杂的文件
+        with _snapshot_lock(path, exclusive=True):
+            for name in names:
+                os.replace(os.path.join(path, name + ".tmp"), os.path.join(path, name))
+
+            self._remap(index_rows, reload_lexical=bool(lexical_names))
+            files = self._checksums(set(names))
+            meta = {
+                "magic": MAGIC,
+                "version": FORMAT_VERSION,
+                "dim": self.index.d,
+                "ntotal": self._ntotal(),
+                "ndocs": len(self.docs),
+                "next_id": self.next_id,
+                "generation": self.generation + 1,
+                "doc_compression": self.docs.compression,
+                "index_rows": self._index_rows,
+                "files": files,
+            }
+            tmp = os.path.join(path, META_FILE + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, os.path.join(path, META_FILE))
+            self.generation += 1
+            self._files = files
+            self._index_dirty = False
+            self._deleted_dirty = False
+            if self.docs.compression == "none" and os.path.exists(os.path.join(path, DOC_BLOCKS_FILE)):
+                # 从压缩格式转换回来后，旧的块表已无用
+                os.remove(os.path.join(path, DOC_BLOCKS_FILE))
+
+    def _fold_index(self) -> bool:
+        """本次保存是否整体重写索引：有追加以外的变化、还没写过，或追加日志超过阈值。"""
+        if self._index_dirty or not os.path.exists(os.path.join(self.path, INDEX_FILE)):
+            return True
+        limit = min(INDEX_LOG_MAX_BYTES // (4 * self.index.d), INDEX_LOG_RATIO * self._index_rows)
+        return len(self._log) > limit
+
+    def _regions(self) -> Dict[str, Tuple[int, int]]:
+        """各数据文件已提交的区域 (数据起始偏移, 字节数)：.npy 列不含文件头，只追加的文件到已提交的长度为止。"""
+        path = self.path
+        arrays = {IDS_FILE: self.ids._base, HASHES_FILE: self.hashes._base,
+                  TIMESTAMPS_FILE: self.timestamps._base, CHUNKS_FILE: self.chunks.rows._base,
+                  INDEX_LOG_FILE: self._log._base, OFFSETS_FILE: self.docs._offsets,
+                  TAG_OFFSETS_FILE: self.tags._offsets, TAG_IDS_FILE: self.tags._ids}
+        if self.docs._blocks is not None:
+            arrays[DOC_BLOCKS_FILE] = self.docs._blocks
+        if self.vectors is not None:
+            arrays[VECTORS_FILE] = self.vectors._base
+        regions = {name: (_npy_offset(os.path.join(path, name)), arr.nbytes) for name, arr in arrays.items()}
+        regions[DOCS_FILE] = (0, len(self.docs._blob))
+        regions[SOURCES_FILE] = (0, self.chunks.size)
+        whole = [INDEX_FILE, DELETED_FILE, TAG_NAMES_FILE]
+        if self.lexical is not None:
+            whole.extend(name for name in LEXICAL_FILES if name != LEXICAL_LOG_FILE)
+            regions[LEXICAL_LOG_FILE] = (0, self.lexical.log_size)
+        for name in whole:
+            regions[name] = (0, os.path.getsize(os.path.join(path, name)))
+        return regions
+
+    def _checksums(self, replaced: Set[str]) -> Dict[str, List[int]]:
+        """各数据文件的 [数据起始偏移, 字节数, CRC32]：本次整体重写的文件完整计算，原地追加的只续算追加的字节。"""
+        files = {}
+        for name, (offset, size) in self._regions().items():
+            file = os.path.join(self.path, name)
+            old = self._files.get(name)
+            if name in replaced or old is None or old[0] != offset or old[1] > size:
+                crc = _crc32(file, offset, size)
+            else:
+                crc = _crc32(file, offset + old[1], size - old[1], old[2])
+            files[name] = [offset, size, crc]
+        return files
+
+    def _remap(self, index_rows: int, reload_lexical: bool) -> None:
+        """把刚保存的各列重新以内存映射方式打开，释放内存中的新增部分；打开后在写锁内一起换上。
+
+        来源名与只追加了日志的倒排索引不必重新读入，沿用内存中的对象。
+        """
+        path = self.path
+        n = len(self.docs)
+        columns = dict(docs=DocStore.load(path, self.docs.compression, n=n),
+                       ids=Column.load(path, IDS_FILE, np.int64, rows=n),
+                       hashes=Column.load(path, HASHES_FILE, np.int64, rows=n),
+                       tags=TagTable.load(path, n),
+                       timestamps=Column.load(path, TIMESTAMPS_FILE, np.int64, rows=n),
+                       _log=Column.load(path, INDEX_LOG_FILE, np.float32, self.index.d, rows=n - index_rows),
+                       _index_rows=index_rows)
+        chunk_rows = Column.load(path, CHUNKS_FILE, CHUNK_DTYPE, rows=n)
+        if self.vectors is not None:
+            columns["vectors"] = Column.load(path, VECTORS_FILE, np.float32, self.index.d, rows=n)
+        if reload_lexical:
+            columns["lexical"] = LexicalIndex.load(path, 0)
+        with self._rw.write():
+            for name, value in columns.items():
+                setattr(self, name, value)
+            self.chunks.rows = chunk_rows
+
+    def refresh(self) -> bool:
+        """切换到其他进程保存的新快照（磁盘上的快照代数与当前不同时），返回是否切换。
+
+        新快照先以内存映射方式完整打开，再在写锁内一次换上，检索看到的要么是旧快照要么是新快照。
+        只用于不写入的进程：本进程尚未保存的改动会被丢弃。
+        """
+        if not self.path or read_generation(self.path) == self.generation:
+            return False
+        fresh = RagStore.open(self.path, dim=self.index.d, kind=self.kind, promote_at=self.promote_at,
+                              codec=self.codec, rescore=self.rescore, lexical=self.lexical is not None,
+                              doc_compression=self.docs.compression)
+        with self._rw.write():
+            for name in ("index", "docs", "ids", "chunks", "hashes", "tags", "timestamps", "vectors",
+                         "lexical", "deleted", "next_id", "generation", "_mapped", "_index_rows", "_log",
+                         "_delta", "_files"):
+                setattr(self, name, getattr(fresh, name))
+            self._index_dirty = False
+            self._hash_set = None
+            self._invalidate()
+        return True
@@ -1,55 +1,560 @@
-from typing import Any, List
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+import asyncio
+import json
 import os
-import faiss
+import time
 import numpy as np
-from openai import OpenAI
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
 from dotenv import load_dotenv
+from rag_store import RagStore
+from sharded_store import ShardedStore
+from shared_index import SharedIndex
+from tiered_store import TieredStore, process_rss
+from embed_cache import EmbeddingCache
+from chunking import Chunk, chunk_text
+from embedding import HashingEmbedder, OpenAIEmbedder, embed_in_batches
+from query_batcher import QueryBatcher, select_hits
+from metadata_filter import FilterError, parse_time
+from ingest_queue import IngestQueue, Job, QueueFull
+from path_source import map_ordered, read_file_chunks, resolve_paths
 print("load_dotenv")
 load_dotenv()
 
 # 初始化 MCP Server
 mcp = FastMCP("rag")
 
-# 向量索引（内存版 FAISS）
-_index: faiss.IndexFlatL2 = faiss.IndexFlatL2(1536)
-_docs: List[str] = []
+# 向量索引（FAISS），设置 RAG_INDEX_PATH 后持久化到该目录，重启时内存映射加载
+# RAG_INDEX_TYPE: flat / ivf_flat / ivf_pq / hnsw；RAG_PROMOTE_AT: 文档数超过该值后由 Flat 升级为 IVF
+#   （不低于训练样本数：IVF 为 24336，更小的值按 24336 处理并记录警告）
+# RAG_CODEC: 向量存储编码 float32 / fp16 / sq8 / pq / binary；RAG_RESCORE: 有损编码下精确重排的候选倍数（0 表示不重排）
+# RAG_DOC_COMPRESSION: 文档区按块压缩 none / zlib / zstd（zstd 需要安装 zstandard）
+_store_options = dict(dim=1536,
+                      verify=os.getenv("RAG_VERIFY_INDEX") == "1",
+                      kind=os.getenv("RAG_INDEX_TYPE", "flat"),
+                      promote_at=int(os.getenv("RAG_PROMOTE_AT", "0")),
+                      codec=os.getenv("RAG_CODEC", "float32"),
+                      rescore=int(os.getenv("RAG_RESCORE", "0")),
+                      lexical=os.getenv("RAG_LEXICAL", "1") == "1",
+                      doc_compression=os.getenv("RAG_DOC_COMPRESSION", "none"))
+# RAG_SHARDS > 1 时启用分片模式：每个分片一个工作进程，检索并行分发后合并；RAG_SHARD_THREADS 为每个分片的线程数
+SHARDS = int(os.getenv("RAG_SHARDS", "1"))
+# RAG_MEMORY_BUDGET_MB > 0 时限制向量库的常驻内存：写入后检查，超出时按 RAG_EVICTION（lru / fifo / ttl）淘汰片段；
+# RAG_EVICTION=ttl 且 RAG_TTL_S > 0 时，时间戳早于 RAG_TTL_S 秒之前的片段无论是否超出预算都淘汰（另每 RAG_EVICT_CHECK_S 秒检查一次）；
+# 淘汰的片段默认溢出到 RAG_INDEX_PATH/spill 仍可检索，RAG_SPILL=0 时直接丢弃（见 tiered_store.py）
+MEMORY_BUDGET = int(float(os.getenv("RAG_MEMORY_BUDGET_MB", "0")) * (1 << 20))
+TTL = float(os.getenv("RAG_TTL_S", "0"))
+EVICTION = os.getenv("RAG_EVICTION", "lru")
+if TTL > 0 and EVICTION != "ttl":
+    raise ValueError(f"RAG_TTL_S 只对 RAG_EVICTION=ttl 生效（当前为 {EVICTION}），请同时设置 RAG_EVICTION=ttl")
+if SHARDS > 1:
+    if MEMORY_BUDGET > 0 or TTL > 0:
+        raise ValueError("RAG_MEMORY_BUDGET_MB / RAG_TTL_S 暂不支持分片模式（RAG_SHARDS > 1）")
+    _store = ShardedStore.open(os.getenv("RAG_INDEX_PATH"), SHARDS,
+                               threads=int(os.getenv("RAG_SHARD_THREADS", "0")), **_store_options)
+elif MEMORY_BUDGET > 0 or TTL > 0:
+    _store = TieredStore.open(os.getenv("RAG_INDEX_PATH"), MEMORY_BUDGET,
+                              EVICTION, ttl=TTL,
+                              spill=os.getenv("RAG_SPILL", "1") == "1",
+                              check_every=float(os.getenv("RAG_EVICT_CHECK_S", "60")), **_store_options)
+else:
+    _store = RagStore.open(os.getenv("RAG_INDEX_PATH"), **_store_options)
+# RAG_SHARED=1 时多个服务进程（每个 stdio 客户端一个）共享 RAG_INDEX_PATH：一个写进程负责写入并发布快照，
+# 其余进程内存映射只读，每隔 RAG_SHARED_POLL 秒切换到最新快照，写进程退出后自动接管（见 shared_index.py）
+_shared: Optional[SharedIndex] = None
+if os.getenv("RAG_SHARED", "0") == "1":
+    if not isinstance(_store, RagStore):
+        raise ValueError("RAG_SHARED 暂不支持分片模式与内存预算（RAG_SHARDS > 1 / RAG_MEMORY_BUDGET_MB / RAG_TTL_S）")
+    _shared = SharedIndex(_store, poll=float(os.getenv("RAG_SHARED_POLL", "1")))
+_tiered: Optional[TieredStore] = _store if isinstance(_store, TieredStore) else None
 
-# OpenAI API（用于生成嵌入）
-openai = OpenAI()
+# 文档切块：每块约 RAG_CHUNK_TOKENS 个 token（0 表示不切块），相邻块重叠 RAG_CHUNK_OVERLAP 个 token
+CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "400"))
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "50"))
+# 入库去重：内容完全相同的片段总是跳过；RAG_NEAR_DUP > 0 时再跳过余弦相似度不低于该值的近重复片段
+NEAR_DUP = float(os.getenv("RAG_NEAR_DUP", "0"))
+# 墓碑（已删除但未移除的向量）占比超过 RAG_COMPACT_RATIO 时在后台压缩重建
+COMPACT_RATIO = float(os.getenv("RAG_COMPACT_RATIO", "0.2"))
 
-async def embed_text(texts: List[str]) -> np.ndarray:
-    resp = openai.embeddings.create(
-        model="text-embedding-3-small",
-        input=texts,
-        encoding_format="float"
-    )
-    return np.array([d.embedding for d in resp.data], dtype='float32')
+# 写操作（入库 / 删除 / 压缩）串行执行，并与检索一样放在线程中运行、不阻塞事件循环；
+# 向量库内部的读写锁保证检索只在一批新行提交的瞬间等待，且不会看到写了一半的状态
+_write_lock = asyncio.Lock()
+_background: set = set()
+# 排队中或正在执行的淘汰任务（同一时刻最多一个）
+_eviction: Optional[asyncio.Task] = None
+
+# 入库队列：index_docs / upsert_docs 按提交顺序在后台逐个执行，最多 RAG_INGEST_QUEUE 个任务排队；
+# RAG_INGEST_BACKGROUND=1 时 index_docs 默认立即返回任务 ID（可用 background 参数逐次指定），进度用 job_status 查询
+_ingest_queue = IngestQueue(max_pending=int(os.getenv("RAG_INGEST_QUEUE", "16")),
+                            keep=int(os.getenv("RAG_INGEST_KEEP", "100")))
+INGEST_BACKGROUND = os.getenv("RAG_INGEST_BACKGROUND", "0") == "1"
+# index_path：服务端直接读取文件入库（见 path_source.py），只允许读取 RAG_INGEST_ROOTS（以 os.pathsep 分隔，默认为当前目录）之下的文件；
+# RAG_READ_WORKERS 个文件并行读取切块，超过 RAG_INGEST_MAX_FILE_MB 的文件跳过；每攒够 INGEST_GROUP 个片段就去重、嵌入、加入一组
+INGEST_ROOTS = [root for root in os.getenv("RAG_INGEST_ROOTS", os.getcwd()).split(os.pathsep) if root]
+READ_WORKERS = int(os.getenv("RAG_READ_WORKERS", "8"))
+MAX_FILE_BYTES = int(float(os.getenv("RAG_INGEST_MAX_FILE_MB", "50")) * (1 << 20))
+INGEST_GROUP = 1024
+
+# OpenAI API（用于生成嵌入），异步客户端不会阻塞事件循环
+# RAG_EMBED_CONCURRENCY: 同时在途的嵌入请求上限
+# RAG_EMBED_BACKEND=hash 时改用本地确定性嵌入（不需要网络，仅用于压测 / 基准测试）
+if os.getenv("RAG_EMBED_BACKEND", "openai") == "hash":
+    _embed_remote = HashingEmbedder(dim=1536,
+                                    max_concurrency=int(os.getenv("RAG_EMBED_CONCURRENCY", "4")))
+else:
+    _embed_remote = OpenAIEmbedder(model="text-embedding-3-small",
+                                   max_concurrency=int(os.getenv("RAG_EMBED_CONCURRENCY", "4")))
+
+# 嵌入缓存：RAG_EMBED_CACHE 为 SQLite 文件路径（默认仅进程内缓存）
+_embed_cache = EmbeddingCache(os.getenv("RAG_EMBED_CACHE", ":memory:"),
+                              model=_embed_remote.model, dim=1536,
+                              max_entries=int(os.getenv("RAG_EMBED_CACHE_SIZE", "50000")))
+
+async def _embed_split(texts: List[str]) -> np.ndarray:
+    """按服务商单次请求的条数上限切开（合并的查询批可能超过上限），并发请求后按顺序拼接。"""
+    n = _embed_remote.max_batch_items
+    parts = await asyncio.gather(*(_embed_remote(texts[i:i + n]) for i in range(0, len(texts), n)))
+    return np.concatenate(parts)
+
+async def embed_text(texts: List[str], counts: Optional[Dict[str, int]] = None) -> np.ndarray:
+    """带缓存的嵌入：只有缓存未命中的文本才会请求嵌入服务；counts 累计本次调用的命中 / 未命中数。"""
+    return await _embed_cache.embed(texts, _embed_split, counts)
+
+# 合并并发的 retrieve_docs：RAG_BATCH_WINDOW_MS 内到达的查询（最多 RAG_BATCH_MAX 条）一起嵌入、一起检索
+# 混合检索：RAG_HYBRID_FUSION 为 rrf（倒数排名融合）或 weighted（按 RAG_HYBRID_ALPHA 加权向量分数）
+# 多样性重排：RAG_MMR_LAMBDA < 1 时默认对结果做 MMR 重排（1 表示不重排），候选数为 top_k 的 RAG_MMR_FETCH 倍
+_batcher = QueryBatcher(_store, embed_text,
+                        window_ms=float(os.getenv("RAG_BATCH_WINDOW_MS", "2")),
+                        max_batch=int(os.getenv("RAG_BATCH_MAX", "32")),
+                        fusion=os.getenv("RAG_HYBRID_FUSION", "rrf"),
+                        alpha=float(os.getenv("RAG_HYBRID_ALPHA", "0.5")),
+                        mmr_lambda=float(os.getenv("RAG_MMR_LAMBDA", "1")),
+                        mmr_fetch=int(os.getenv("RAG_MMR_FETCH", "4")))
+# retrieve_docs 的默认检索模式：vector / lexical / hybrid
+SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "vector")
+# retrieve_docs 的默认结果格式（text / json）与相关性阈值（见 query_batcher.select_hits）
+RESULT_FORMAT = os.getenv("RAG_RESULT_FORMAT", "text")
+MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "-inf"))
+RELATIVE_SCORE = float(os.getenv("RAG_RELATIVE_SCORE", "0"))
+
+def _doc_meta(n: int, tags: Optional[List[List[str]]], timestamps: Optional[List[Any]],
+              sources: Optional[List[str]] = None) -> Tuple[List[Tuple[str, ...]], List[int]]:
+    """校验 sources 的长度，并规范化每篇文档的标签与时间戳（未给出时间的文档记为入库时间）。"""
+    if any(values is not None and len(values) != n for values in (sources, tags, timestamps)):
+        raise FilterError("sources / tags / timestamps 的长度必须与 docs 一致")
+    now = int(time.time())
+    return ([tuple(t) for t in tags] if tags is not None else [()] * n,
+            [parse_time(t) if t not in (None, "") else now for t in timestamps]
+            if timestamps is not None else [now] * n)
+
+async def _ingest(docs: List[str], sources: List[str],
+                  meta: Tuple[List[Tuple[str, ...]], List[int]], job: Job) -> str:
+    counts = {"skipped": 0, "hits": 0, "misses": 0}
+    # 切块与去重（逐片段哈希）按文档总量线性增长，放到线程中，不阻塞事件循环
+    chunks = await asyncio.to_thread(lambda: list(_store.unique_chunks(
+        (c._replace(tags=doc_tags, timestamp=ts)
+         for doc, src, doc_tags, ts in zip(docs, sources, *meta)
+         for c in chunk_text(doc, src, CHUNK_TOKENS, CHUNK_OVERLAP)),
+        counts)))
+    job.advance(0, len(chunks))
+    n_new, n_near = await _add_chunks(chunks, job, counts)
+    await asyncio.to_thread(_store.save)
+    _schedule_eviction(force=True)
+    return (f"新增 {n_new} 个片段，跳过重复 {counts['skipped']} 个、近重复 {n_near} 个，"
+            f"总片段数：{len(_store)}（嵌入缓存命中 {counts['hits']}，未命中 {counts['misses']}）")
+
+def _delete_sources(sources: Iterable[str]) -> int:
+    """删除这些来源的全部片段（同步，在线程中调用），返回删除的片段数。"""
+    return _store.delete([i for src in sources for i in _store.ids_of_source(src).tolist()])
+
+async def _add_chunks(chunks: List[Chunk], job: Job, counts: Dict[str, int]) -> Tuple[int, int]:
+    """嵌入并加入已去重的片段，返回 (新增, 近重复) 片段数；本次的嵌入缓存命中 / 未命中数累加到 counts。"""
+    # 按服务商的单次请求上限切批，流水线并发嵌入，完成一批就按顺序加入一批
+    n_new = n_near = 0
+    async for batch, embeddings in embed_in_batches(
+            chunks, lambda texts: embed_text(texts, counts),
+            max_items=_embed_remote.max_batch_items,
+            max_tokens=_embed_remote.max_batch_tokens,
+            window=_embed_remote.max_concurrency):
+        keep = await asyncio.to_thread(_store.novel_mask, embeddings, NEAR_DUP)
+        kept = [c for c, k in zip(batch, keep) if k]
+        if kept:
+            await asyncio.to_thread(_store.add, embeddings[keep], kept)
+        n_new += len(kept)
+        n_near += len(batch) - len(kept)
+        job.advance(job.done + len(batch))
+    return n_new, n_near
+
+async def _ingest_files(files: List[str], tags: Tuple[str, ...], job: Job) -> str:
+    """流式入库一批文件：并行读取切块，按文件顺序攒够 INGEST_GROUP 个片段就去重、嵌入、加入一组。"""
+    counts = {"skipped": 0, "hits": 0, "misses": 0}
+    n_new = n_near = n_files = 0
+    unreadable: List[str] = []
+    group: List[Chunk] = []
+
+    async def flush() -> None:
+        nonlocal n_new, n_near
+        unique = await asyncio.to_thread(lambda: list(_store.unique_chunks(group, counts)))
+        group.clear()
+        new, near = await _add_chunks(unique, job, counts)
+        n_new += new
+        n_near += near
+
+    def read(path: str) -> Optional[List[Chunk]]:
+        return read_file_chunks(path, CHUNK_TOKENS, CHUNK_OVERLAP, MAX_FILE_BYTES)
+
+    async for path, chunks in map_ordered(read, files, READ_WORKERS):
+        if chunks is None:
+            unreadable.append(path)
+            continue
+        n_files += 1
+        group.extend(c._replace(tags=tags) for c in chunks)
+        if len(group) >= INGEST_GROUP:
+            await flush()
+    if group:
+        await flush()
+    # 全部文件读完才知道片段总数
+    job.advance(job.done, job.done)
+    await asyncio.to_thread(_store.save)
+    _schedule_eviction(force=True)
+    skipped = f"，无法读取或过大而跳过 {len(unreadable)} 个（{', '.join(unreadable[:3])}）" if unreadable else ""
+    return (f"读取 {n_files} 个文件{skipped}；新增 {n_new} 个片段，跳过重复 {counts['skipped']} 个、"
+            f"近重复 {n_near} 个，总片段数：{len(_store)}（嵌入缓存命中 {counts['hits']}，未命中 {counts['misses']}）")
+
+async def _compact() -> None:
+    async with _write_lock:
+        if _store.dead_ratio() < COMPACT_RATIO:
+            return
+        compacted = await asyncio.to_thread(_store.prepare_compaction)
+        await asyncio.to_thread(_store.finish_compaction, compacted)
+        await asyncio.to_thread(_store.save)
+
+async def _report(ctx: Optional[Context], job: Job) -> None:
+    """把任务进度作为 MCP 进度通知发给当前请求（客户端没有要求进度时什么也不做）。"""
+    if ctx is not None:
+        total = job.total or None
+        await ctx.report_progress(job.done, total, f"{job.description}：{job.status}")
+
+async def _run_job(job: Job, ctx: Optional[Context]) -> str:
+    """同步执行：等待排队中的任务完成，期间发送进度通知；任务失败时抛出原异常。"""
+    await _ingest_queue.watch(job, lambda j: _report(ctx, j))
+    if job.error is not None:
+        raise job.error
+    return job.result
+
+async def _notify_when_done(job: Job, ctx: Context) -> None:
+    """后台任务结束后向提交它的会话发一条日志通知（进度通知只能跟随仍在进行的请求）。"""
+    await job.join()
+    try:
+        await ctx.session.send_log_message("info" if job.status == "done" else "error",
+                                           job.to_dict(), logger="rag.ingest")
+    except Exception:
+        # 客户端可能已断开
+        pass
+
+def _sync_shared() -> None:
+    """只读进程：到了检查间隔就在后台切换到写进程发布的新快照，当前请求继续使用旧快照。"""
+    if _shared is not None and _shared.due():
+        task = asyncio.ensure_future(asyncio.to_thread(_shared.sync))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+async def _read_only() -> Optional[str]:
+    """只读进程拒绝写入并返回提示（写进程已退出时先接管写租约）；可以写入时返回 None。"""
+    if _shared is None or _shared.writable:
+        return None
+    await asyncio.to_thread(_shared.sync)
+    if _shared.writable:
+        return None
+    return (f"只读实例：向量库 {_store.path} 由写进程（pid {_shared.lease.holder()}）负责写入，"
+            f"本进程只提供检索，请通过写进程入库")
+
+async def _evict() -> None:
+    async with _write_lock:
+        await asyncio.to_thread(_tiered.evict)
+    # 预算内的淘汰（例如过期片段）只在热层留下墓碑，由常规压缩清理
+    _schedule_compaction()
+
+def _schedule_eviction(force: bool = False) -> None:
+    """有内存预算时在后台淘汰：写入后立即检查，否则每隔 RAG_EVICT_CHECK_S 秒检查一次（过期片段）。"""
+    global _eviction
+    if _tiered is None or not (force or _tiered.due()):
+        return
+    # 已有排队中的淘汰任务时不再重复提交：它拿到写锁时会看到最新的状态
+    if _eviction is None or _eviction.done():
+        _eviction = asyncio.ensure_future(_evict())
+
+def _schedule_compaction() -> None:
+    if _store.dead_ratio() >= COMPACT_RATIO:
+        task = asyncio.ensure_future(_compact())
+        _background.add(task)
+        task.add_done_callback(_background.discard)
 
 @mcp.tool()
-async def index_docs(docs: List[str]) -> str:
-    """将一批文档加入索引。
+async def index_docs(docs: List[str], sources: Optional[List[str]] = None,
+                     tags: Optional[List[List[str]]] = None,
+                     timestamps: Optional[List[Union[str, int]]] = None,
+                     background: Optional[bool] = None, ctx: Context = None) -> str:
+    """将一批文档切块后加入索引。
     Args:
         docs: 文本列表
+        sources: 每篇文档的来源（文件路径 / URI），可选，用于命中后还原上下文及按来源删除 / 更新
+        tags: 每篇文档的标签列表，可选，检索时可按标签过滤
+        timestamps: 每篇文档的时间（ISO 日期或 Unix 秒），可选，默认为入库时间
+        background: 为 true 时立即返回任务 ID，在后台入库，用 job_status 查询进度（适合大批量文档）；
+                    不填时使用服务端默认值
     """
-    global _index, _docs
-    embeddings = await embed_text(docs)
-    _index.add(embeddings.astype('float32'))
-    _docs.extend(docs)
-    return f"已索引 {len(docs)} 篇文档，总文档数：{len(_docs)}"
+    try:
+        meta = _doc_meta(len(docs), tags, timestamps, sources)
+    except FilterError as e:
+        return f"参数错误：{e}"
+    denied = await _read_only()
+    if denied is not None:
+        return denied
+
+    async def run(job: Job) -> str:
+        async with _write_lock:
+            summary = await _ingest(docs, sources or [""] * len(docs), meta, job)
+        return f"已索引 {len(docs)} 篇文档：{summary}"
+
+    return await _submit(run, f"index_docs {len(docs)} 篇文档", background, ctx)
 
 @mcp.tool()
-async def retrieve_docs(query: str, top_k: int = 3) -> str:
+async def index_path(paths: List[str], tags: Optional[List[str]] = None, replace: bool = False,
+                     background: Optional[bool] = None, ctx: Context = None) -> str:
+    """由服务端直接从磁盘读取文件入库：只传路径，不必把全文放进请求，适合批量导入本机文件或 file:// 资源。
+    片段的来源为文件的绝对路径，时间为文件的修改时间。
+    Args:
+        paths: 文件、目录（递归收录 .txt / .md 等文本文件）、file:// URI 或 glob 模式（如 docs/**/*.txt），
+               相对路径相对于服务端允许读取的第一个目录
+        tags: 给这批文件统一加上的标签，可选
+        replace: 为 true 时先删除这些文件已有的全部片段再入库（文件内容有更新时使用）
+        background: 同 index_docs
+    """
+    try:
+        files = await asyncio.to_thread(resolve_paths, paths, INGEST_ROOTS)
+    except ValueError as e:
+        return f"参数错误：{e}"
+    if not files:
+        return "未匹配到任何文件。"
+    denied = await _read_only()
+    if denied is not None:
+        return denied
+
+    async def run(job: Job) -> str:
+        async with _write_lock:
+            removed = 0
+            if replace:
+                removed = await asyncio.to_thread(_delete_sources, files)
+            summary = await _ingest_files(files, tuple(tags or ()), job)
+        return f"已处理 {len(files)} 个文件" + (f"（删除旧片段 {removed} 个）" if replace else "") + f"：{summary}"
+
+    result = await _submit(run, f"index_path {len(files)} 个文件", background, ctx)
+    if replace:
+        _schedule_compaction()
+    return result
+
+async def _submit(run: Callable[[Job], Awaitable[str]], description: str,
+                  background: Optional[bool], ctx: Optional[Context]) -> str:
+    """把入库函数放入队列：后台模式立即返回任务 ID，否则等待完成并返回结果。"""
+    if INGEST_BACKGROUND if background is None else background:
+        try:
+            job = _ingest_queue.submit(run, description)
+        except QueueFull as e:
+            return f"入库队列已满：{e}"
+        if ctx is not None:
+            task = asyncio.ensure_future(_notify_when_done(job, ctx))
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+        return (f"已提交入库任务 {job.id}（前面还有 {_ingest_queue.ahead_of(job)} 个任务），"
+                f"可用 job_status 查询进度")
+    return await _run_job(await _ingest_queue.put(run, description), ctx)
+
+@mcp.tool()
+async def delete_docs(ids: Optional[List[int]] = None, sources: Optional[List[str]] = None) -> str:
+    """按片段 ID（检索结果中方括号内的编号）或来源删除文档。
+    Args:
+        ids: 要删除的片段 ID 列表
+        sources: 要删除的来源列表，该来源的全部片段都会被删除
+    """
+    denied = await _read_only()
+    if denied is not None:
+        return denied
+
+    def run() -> int:
+        targets = list(ids or [])
+        for src in sources or []:
+            targets.extend(_store.ids_of_source(src).tolist())
+        removed = _store.delete(targets)
+        _store.save()
+        return removed
+
+    async with _write_lock:
+        removed = await asyncio.to_thread(run)
+    _schedule_compaction()
+    return f"已删除 {removed} 个片段，剩余片段数：{len(_store)}"
+
+@mcp.tool()
+async def upsert_docs(docs: List[str], sources: List[str],
+                      tags: Optional[List[List[str]]] = None,
+                      timestamps: Optional[List[Union[str, int]]] = None, ctx: Context = None) -> str:
+    """按来源更新文档：先删除每个来源已有的全部片段，再索引新内容。
+    Args:
+        docs: 文本列表
+        sources: 每篇文档的来源（文件路径 / URI），与 docs 一一对应
+        tags: 每篇文档的标签列表，可选
+        timestamps: 每篇文档的时间（ISO 日期或 Unix 秒），可选，默认为入库时间
+    """
+    try:
+        meta = _doc_meta(len(docs), tags, timestamps, sources)
+    except FilterError as e:
+        return f"参数错误：{e}"
+    denied = await _read_only()
+    if denied is not None:
+        return denied
+
+    async def run(job: Job) -> str:
+        # 与排在前面的 index_docs 任务保持提交顺序
+        async with _write_lock:
+            removed = await asyncio.to_thread(_delete_sources, set(sources))
+            summary = await _ingest(docs, sources, meta, job)
+        return f"已更新 {len(set(sources))} 个来源：删除旧片段 {removed} 个，{summary}"
+
+    result = await _run_job(await _ingest_queue.put(run, f"upsert_docs {len(set(sources))} 个来源"), ctx)
+    _schedule_compaction()
+    return result
+
+async def _fetch_hits(results: List[Tuple[np.ndarray, np.ndarray]], mode: str, context: int,
+                      min_score: Optional[float],
+                      relative_score: Optional[float]) -> List[List[Tuple[int, float, str, str]]]:
+    """按阈值选出每条查询的命中 [(ID, 分数, 来源, 文本)]（见 query_batcher.select_hits）。"""
+    selected = [select_hits(D, I, mode,
+                            MIN_SCORE if min_score is None else min_score,
+                            RELATIVE_SCORE if relative_score is None else relative_score)
+                for D, I in results]
+    # 一次取出全部命中片段的来源与文本，检索之后才被删除的片段在这里去掉
+    found = iter(await asyncio.to_thread(_store.fetch, [i for hits in selected for i, _ in hits], context))
+    return [[(i, score, *hit) for (i, score), hit in zip(hits, found) if hit is not None]
+            for hits in selected]
+
+def _hit_dicts(hits: List[Tuple[int, float, str, str]]) -> List[Dict[str, Any]]:
+    return [{"id": i, "score": round(score, 4), "source": source, "text": text}
+            for i, score, source, text in hits]
+
+@mcp.tool()
+async def retrieve_docs(query: str, top_k: int = 3, nprobe: int = 0, ef_search: int = 0,
+                        context: int = 0, mode: str = "",
+                        filters: Optional[Dict[str, Any]] = None,
+                        mmr_lambda: Optional[float] = None, format: str = "",
+                        min_score: Optional[float] = None,
+                        relative_score: Optional[float] = None) -> str:
     """检索最相关文档片段。
     Args:
         query: 用户查询
         top_k: 返回的文档数
+        nprobe: IVF 索引每次查询扫描的聚类数，0 表示使用默认值
+        ef_search: HNSW 索引的搜索宽度，0 表示使用默认值
+        context: 每个命中片段前后各拼接多少个同源相邻片段，0 表示只返回片段本身
+        mode: 检索模式，vector（向量）/ lexical（BM25 关键词）/ hybrid（两者融合，适合药名、数值阈值等精确词），
+              为空时使用服务端默认值
+        filters: 元数据过滤条件（JSON 对象），可选，例如
+                 {"source_prefix": "guidelines/", "tags": ["心内科"], "after": "2024-01-01"}；
+                 支持 source / source_prefix / tags / tags_all / after / before / or / not
+        mmr_lambda: 多样性重排（MMR）中相关性的权重，0~1，越小结果越分散，1 表示不重排；
+                    不填时使用服务端默认值。命中片段内容相近时可设为 0.5 左右
+        format: 结果格式，text（"[ID] 片段" 拼接的文本）或 json（[{id, score, source, text}] 列表），
+                为空时使用服务端默认值
+        min_score: 分数阈值，低于它的结果被丢弃；vector 模式为余弦相似度，lexical 为 BM25 分数，hybrid 为融合分数
+        relative_score: 0~1，丢弃分数低于最高分该比例的结果（例如 0.8），强相关结果少时只返回少数几个
     """
-    q_emb = await embed_text([query])
-    D, I = _index.search(q_emb.astype('float32'), top_k)
-    results = [f"[{i}] {_docs[i]}" for i in I[0] if i < len(_docs)]
+    _sync_shared()
+    _schedule_eviction()
+    format = format or RESULT_FORMAT
+    if format not in ("text", "json"):
+        return f"参数错误：未知结果格式 {format}，可选：text, json"
+    try:
+        D, I = await _batcher.search(query, top_k, nprobe=nprobe, ef_search=ef_search,
+                                     mode=mode or SEARCH_MODE, filters=filters,
+                                     mmr_lambda=mmr_lambda)
+    except FilterError as e:
+        return f"过滤条件错误：{e}"
+    except ValueError as e:
+        return f"参数错误：{e}"
+    hits, = await _fetch_hits([(D, I)], mode or SEARCH_MODE, context, min_score, relative_score)
+    if format == "json":
+        return json.dumps(_hit_dicts(hits), ensure_ascii=False)
+    results = [f"[{i}] {text}" for i, _, _, text in hits]
     return "\n\n".join(results) if results else "未检索到相关文档。"
 
+@mcp.tool()
+async def retrieve_docs_batch(queries: List[str], top_k: int = 3, nprobe: int = 0, ef_search: int = 0,
+                              context: int = 0, mode: str = "",
+                              filters: Optional[Dict[str, Any]] = None,
+                              mmr_lambda: Optional[float] = None, format: str = "",
+                              min_score: Optional[float] = None,
+                              relative_score: Optional[float] = None) -> str:
+    """一次检索多条查询，结果按查询分组返回。一个问题需要查多个方面（多跳问题、对比、拆分出的子问题）时，
+    用它代替多次调用 retrieve_docs：全部查询一起嵌入、一起检索，只需一次往返。
+    Args:
+        queries: 查询列表（最多 RAG_BATCH_MAX 条，默认 32）
+        top_k: 每条查询返回的文档数
+        其余参数同 retrieve_docs，对全部查询生效；format 为 json 时返回 [{query, results: [{id, score, source, text}]}]
+    """
+    _sync_shared()
+    _schedule_eviction()
+    format = format or RESULT_FORMAT
+    if format not in ("text", "json"):
+        return f"参数错误：未知结果格式 {format}，可选：text, json"
+    try:
+        results = await _batcher.search_many(queries, top_k, nprobe=nprobe, ef_search=ef_search,
+                                             mode=mode or SEARCH_MODE, filters=filters,
+                                             mmr_lambda=mmr_lambda)
+    except FilterError as e:
+        return f"过滤条件错误：{e}"
+    except ValueError as e:
+        return f"参数错误：{e}"
+    grouped = await _fetch_hits(results, mode or SEARCH_MODE, context, min_score, relative_score)
+    if format == "json":
+        return json.dumps([{"query": q, "results": _hit_dicts(hits)} for q, hits in zip(queries, grouped)],
+                          ensure_ascii=False)
+    sections = []
+    for n, (q, hits) in enumerate(zip(queries, grouped), 1):
+        results = [f"[{i}] {text}" for i, _, _, text in hits]
+        sections.append(f"## 查询 {n}：{q}\n\n" + ("\n\n".join(results) if results else "未检索到相关文档。"))
+    return "\n\n".join(sections)
+
+@mcp.tool()
+async def job_status(job_id: str = "", wait: float = 0, ctx: Context = None) -> str:
+    """查询后台入库任务的状态（JSON）：status 为 queued / running / done / failed，done / total 为已处理 / 全部片段数。
+    Args:
+        job_id: index_docs 返回的任务 ID，为空时列出最近的全部任务
+        wait: 最多等待多少秒直到任务结束，等待期间发送进度通知；0 表示立即返回
+    """
+    if not job_id:
+        return json.dumps([job.to_dict() for job in _ingest_queue.jobs()], ensure_ascii=False)
+    job = _ingest_queue.get(job_id)
+    if job is None:
+        return f"未找到任务 {job_id}（服务重启后任务记录会丢失）"
+    if wait > 0:
+        await _ingest_queue.watch(job, lambda j: _report(ctx, j), timeout=wait)
+    return json.dumps(dict(job.to_dict(), ahead=_ingest_queue.ahead_of(job)), ensure_ascii=False)
+
+@mcp.tool()
+async def rag_stats() -> str:
+    """返回服务运行统计（嵌入缓存命中率、查询合并批大小分布等，JSON 格式）。"""
+    _sync_shared()
+    _schedule_eviction()
+    return json.dumps({
+        "docs": len(_store),
+        "shards": SHARDS,
+        "dead_ratio": _store.dead_ratio(),
+        "embed_cache": _embed_cache.stats(),
+        "query_batcher": _batcher.stats(),
+        "ingest_jobs": _ingest_queue.stats(),
+        "shared": _shared.stats() if _shared is not None else None,
+        "memory": {"resident": _store.memory_usage(), "rss_bytes": process_rss(),
+                   "eviction": _tiered.stats() if _tiered is not None else None},
+    }, ensure_ascii=False)
+
 if __name__ == "__main__":
     mcp.run(transport="stdio")
     # mcp.run(transport="tcp", host="127.0.0.1", port=8000)
@@ -0,0 +1,416 @@
+"""分片模式：N 个工作进程各持有一个 RagStore 分片，检索时分发到全部分片再合并。
+
+单个 Python 进程只能用上一个解释器、一台机器的内存。ShardedStore 对外提供与 RagStore
+相同的接口（server.py 无需区分），内部：
+    - 每个分片是一个独立的工作进程（python sharded_store.py --worker ...），
+      向量库放在 path/shard-00、path/shard-01 …… 目录下；
+    - 文档块按来源的哈希分配到分片（无来源时按内容哈希），同一来源的块总在同一分片，
+      上下文拼接、按来源删除都只涉及一个分片；
+    - 全局 ID = 分片内 ID * 分片数 + 分片号，无需额外的映射表；
+    - 检索同时发给全部分片，各分片在自己的进程里并行检索 top_k，
+      父进程用 FAISS 的 ResultHeap（按查询的定长堆）合并出全局 top_k。
+混合检索在父进程中融合：向量、BM25 两路各自先跨分片合并，再用 lexical_index.fuse 融合；
+BM25 的 idf 按分片各自统计，分片足够大时与全局统计几乎一致。
+
+每个工作进程与父进程之间有两条连接：写操作（入库、删除、保存、压缩）走写连接，其余走读连接，
+工作进程各用一个线程处理，检索不必排在同一分片正在执行的写入之后（并发安全由 RagStore 的读写锁保证）。
+
+工作进程的标准输出重定向到父进程的标准错误，不会干扰 MCP 的 stdio 传输。
+"""
+import argparse
+import atexit
+import json
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+import faiss
+import numpy as np
+
+from chunking import Chunk, as_chunk
+from rag_store import RagStore, StoreFormatError, content_hash
+
+SHARDS_FILE = "shards.json"
+AUTHKEY_ENV = "RAG_SHARD_AUTHKEY"
+# 跨分片去重时每批询问的块数
+DEDUP_BLOCK = 1024
+# 后台压缩时轮询各分片进度的间隔（秒）
+COMPACTION_POLL_S = 0.05
+# 走写连接的方法，其余方法走读连接
+WRITE_METHODS = frozenset({"add", "delete", "save", "start_compaction", "compaction_ready",
+                           "finish_compaction"})
+# 连接编号：每个工作进程先连读连接，再连写连接
+READ, WRITE = 0, 1
+
+
+def shard_dir(path: Optional[str], shard: int) -> Optional[str]:
+    return os.path.join(path, f"shard-{shard:02d}") if path else None
+
+
+class _Shard:
+    """工作进程内的分片：直接转发给 RagStore，另外负责在后台线程里准备压缩。"""
+
+    def __init__(self, store: RagStore):
+        self.store = store
+        self._compaction: Optional[threading.Thread] = None
+        self._compacted = None
+
+    def __getattr__(self, name: str):
+        return getattr(self.store, name)
+
+    def start_compaction(self) -> bool:
+        if not self.store.deleted or self._compaction is not None:
+            return False
+
+        def run() -> None:
+            self._compacted = self.store.prepare_compaction()
+
+        self._compaction = threading.Thread(target=run, daemon=True)
+        self._compaction.start()
+        return True
+
+    def compaction_ready(self) -> bool:
+        return self._compaction is None or not self._compaction.is_alive()
+
+    def finish_compaction(self) -> int:
+        if self._compaction is None:
+            return 0
+        self._compaction.join()
+        compacted, self._compaction, self._compacted = self._compacted, None, None
+        if compacted is None:
+            # 准备阶段抛了异常（已打印到标准错误），保持原状
+            return 0
+        self.store.finish_compaction(compacted)
+        return len(compacted.removed)
+
+
+def _serve(conns: Sequence[Connection], path: Optional[str], options: Dict[str, Any]) -> None:
+    """工作进程：打开分片后，写连接在后台线程、读连接在主线程各自处理请求，读连接关闭时退出。"""
+    try:
+        shard = _Shard(RagStore.open(path, **options))
+    except Exception as e:
+        conns[READ].send(("err", e))
+        return
+    conns[READ].send(("ok", None))
+    threading.Thread(target=_loop, args=(conns[WRITE], shard), daemon=True).start()
+    _loop(conns[READ], shard)
+
+
+def _loop(conn: Connection, shard: _Shard) -> None:
+    """依次执行一条连接上发来的 (方法名, 位置参数, 关键字参数)。"""
+    while True:
+        try:
+            method, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        if method == "close":
+            conn.send(("ok", None))
+            return
+        try:
+            conn.send(("ok", getattr(shard, method)(*args, **kwargs)))
+        except Exception as e:
+            conn.send(("err", e))
+
+
+def _accept(listener: Listener, proc: subprocess.Popen, authkey: bytes) -> Connection:
+    """等待工作进程连上来；进程在连接前就退出时报错，而不是永远阻塞在 accept 上。"""
+    connected = threading.Event()
+
+    def watch() -> None:
+        while not connected.wait(0.1):
+            if proc.poll() is not None:
+                # 自己连一次，唤醒阻塞中的 accept
+                Client(listener.address, authkey=authkey).close()
+                return
+
+    threading.Thread(target=watch, daemon=True).start()
+    try:
+        conn = listener.accept()
+    finally:
+        connected.set()
+    if proc.poll() is not None:
+        raise RuntimeError(f"分片工作进程启动失败（退出码 {proc.returncode}），详见标准错误输出")
+    return conn
+
+
+class ShardedStore:
+    """多进程分片向量库，接口与 RagStore 一致（search / add / delete / context ……）。
+
+    Args:
+        path: 向量库目录，None 表示只在内存中使用
+        n_shards: 分片（工作进程）数
+        threads: 每个工作进程的 OpenMP 线程数，0 表示 CPU 核数 / 分片数
+        options: 传给每个分片 RagStore.open 的参数（dim、kind、codec 等）
+    """
+
+    def __init__(self, path: Optional[str], n_shards: int, threads: int = 0, **options):
+        self.path = path
+        self.n_shards = n_shards
+        threads = threads or max(1, (os.cpu_count() or 1) // n_shards)
+        authkey = secrets.token_bytes(16)
+        listener = Listener(authkey=authkey)
+        env = dict(os.environ, **{AUTHKEY_ENV: authkey.hex()})
+        self._procs: List[subprocess.Popen] = []
+        # self._conns[分片号][READ / WRITE]
+        self._conns: List[List[Connection]] = []
+        try:
+            for i in range(n_shards):
+                self._procs.append(subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), "--worker",
+                     "--address", json.dumps(listener.address),
+                     "--path", shard_dir(path, i) or "", "--threads", str(threads),
+                     "--options", json.dumps(options)],
+                    env=env, stdin=subprocess.DEVNULL, stdout=sys.stderr))
+                # 逐个启动、逐个接受连接，第 i 对连接就是第 i 个分片
+                self._conns.append([_accept(listener, self._procs[-1], authkey) for _ in (READ, WRITE)])
+        finally:
+            listener.close()
+        self._locks = [[threading.Lock(), threading.Lock()] for _ in range(n_shards)]
+        atexit.register(self.close)
+        for conns in self._conns:
+            status, value = conns[READ].recv()
+            if status == "err":
+                self.close()
+                raise value
+
+    @classmethod
+    def open(cls, path: Optional[str], n_shards: int, threads: int = 0, **options) -> "ShardedStore":
+        """打开（或新建）path 下的分片向量库；分片数必须与创建时一致，否则文档会被路由到错误的分片。"""
+        if path:
+            os.makedirs(path, exist_ok=True)
+            meta_path = os.path.join(path, SHARDS_FILE)
+            if os.path.exists(meta_path):
+                with open(meta_path, encoding="utf-8") as f:
+                    existing = json.load(f)["shards"]
+                if existing != n_shards:
+                    raise StoreFormatError(f"向量库按 {existing} 个分片创建，不能以 {n_shards} 个分片打开")
+            else:
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"shards": n_shards}, f)
+        return cls(path, n_shards, threads, **options)
+
+    def close(self) -> None:
+        for conns, proc in zip(self._conns, self._procs):
+            for conn in conns[::-1]:
+                try:
+                    conn.send(("close", (), {}))
+                    conn.recv()
+                except (OSError, EOFError):
+                    pass
+            proc.wait(timeout=10)
+        self._conns, self._procs = [], []
+
+    # ----- 进程间调用 -----
+
+    def _scatter(self, calls: Dict[int, Tuple[str, tuple, dict]]) -> Dict[int, Any]:
+        """把 {分片号: (方法名, 位置参数, 关键字参数)} 同时发给各分片，等全部返回。
+
+        写操作与其他操作分别走各分片的写连接、读连接；按分片号顺序给连接加锁，多个线程可以安全地共用连接。
+        """
+        shards = sorted(calls)
+        channel = {s: WRITE if calls[s][0] in WRITE_METHODS else READ for s in shards}
+        for s in shards:
+            self._locks[s][channel[s]].acquire()
+        try:
+            for s in shards:
+                self._conns[s][channel[s]].send(calls[s])
+            replies = {s: self._conns[s][channel[s]].recv() for s in shards}
+        finally:
+            for s in shards:
+                self._locks[s][channel[s]].release()
+        for status, value in replies.values():
+            if status == "err":
+                raise value
+        return {s: value for s, (_, value) in replies.items()}
+
+    def _broadcast(self, method: str, *args, **kwargs) -> List[Any]:
+        results = self._scatter({s: (method, args, kwargs) for s in range(self.n_shards)})
+        return [results[s] for s in range(self.n_shards)]
+
+    def _call(self, shard: int, method: str, *args, **kwargs) -> Any:
+        return self._scatter({shard: (method, args, kwargs)})[shard]
+
+    # ----- ID 与路由 -----
+
+    def shard_of(self, chunk: Chunk) -> int:
+        if chunk.source:
+            return zlib.crc32(chunk.source.encode("utf-8")) % self.n_shards
+        return content_hash(chunk.text) % self.n_shards
+
+    def _global(self, local: np.ndarray, shard: int) -> np.ndarray:
+        local = np.asarray(local, dtype=np.int64)
+        return np.where(local >= 0, local * self.n_shards + shard, -1)
+
+    def _split(self, doc_ids: Iterable[int]) -> Dict[int, List[int]]:
+        by_shard: Dict[int, List[int]] = {}
+        for doc_id in doc_ids:
+            doc_id = int(doc_id)
+            if doc_id >= 0:
+                by_shard.setdefault(doc_id % self.n_shards, []).append(doc_id // self.n_shards)
+        return by_shard
+
+    # ----- 与 RagStore 相同的接口 -----
+
+    def __len__(self) -> int:
+        return sum(self._broadcast("__len__"))
+
+    def row_of(self, doc_id: int) -> int:
+        """文档在其分片内的行号；ID 不存在或已删除时返回 -1。"""
+        doc_id = int(doc_id)
+        if doc_id < 0:
+            return -1
+        return self._call(doc_id % self.n_shards, "row_of", doc_id // self.n_shards)
+
+    def doc(self, doc_id: int) -> str:
+        return self._call(doc_id % self.n_shards, "doc", doc_id // self.n_shards)
+
+    def source_of(self, doc_id: int) -> str:
+        return self._call(doc_id % self.n_shards, "source_of", doc_id // self.n_shards)
+
+    def context(self, doc_id: int, window: int = 1) -> str:
+        return self._call(doc_id % self.n_shards, "context", doc_id // self.n_shards, window)
+
+    def fetch(self, doc_ids: Sequence[int], window: int = 0) -> List[Optional[Tuple[str, str]]]:
+        """同 RagStore.fetch，每个分片只往返一次。"""
+        by_shard = self._split(doc_ids)
+        results = self._scatter({s: ("fetch", (local, window), {}) for s, local in by_shard.items()})
+        found = {(s, local): hit for s, local_ids in by_shard.items()
+                 for local, hit in zip(local_ids, results[s])}
+        return [found.get((int(i) % self.n_shards, int(i) // self.n_shards)) if int(i) >= 0 else None
+                for i in doc_ids]
+
+    def vectors_of(self, doc_ids: np.ndarray) -> np.ndarray:
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        flat = doc_ids.ravel()
+        shards = np.where(flat >= 0, flat % self.n_shards, -1)
+        calls = {s: ("vectors_of", (flat[shards == s] // self.n_shards,), {})
+                 for s in np.unique(shards[shards >= 0]).tolist()}
+        out = None
+        for s, vectors in self._scatter(calls).items():
+            if out is None:
+                out = np.zeros((len(flat), vectors.shape[1]), dtype="float32")
+            out[shards == s] = vectors
+        if out is None:
+            return np.zeros(doc_ids.shape + (0,), dtype="float32")
+        return out.reshape(doc_ids.shape + (out.shape[1],))
+
+    def add(self, embeddings: np.ndarray, docs: List) -> np.ndarray:
+        """按来源分配到各分片并行加入，返回全局 ID（与 docs 顺序一致）。"""
+        chunks = [as_chunk(d) for d in docs]
+        embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+        shards = np.fromiter((self.shard_of(c) for c in chunks), dtype=np.int64, count=len(chunks))
+        calls, rows = {}, {}
+        for s in np.unique(shards).tolist():
+            rows[s] = np.flatnonzero(shards == s)
+            calls[s] = ("add", (embeddings[rows[s]], [chunks[i] for i in rows[s]]), {})
+        ids = np.empty(len(chunks), dtype=np.int64)
+        for s, local in self._scatter(calls).items():
+            ids[rows[s]] = self._global(local, s)
+        return ids
+
+    def delete(self, doc_ids: Iterable[int]) -> int:
+        calls = {s: ("delete", (local,), {}) for s, local in self._split(doc_ids).items()}
+        return sum(self._scatter(calls).values()) if calls else 0
+
+    def ids_of_source(self, source: str) -> np.ndarray:
+        shard = self.shard_of(Chunk("", source))
+        return self._global(self._call(shard, "ids_of_source", source), shard)
+
+    def dead_ratio(self) -> float:
+        """各分片墓碑比例的最大值（压缩按分片进行）。"""
+        return max(self._broadcast("dead_ratio"))
+
+    def memory_usage(self) -> Dict[str, int]:
+        """各分片常驻内存（见 RagStore.memory_usage）按部分求和。"""
+        usages = self._broadcast("memory_usage")
+        return {part: sum(u[part] for u in usages) for part in usages[0]}
+
+    def prepare_compaction(self) -> List[int]:
+        """让有墓碑的分片在各自的后台线程里准备压缩，等全部准备好后返回这些分片号。"""
+        started = [s for s, ok in enumerate(self._broadcast("start_compaction")) if ok]
+        while started and not all(self._scatter({s: ("compaction_ready", (), {}) for s in started}).values()):
+            time.sleep(COMPACTION_POLL_S)
+        return started
+
+    def finish_compaction(self, started: List[int]) -> None:
+        if started:
+            self._scatter({s: ("finish_compaction", (), {}) for s in started})
+
+    def save(self) -> None:
+        self._broadcast("save")
+
+    def unique_chunks(self, chunks: Iterable[Chunk], counts: Dict[str, int]) -> Iterator[Chunk]:
+        """同 RagStore.unique_chunks；同一内容可能以不同来源落在不同分片，按批询问全部分片。"""
+        seen: Set[int] = set()
+        block: List[Tuple[int, Chunk]] = []
+
+        def flush() -> Iterator[Chunk]:
+            hashes = [h for h, _ in block]
+            known = np.logical_or.reduce(self._broadcast("known_hashes", hashes))
+            for (h, c), dup in zip(block, known):
+                if dup or h in seen:
+                    counts["skipped"] = counts.get("skipped", 0) + 1
+                    continue
+                seen.add(h)
+                yield c
+            block.clear()
+
+        for c in chunks:
+            block.append((content_hash(c.text), c))
+            if len(block) >= DEDUP_BLOCK:
+                yield from flush()
+        if block:
+            yield from flush()
+
+    def _merge(self, results: Sequence[Tuple[np.ndarray, np.ndarray]], nq: int, top_k: int,
+               keep_max: bool) -> Tuple[np.ndarray, np.ndarray]:
+        """用定长堆合并各分片的 (距离或分数, 分片内 ID)，得到全局 top_k。"""
+        heap = faiss.ResultHeap(nq, top_k, keep_max=keep_max)
+        for s, (D, I) in enumerate(results):
+            heap.add_result(D, self._global(I, s))
+        heap.finalize()
+        # 与 RagStore 保持一致的空位：距离为最大浮点数，分数为 0
+        heap.D[heap.I < 0] = 0 if keep_max else np.finfo("float32").max
+        return heap.D, heap.I
+
+    def search(self, query: np.ndarray, top_k: int, nprobe: int = 0, ef_search: int = 0,
+               filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        query = np.ascontiguousarray(query, dtype="float32")
+        results = self._broadcast("search", query, top_k, nprobe=nprobe, ef_search=ef_search,
+                                  filters=filters)
+        return self._merge(results, len(query), top_k, keep_max=False)
+
+    def search_lexical(self, queries: List[str], top_k: int,
+                       filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        results = self._broadcast("search_lexical", queries, top_k, filters=filters)
+        return self._merge(results, len(queries), top_k, keep_max=True)
+
+    # 只依赖 search / search_lexical / __len__，直接复用单进程版本（不需要 RagStore 的读锁）
+    search_hybrid = RagStore.search_hybrid.__wrapped__
+    novel_mask = RagStore.novel_mask.__wrapped__
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="分片工作进程（由 ShardedStore 启动，不要手动运行）")
+    parser.add_argument("--worker", action="store_true")
+    parser.add_argument("--address", required=True)
+    parser.add_argument("--path", default="")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--options", default="{}")
+    args = parser.parse_args()
+    address = json.loads(args.address)
+    address = tuple(address) if isinstance(address, list) else address
+    authkey = bytes.fromhex(os.environ[AUTHKEY_ENV])
+    conns = [Client(address, authkey=authkey) for _ in (READ, WRITE)]
+    faiss.omp_set_num_threads(args.threads)
+    _serve(conns, args.path or None, json.loads(args.options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""多个 stdio 服务进程共享同一个向量库目录。
+
+每个通过 stdio 连接的客户端都会启动自己的服务进程。RAG_SHARED=1 时这些进程共享 RAG_INDEX_PATH：
+    - 第一个拿到写租约（writer.lock 上的 flock 排他锁）的进程是写进程，负责入库、删除、压缩与保存；
+      每次保存都发布一个新快照（meta.json 中的 generation 加一）；
+    - 其余进程是只读进程：索引、文档等全部以内存映射方式打开，与写进程共用操作系统的页缓存，
+      每多一个客户端几乎不增加内存；写入类工具直接拒绝；
+    - 只读进程每隔 poll 秒检查一次快照代数，有新快照时在后台整体切换（见 RagStore.refresh），
+      切换之前的检索照常使用旧快照；
+    - 写进程退出后租约由内核释放，下一个检查到的只读进程接管写入。
+flock 只在 POSIX 系统上可用；没有 fcntl 时每个进程都是写进程（与不共享时相同）。
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from rag_store import RagStore, read_generation
+
+LEASE_FILE = "writer.lock"
+
+
+class WriterLease:
+    """向量库目录的写租约：writer.lock 上的非阻塞排他 flock，文件内容为持有者的进程号。
+
+    租约随文件描述符存在，持有进程退出（包括崩溃）时由内核自动释放。
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.join(path, LEASE_FILE)
+        self._file = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def acquire(self) -> bool:
+        """尝试获取租约，已被其他进程持有时立即返回 False。"""
+        if self._file is not None:
+            return True
+        f = open(self.path, "a+")
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def holder(self) -> Optional[int]:
+        """当前持有租约的进程号（尽力而为，读不到时为 None）。"""
+        if self.held:
+            return os.getpid()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+    def release(self) -> None:
+        if self._file is not None:
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+        self._file = None
+
+
+class SharedIndex:
+    """一个服务进程在共享向量库目录中的角色。
+
+    Args:
+        store: 已打开的向量库（path 不能为空），只读进程会被原地切换到新快照
+        poll: 只读进程检查新快照与写租约的最小间隔（秒）
+    """
+
+    def __init__(self, store: RagStore, poll: float = 1.0):
+        if not store.path:
+            raise ValueError("共享模式需要设置 RAG_INDEX_PATH")
+        os.makedirs(store.path, exist_ok=True)
+        self.store = store
+        self.poll = poll
+        self.lease = WriterLease(store.path)
+        self.lease.acquire()
+        self.switches = 0
+        self._checked = time.monotonic()
+        self._syncing = threading.Lock()
+
+    @property
+    def writable(self) -> bool:
+        return self.lease.held
+
+    def due(self) -> bool:
+        """只读进程距上次检查已超过 poll 秒。"""
+        return not self.writable and time.monotonic() - self._checked >= self.poll
+
+    def sync(self) -> bool:
+        """只读进程：写进程已退出时接管写租约，再切换到最新快照；返回是否切换了快照。
+
+        同一时刻只有一个 sync 在执行，其余调用直接返回。
+        """
+        if self.writable or not self._syncing.acquire(blocking=False):
+            return False
+        try:
+            self._checked = time.monotonic()
+            # 先拿租约再切换：接管之后不会再有别的进程发布快照，切换到的就是最终状态
+            self.lease.acquire()
+            switched = self.store.refresh()
+            self.switches += switched
+            return switched
+        finally:
+            self._syncing.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "role": "writer" if self.writable else "reader",
+            "pid": os.getpid(),
+            "writer_pid": self.lease.holder(),
+            "generation": self.store.generation,
+            "latest_generation": read_generation(self.store.path),
+            "switches": self.switches,
+        }
@@ -0,0 +1,191 @@
+"""并发压测：入库 / 更新 / 删除与检索同时进行，检查检索结果是否一致。
+
+通过 stdio 启动一个服务端（默认 server.py，RAG_EMBED_BACKEND=hash，不需要网络与 API Key），
+在 --seconds 秒内同时运行：
+    - --writers 个写任务，循环调用 index_docs / upsert_docs / delete_docs；
+    - --readers 个读任务，循环调用 retrieve_docs（format=json），轮换 vector / lexical / hybrid
+      检索模式，部分查询带来源前缀过滤。
+每篇文档的正文都写明了自己的来源（"来源 s-0-12-3 ……"），因此每条检索结果都可以自证：
+    torn_text     正文不是任何一次写入过的文档（读到了写了一半的数据）
+    wrong_source  结果的来源与正文中的来源不一致（索引、文档、来源几列错位）
+    duplicate_id  同一次检索的结果中 ID 重复
+输出读写吞吐、retrieve_docs 延迟分位数与上述违反次数（JSON）；有违反或工具报错时退出码为 1。
+
+    uv run stress.py --seconds 30 --readers 8 --writers 2
+    RAG_SHARDS=2 uv run stress.py --server server-ali.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Set
+
+import numpy as np
+from mcp import ClientSession
+from mcp.client.stdio import StdioServerParameters, stdio_client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+_SOURCE = re.compile(r"^来源 (\S+) ")
+TOPICS = ["高血压", "糖尿病", "冠心病", "阿司匹林", "胰岛素", "血脂", "心律失常", "脑卒中"]
+
+
+class Stress:
+    def __init__(self, session: ClientSession, args: argparse.Namespace):
+        self.session = session
+        self.args = args
+        self.deadline = 0.0
+        # 每一段写入过的正文（在调用工具之前登记，检索可能比工具返回更早看到它）
+        self.written: Set[str] = set()
+        # 当前在线的来源，供更新、删除与构造查询使用
+        self.sources: List[str] = []
+        self.calls: Counter = Counter()
+        self.violations: Counter = Counter()
+        self.errors: List[str] = []
+        self.latencies: List[float] = []
+
+    async def call(self, tool: str, **arguments) -> str:
+        result = await self.session.call_tool(tool, arguments)
+        self.calls[tool] += 1
+        text = result.content[0].text if result.content else ""
+        if result.isError or text.startswith(("参数错误", "过滤条件错误")):
+            self.errors.append(f"{tool}: {text[:200]}")
+        return text
+
+    def doc(self, source: str, version: int) -> str:
+        rng = random.Random(f"{source}/{version}")
+        topic = rng.choice(TOPICS)
+        return (f"来源 {source} 第 {version} 版：{topic}患者应定期复查，"
+                f"收缩压≥{rng.randint(120, 160)} 时遵医嘱用药。")
+
+    async def writer(self, w: int) -> None:
+        rng = random.Random(w)
+        i = 0
+        while time.monotonic() < self.deadline:
+            action = rng.random()
+            if action < 0.7 or len(self.sources) < 10:
+                sources = [f"s-{w}-{i}-{j}" for j in range(self.args.batch)]
+                docs = [self.doc(src, 1) for src in sources]
+                self.written.update(docs)
+                await self.call("index_docs", docs=docs, sources=sources,
+                                tags=[[f"w{w}"]] * len(docs))
+                self.sources.extend(sources)
+            elif action < 0.9:
+                sources = rng.sample(self.sources, min(self.args.batch, len(self.sources)))
+                docs = [self.doc(src, i + 2) for src in sources]
+                self.written.update(docs)
+                await self.call("upsert_docs", docs=docs, sources=sources)
+            else:
+                sources = rng.sample(self.sources, min(self.args.batch, len(self.sources)))
+                for src in sources:
+                    self.sources.remove(src)
+                await self.call("delete_docs", sources=sources)
+            i += 1
+
+    async def reader(self, r: int) -> None:
+        rng = random.Random(1000 + r)
+        modes = ("vector", "lexical", "hybrid")
+        n = 0
+        while time.monotonic() < self.deadline:
+            if not self.sources:
+                await asyncio.sleep(0.01)
+                continue
+            source = rng.choice(self.sources)
+            query = self.doc(source, 1) if n % 2 else f"来源 {source} {rng.choice(TOPICS)}"
+            arguments = dict(query=query, top_k=self.args.top_k, mode=modes[n % len(modes)],
+                             format="json")
+            if n % 4 == 3:
+                arguments["filters"] = {"source_prefix": source.rsplit("-", 2)[0] + "-"}
+            t0 = time.perf_counter()
+            text = await self.call("retrieve_docs", **arguments)
+            self.latencies.append(time.perf_counter() - t0)
+            n += 1
+            try:
+                hits = json.loads(text)
+            except ValueError:
+                continue  # 已计入 errors
+            self.check(hits)
+
+    def check(self, hits: List[Dict]) -> None:
+        ids = [hit["id"] for hit in hits]
+        if len(set(ids)) != len(ids):
+            self.violations["duplicate_id"] += 1
+        for hit in hits:
+            if hit["text"] not in self.written:
+                self.violations["torn_text"] += 1
+                continue
+            m = _SOURCE.match(hit["text"])
+            if m is None or m.group(1) != hit["source"]:
+                self.violations["wrong_source"] += 1
+
+    async def run(self) -> Dict[str, object]:
+        self.deadline = time.monotonic() + self.args.seconds
+        t0 = time.perf_counter()
+        await asyncio.gather(*[self.writer(w) for w in range(self.args.writers)],
+                             *[self.reader(r) for r in range(self.args.readers)])
+        elapsed = time.perf_counter() - t0
+        lat = np.array(self.latencies or [0.0]) * 1000
+        stats = json.loads(await self.call("rag_stats"))
+        return {
+            "seconds": round(elapsed, 2),
+            "calls": dict(self.calls),
+            "retrieve_qps": round(self.calls["retrieve_docs"] / elapsed, 1),
+            "retrieve_ms": {f"p{q}": round(float(np.percentile(lat, q)), 2) for q in (50, 95, 99)},
+            "retrieve_max_ms": round(float(lat.max()), 2),
+            "docs": stats["docs"],
+            "violations": dict(self.violations),
+            "errors": self.errors[:20],
+            "n_errors": len(self.errors),
+        }
+
+
+async def main_async(args: argparse.Namespace) -> Dict[str, object]:
+    index_path = args.index_path or tempfile.mkdtemp(prefix="rag-stress-")
+    env = dict(os.environ)
+    env.setdefault("RAG_EMBED_BACKEND", "hash")
+    env.setdefault("OPENAI_API_KEY", "unused")
+    env.setdefault("DASHSCOPE_API_KEY", "unused")
+    env.setdefault("RAG_COMPACT_RATIO", str(args.compact_ratio))
+    env["RAG_INDEX_PATH"] = index_path
+    params = StdioServerParameters(command=sys.executable, args=[args.server], env=env, cwd=HERE)
+    async with stdio_client(params) as (read, write):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+            report = await Stress(session, args).run()
+    report.update(server=args.server, index_path=index_path, readers=args.readers,
+                  writers=args.writers, shards=int(env.get("RAG_SHARDS", "1")))
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="index_docs / retrieve_docs 并发压测与一致性检查")
+    parser.add_argument("--server", default="server.py", help="服务端脚本（server.py / server-ali.py）")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--readers", type=int, default=8, help="并发的 retrieve_docs 任务数")
+    parser.add_argument("--writers", type=int, default=2, help="并发的写任务数")
+    parser.add_argument("--batch", type=int, default=16, help="每次写入的文档数")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--compact-ratio", type=float, default=0.1,
+                        help="服务端的 RAG_COMPACT_RATIO，调低以便压测期间触发后台压缩")
+    parser.add_argument("--index-path", default="", help="向量库目录，默认新建临时目录")
+    parser.add_argument("--out", help="结果 JSON 文件，不指定则打印到标准输出")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    if report["violations"] or report["n_errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
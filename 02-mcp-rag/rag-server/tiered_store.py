@@ -0,0 +1,317 @@
+"""有内存预算的分层向量库。
+
+长时间运行的服务每次 index_docs 都在追加，热层（FAISS 索引与各列）只增不减。
+TieredStore 给向量库加一个常驻内存预算（按 RagStore.memory_usage 估算）：
+    - 每次写入后、以及每隔 check_every 秒检查一次，超出预算时按淘汰策略（见 eviction.py）
+      选出热层的片段，一次淘汰到预算的 LOW_WATER 以下，避免每次写入都触发；
+    - 淘汰的片段默认溢出到 path/spill 下的溢出层：另一个 RagStore，使用 binary 编码，
+      常驻内存的只有每维一位的符号码，原始向量与文档都在内存映射的文件里，仍然可以检索；
+      没有溢出层（未设置持久化目录或 spill=False）时直接丢弃；
+    - 被淘汰的片段先在热层标记删除，再写入溢出层，检索不会同时看到两份；墓碑的空间要压缩后才释放，
+      只有标记之后仍超出预算时才立即压缩热层，只淘汰了少量过期片段时留给常规的墓碑压缩（RAG_COMPACT_RATIO）。
+对外接口与 RagStore 一致（server.py 无需区分）。全局 ID = 层内 ID * 2 + 层号（0 热层，1 溢出层），
+与分片模式同样的编码方式；片段溢出后换用溢出层中的新 ID。检索时两层各取 top_k 再合并，
+BM25 的 idf 按层各自统计。
+"""
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from chunking import Chunk
+from eviction import EvictionPolicy, make_policy
+from rag_store import RagStore, content_hash
+
+SPILL_DIR = "spill"
+HOT, SPILL = 0, 1
+N_TIERS = 2
+# 超出预算时淘汰到预算的这个比例以下
+LOW_WATER = 0.9
+EVICT_ROUNDS = 3
+
+
+def process_rss() -> Optional[int]:
+    """当前进程的常驻内存（字节），读不到（非 Linux）时为 None。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class TieredStore:
+    """热层 + 溢出层的向量库，接口与 RagStore 一致。
+
+    Args:
+        hot: 热层向量库
+        budget: 常驻内存预算（字节），0 表示不限（只按策略淘汰过期片段）
+        policy: 淘汰策略
+        spill: 溢出层向量库，None 表示淘汰的片段直接丢弃
+        check_every: 没有写入时定期检查预算与过期片段的间隔（秒）
+    """
+
+    def __init__(self, hot: RagStore, budget: int, policy: EvictionPolicy,
+                 spill: Optional[RagStore] = None, check_every: float = 60.0):
+        self.hot = hot
+        self.spill = spill
+        self.budget = budget
+        self.policy = policy
+        self.check_every = check_every
+        self.evicted = 0
+        self.spilled = 0
+        self._checked = time.monotonic()
+        self._policy_lock = threading.Lock()
+        now = time.time()
+        ids, _ = hot.live_ids()
+        policy.added(ids, now)
+
+    @classmethod
+    def open(cls, path: Optional[str], budget: int, policy: str = "lru", ttl: float = 0,
+             spill: bool = True, check_every: float = 60.0, **options) -> "TieredStore":
+        """打开 path 下的热层与 path/spill 下的溢出层；options 为热层 RagStore.open 的参数。"""
+        hot = RagStore.open(path, **options)
+        spill_store = None
+        if spill and path:
+            spill_store = RagStore.open(os.path.join(path, SPILL_DIR),
+                                        **dict(options, kind="flat", promote_at=0, codec="binary"))
+        return cls(hot, budget, make_policy(policy, ttl), spill_store, check_every)
+
+    @property
+    def path(self) -> Optional[str]:
+        return self.hot.path
+
+    def _tiers(self) -> Dict[int, RagStore]:
+        tiers = {HOT: self.hot}
+        if self.spill is not None:
+            tiers[SPILL] = self.spill
+        return tiers
+
+    # ----- ID 与路由 -----
+
+    def _global(self, local: np.ndarray, tier: int) -> np.ndarray:
+        local = np.asarray(local, dtype=np.int64)
+        return np.where(local >= 0, local * N_TIERS + tier, -1)
+
+    def _split(self, doc_ids: Iterable[int]) -> Dict[int, List[int]]:
+        by_tier: Dict[int, List[int]] = {}
+        for doc_id in doc_ids:
+            doc_id = int(doc_id)
+            if doc_id >= 0 and doc_id % N_TIERS in self._tiers():
+                by_tier.setdefault(doc_id % N_TIERS, []).append(doc_id // N_TIERS)
+        return by_tier
+
+    def _route(self, doc_id: int) -> Tuple[Optional[RagStore], int]:
+        doc_id = int(doc_id)
+        return self._tiers().get(doc_id % N_TIERS) if doc_id >= 0 else None, doc_id // N_TIERS
+
+    def _lookup(self, doc_id: int) -> Tuple[RagStore, int]:
+        """同 _route，ID 不属于任何一层时抛出 KeyError。"""
+        store, local = self._route(doc_id)
+        if store is None:
+            raise KeyError(doc_id)
+        return store, local
+
+    # ----- 与 RagStore 相同的接口 -----
+
+    def __len__(self) -> int:
+        return sum(len(store) for store in self._tiers().values())
+
+    def row_of(self, doc_id: int) -> int:
+        """文档在其所在层内的行号；ID 不存在或已删除时返回 -1。"""
+        store, local = self._route(doc_id)
+        return store.row_of(local) if store is not None else -1
+
+    def doc(self, doc_id: int) -> str:
+        store, local = self._lookup(doc_id)
+        return store.doc(local)
+
+    def source_of(self, doc_id: int) -> str:
+        store, local = self._lookup(doc_id)
+        return store.source_of(local)
+
+    def context(self, doc_id: int, window: int = 1) -> str:
+        store, local = self._lookup(doc_id)
+        return store.context(local, window)
+
+    def fetch(self, doc_ids: Sequence[int], window: int = 0) -> List[Optional[Tuple[str, str]]]:
+        """同 RagStore.fetch；取出的热层片段记为一次命中（供 lru 策略使用）。"""
+        found: Dict[Tuple[int, int], Optional[Tuple[str, str]]] = {}
+        for tier, local_ids in self._split(doc_ids).items():
+            hits = self._tiers()[tier].fetch(local_ids, window)
+            found.update(((tier, local), hit) for local, hit in zip(local_ids, hits))
+            if tier == HOT:
+                with self._policy_lock:
+                    self.policy.touched((local for local, hit in zip(local_ids, hits) if hit is not None),
+                                        time.time())
+        return [found.get((int(i) % N_TIERS, int(i) // N_TIERS)) if int(i) >= 0 else None
+                for i in doc_ids]
+
+    def vectors_of(self, doc_ids: np.ndarray) -> np.ndarray:
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        flat = doc_ids.ravel()
+        out = np.zeros((len(flat), self.hot.index.d), dtype="float32")
+        for tier, store in self._tiers().items():
+            mask = (flat >= 0) & (flat % N_TIERS == tier)
+            if mask.any():
+                out[mask] = store.vectors_of(flat[mask] // N_TIERS)
+        return out.reshape(doc_ids.shape + (self.hot.index.d,))
+
+    def add(self, embeddings: np.ndarray, docs: List) -> np.ndarray:
+        """新片段总是加入热层，返回全局 ID。"""
+        local = self.hot.add(embeddings, docs)
+        with self._policy_lock:
+            self.policy.added(local, time.time())
+        return self._global(local, HOT)
+
+    def delete(self, doc_ids: Iterable[int]) -> int:
+        return sum(self._tiers()[tier].delete(local) for tier, local in self._split(doc_ids).items())
+
+    def ids_of_source(self, source: str) -> np.ndarray:
+        return np.concatenate([self._global(store.ids_of_source(source), tier)
+                               for tier, store in self._tiers().items()])
+
+    def dead_ratio(self) -> float:
+        return max(store.dead_ratio() for store in self._tiers().values())
+
+    def prepare_compaction(self) -> Dict[int, Any]:
+        return {tier: store.prepare_compaction() for tier, store in self._tiers().items() if store.deleted}
+
+    def finish_compaction(self, compacted: Dict[int, Any]) -> None:
+        for tier, result in compacted.items():
+            self._tiers()[tier].finish_compaction(result)
+
+    def save(self) -> None:
+        for store in self._tiers().values():
+            store.save()
+
+    def unique_chunks(self, chunks: Iterable[Chunk], counts: Dict[str, int]) -> Iterator[Chunk]:
+        """同 RagStore.unique_chunks，已溢出到溢出层的内容同样跳过。"""
+        chunks = list(chunks)
+        hashes = [content_hash(c.text) for c in chunks]
+        known = self.known_hashes(hashes)
+        seen = set()
+        for c, h, k in zip(chunks, hashes, known):
+            if k or h in seen:
+                counts["skipped"] = counts.get("skipped", 0) + 1
+                continue
+            seen.add(h)
+            yield c
+
+    def known_hashes(self, hashes: Sequence[int]) -> np.ndarray:
+        return np.logical_or.reduce([store.known_hashes(hashes) for store in self._tiers().values()])
+
+    def _merge(self, results: Dict[int, Tuple[np.ndarray, np.ndarray]], nq: int, top_k: int,
+               keep_max: bool) -> Tuple[np.ndarray, np.ndarray]:
+        """用定长堆合并各层的 (距离或分数, 层内 ID)，得到全局 top_k。"""
+        heap = faiss.ResultHeap(nq, top_k, keep_max=keep_max)
+        for tier, (D, I) in results.items():
+            heap.add_result(np.ascontiguousarray(D, dtype="float32"), self._global(I, tier))
+        heap.finalize()
+        # 与 RagStore 保持一致的空位：距离为最大浮点数，分数为 0
+        heap.D[heap.I < 0] = 0 if keep_max else np.finfo("float32").max
+        return heap.D, heap.I
+
+    def _searched(self) -> Dict[int, RagStore]:
+        # 空的溢出层不参与检索
+        return {tier: store for tier, store in self._tiers().items() if tier == HOT or len(store)}
+
+    def search(self, query: np.ndarray, top_k: int, nprobe: int = 0, ef_search: int = 0,
+               filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        query = np.ascontiguousarray(query, dtype="float32")
+        results = {tier: store.search(query, top_k, nprobe=nprobe, ef_search=ef_search, filters=filters)
+                   for tier, store in self._searched().items()}
+        return self._merge(results, len(query), top_k, keep_max=False)
+
+    def search_lexical(self, queries: List[str], top_k: int,
+                       filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        results = {tier: store.search_lexical(queries, top_k, filters=filters)
+                   for tier, store in self._searched().items()}
+        return self._merge(results, len(queries), top_k, keep_max=True)
+
+    # 只依赖 search / search_lexical / __len__，直接复用单层版本（不需要 RagStore 的读锁）
+    search_hybrid = RagStore.search_hybrid.__wrapped__
+    novel_mask = RagStore.novel_mask.__wrapped__
+
+    # ----- 内存预算 -----
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """各层常驻内存的大致字节数（见 RagStore.memory_usage），total 为合计。"""
+        usage: Dict[str, Any] = {"hot": self.hot.memory_usage()}
+        if self.spill is not None:
+            usage["spill"] = self.spill.memory_usage()
+        usage["total"] = sum(u["total"] for u in usage.values())
+        return usage
+
+    def due(self) -> bool:
+        """距上次检查已超过 check_every 秒。"""
+        return time.monotonic() - self._checked >= self.check_every
+
+    def evict(self, now: Optional[float] = None) -> int:
+        """淘汰过期片段，超出预算时再按策略淘汰到预算的 LOW_WATER 以下，返回淘汰的片段数。
+
+        写操作：须与其他写入串行执行。被淘汰的片段先从热层删除，再写入溢出层并保存，最后保存热层
+        （两次保存之间崩溃时片段在两层各有一份，不会丢失）；仍超出预算时才压缩热层释放墓碑的空间。
+        溢出的片段在溢出层仍占少量内存（符号码），按估算淘汰一轮后仍超出预算时再来一轮，最多 EVICT_ROUNDS 轮。
+        """
+        now = time.time() if now is None else now
+        self._checked = time.monotonic()
+        evicted = 0
+        for _ in range(EVICT_ROUNDS):
+            n = self._evict_once(now)
+            evicted += n
+            if not n or self.budget <= 0 or self.memory_usage()["total"] <= self.budget:
+                break
+        return evicted
+
+    def _evict_once(self, now: float) -> int:
+        ids, timestamps = self.hot.live_ids()
+        victims = self.policy.expired(ids, timestamps, now)
+        usage = self.memory_usage()
+        over = self.budget > 0 and usage["total"] > self.budget
+        if over and len(ids):
+            # 按热层每行（含墓碑）的平均占用（减去溢出后在溢出层的平均占用）估算要淘汰多少个，
+            # 已有的墓碑压缩后就会释放，先从超出量中扣除
+            per_row = usage["hot"]["total"] / (len(ids) + len(self.hot.deleted))
+            per_doc = per_row
+            if "spill" in usage and len(self.spill):
+                per_doc -= usage["spill"]["total"] / len(self.spill)
+            excess = usage["total"] - per_row * len(self.hot.deleted) - self.budget * LOW_WATER
+            need = math.ceil(excess / max(per_doc, 1.0)) - int(victims.sum())
+            if need > 0:
+                with self._policy_lock:
+                    order = self.policy.order(ids, timestamps)
+                order = order[~victims[order]]
+                victims[order[:need]] = True
+        doomed = ids[victims]
+        if len(doomed):
+            vectors, chunks = self.hot.export(doomed) if self.spill is not None else (None, [])
+            # 先删后加：两步之间的检索最多暂时看不到这些片段，不会在两层各命中一次
+            self.hot.delete(doomed.tolist())
+            if self.spill is not None:
+                self.spill.add(vectors, chunks)
+                self.spill.save()
+                self.spilled += len(chunks)
+            self.evicted += len(doomed)
+        # 压缩要重建整个热层：只在仍超出预算时执行，预算内的墓碑留给常规压缩
+        compact = over and bool(self.hot.deleted)
+        if compact:
+            self.hot.finish_compaction(self.hot.prepare_compaction())
+        if len(doomed) or compact:
+            self.hot.save()
+        return len(doomed)
+
+    def stats(self) -> Dict[str, Any]:
+        usage = self.memory_usage()
+        return {
+            "budget_bytes": self.budget,
+            "resident_bytes": usage["total"],
+            "policy": self.policy.name,
+            "hot_docs": len(self.hot),
+            "spill_docs": len(self.spill) if self.spill is not None else None,
+            "evicted": self.evicted,
+            "spilled": self.spilled,
+        }
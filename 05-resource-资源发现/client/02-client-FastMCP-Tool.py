@@ -61,7 +61,12 @@ class RagClient:
         uris = [r.uri for r in getattr(res_list, "resources", res_list)]
         print("发现资源：", uris)
 
-        # 5) 读取并索引资源内容
+        # 5) 索引资源内容：服务端提供 index_resources 时只发送 URI，由服务端直接读取文件，
+        #    不必把全文读到客户端再经 JSON-RPC 发回去
+        if uris and any(t["function"]["name"] == "index_resources" for t in self.tools):
+            idx_resp = await self.session.call_tool("index_resources", {"uris": [str(u) for u in uris]})
+            print("资源文档索引：", idx_resp)
+            return
         all_texts = []
         for uri in uris:
             rr = await self.session.read_resource(uri)
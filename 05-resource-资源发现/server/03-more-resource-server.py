@@ -1,15 +1,20 @@
 # server.py
-import os, asyncio
-from typing import Any, List
-import faiss, numpy as np
+import os, sys, asyncio
+from typing import List
 from dotenv import load_dotenv
-from openai import OpenAI
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
 import mcp.types as types
 
 load_dotenv()
 
+# 复用 02-mcp-rag/rag-server 中的向量库磁盘格式（rag_store.py）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "..", "02-mcp-rag", "rag-server"))
+from chunking import as_chunk
+from rag_store import RagStore
+from embedding import OpenAIEmbedder
+
 # 创建一个MCP服务器实例，名称为"rag-simple"
 app = Server("rag-simple")
 
@@ -37,29 +42,25 @@ async def read_resource(uri: str) -> str:
         return f.read()
 
 # --- 以下为原有的 index_docs / retrieve_docs 工具逻辑（不注册为 tool，仅供本地调用） ---
-_index = faiss.IndexFlatL2(1536)
-_docs: List[str] = []
-openai = OpenAI()
-
-async def embed_text(texts: List[str]) -> np.ndarray:
-    resp = openai.embeddings.create(
-        model="text-embedding-3-small",
-        input=texts,
-        encoding_format="float"
-    )
-    return np.array([d.embedding for d in resp.data], dtype="float32")
+_store = RagStore.open(os.getenv("RAG_INDEX_PATH"), dim=1536,
+                       verify=os.getenv("RAG_VERIFY_INDEX") == "1")
+embed_text = OpenAIEmbedder(model="text-embedding-3-small")
 
 async def index_docs(docs: List[str]) -> str:
-    global _index, _docs
-    emb = await embed_text(docs)
-    _index.add(emb)
-    _docs.extend(docs)
-    return f"已索引 {len(docs)} 篇文档，总文档数：{len(_docs)}"
+    # 客户端每次连接都会重新发送全部资源，已入库的相同内容直接跳过，不再重复嵌入
+    counts = {"skipped": 0}
+    new_docs = [c.text for c in _store.unique_chunks(map(as_chunk, docs), counts)]
+    if new_docs:
+        emb = await embed_text(new_docs)
+        _store.add(emb, new_docs)
+        _store.save()
+    return (f"已索引 {len(docs)} 篇文档：新增 {len(new_docs)} 篇，"
+            f"跳过重复 {counts['skipped']} 篇，总文档数：{len(_store)}")
 
 async def retrieve_docs(query: str, top_k: int = 3) -> str:
     q_emb = await embed_text([query])
-    D, I = _index.search(q_emb, top_k)
-    hits = [f"[{i}] {_docs[i]}" for i in I[0] if i < len(_docs)]
+    D, I = _store.search(q_emb, top_k)
+    hits = [f"[{i}] {_store.doc(i)}" for i in I[0] if _store.row_of(i) >= 0]
     return "\n\n".join(hits) or "未检索到相关文档。"
 
 async def main():
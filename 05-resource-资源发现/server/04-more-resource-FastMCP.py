@@ -1,14 +1,19 @@
 # server.py
-import os, asyncio
-from typing import Any, List
-import faiss, numpy as np
+import os, sys, asyncio
+from typing import List
 from dotenv import load_dotenv
-from openai import OpenAI
 from mcp.server.fastmcp import FastMCP
-import mcp.types as types
 
 load_dotenv()
 
+# 复用 02-mcp-rag/rag-server 中的向量库磁盘格式（rag_store.py）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "..", "02-mcp-rag", "rag-server"))
+from chunking import as_chunk
+from rag_store import RagStore
+from embedding import OpenAIEmbedder, embed_in_batches
+from path_source import map_ordered, read_file_chunks, resolve_paths
+
 # 指定文档目录，服务器启动时，会将该目录下所有 .txt 文件暴露为资源
 DOC_DIR = "/home/huangj2/Documents/mcp-in-action/05-resource-资源发现/server/medical_docs"
 
@@ -46,31 +51,68 @@ for fname in os.listdir(DOC_DIR):
 #     ]
 
 # --- 以下保留原有的 index_docs / retrieve_docs 工具 ---
-_index = faiss.IndexFlatL2(1536)
-_docs: List[str] = []
-openai = OpenAI()
-
-async def embed_text(texts: List[str]) -> np.ndarray:
-    resp = openai.embeddings.create(
-        model="text-embedding-3-small",
-        input=texts,
-        encoding_format="float"
-    )
-    return np.array([d.embedding for d in resp.data], dtype="float32")
+_store = RagStore.open(os.getenv("RAG_INDEX_PATH"), dim=1536,
+                       verify=os.getenv("RAG_VERIFY_INDEX") == "1")
+embed_text = OpenAIEmbedder(model="text-embedding-3-small")
+# index_resources 每读够 INGEST_GROUP 篇文档就去重、嵌入、加入一组，内存占用与文件总量无关
+INGEST_GROUP = 256
 
 @mcp.tool()
 async def index_docs(docs: List[str]) -> str:
-    global _index, _docs
-    emb = await embed_text(docs)
-    _index.add(emb)
-    _docs.extend(docs)
-    return f"已索引 {len(docs)} 篇文档，总文档数：{len(_docs)}"
+    # 客户端每次连接都会重新发送全部资源，已入库的相同内容直接跳过，不再重复嵌入
+    counts = {"skipped": 0}
+    new_docs = [c.text for c in _store.unique_chunks(map(as_chunk, docs), counts)]
+    if new_docs:
+        emb = await embed_text(new_docs)
+        _store.add(emb, new_docs)
+        _store.save()
+    return (f"已索引 {len(docs)} 篇文档：新增 {len(new_docs)} 篇，"
+            f"跳过重复 {counts['skipped']} 篇，总文档数：{len(_store)}")
+
+@mcp.tool()
+async def index_resources(uris: List[str]) -> str:
+    """由服务端直接读取资源文件入库，只传 URI，不必把全文发回服务端。
+    Args:
+        uris: 资源 URI（file://...）、文件名或 glob 模式（如 *.txt），只能是文档目录下的文件
+    """
+    try:
+        files = await asyncio.to_thread(resolve_paths, uris, [DOC_DIR])
+    except ValueError as e:
+        return f"参数错误：{e}"
+    counts = {"skipped": 0}
+    n_files = n_new = 0
+    group = []
+
+    async def flush() -> None:
+        nonlocal n_new
+        # 去重、加入与保存都是同步的向量库操作，放到线程中，不阻塞其他请求
+        new_docs = await asyncio.to_thread(lambda: list(_store.unique_chunks(group, counts)))
+        group.clear()
+        async for batch, emb in embed_in_batches(new_docs, embed_text, embed_text.max_batch_items,
+                                                 embed_text.max_batch_tokens, embed_text.max_concurrency):
+            await asyncio.to_thread(_store.add, emb, batch)
+        n_new += len(new_docs)
+
+    # 并行读取，每个文件整篇作为一个文档（与 index_docs 相同），来源为文件路径；按文件顺序分组入库
+    async for path, chunks in map_ordered(lambda p: read_file_chunks(p, max_tokens=0), files):
+        if chunks is None:
+            continue
+        n_files += 1
+        group.extend(chunks)
+        if len(group) >= INGEST_GROUP:
+            await flush()
+    if group:
+        await flush()
+    if n_new:
+        await asyncio.to_thread(_store.save)
+    return (f"已读取 {n_files} 个资源文件：新增 {n_new} 篇，"
+            f"跳过重复 {counts['skipped']} 篇，总文档数：{len(_store)}")
 
 @mcp.tool()
 async def retrieve_docs(query: str, top_k: int = 3) -> str:
     q_emb = await embed_text([query])
-    D, I = _index.search(q_emb, top_k)
-    hits = [f"[{i}] {_docs[i]}" for i in I[0] if i < len(_docs)]
+    D, I = _store.search(q_emb, top_k)
+    hits = [f"[{i}] {_store.doc(i)}" for i in I[0] if _store.row_of(i) >= 0]
     return "\n\n".join(hits) or "未检索到相关文档。"
 
 if __name__ == "__main__":